@@ -0,0 +1,335 @@
+"""
+WordToWord 无界面 HTTP 服务 (可在负载均衡后水平扩展)
+
+启动:
+    python api_server.py --host 0.0.0.0 --port 8080
+
+鉴权: 请求头 X-API-Key (在网页侧边栏「API 访问密钥」中生成)，DeepSeek Key 使用该用户在网页中保存的配置。
+
+接口:
+    GET  /api/v1/health                     健康检查
+    POST /api/v1/analyze                    multipart: template(docx) + source(docx/pdf，可重复多个) 或 profile_name
+                                            -> 202 {job_id}
+    GET  /api/v1/jobs/{job_id}              任务状态 (ready 后附带方案)
+    PUT  /api/v1/jobs/{job_id}/plan         提交编辑后的方案 (JSON body)
+    POST /api/v1/jobs/{job_id}/render       生成并返回 docx
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from aiohttp import web
+
+import auth
+import blobstore
+import logic
+import state_store
+
+MAX_UPLOAD_BYTES = int(os.getenv("API_MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))  # 单个文件
+MAX_REQUEST_BYTES = int(os.getenv("API_MAX_REQUEST_BYTES", str(60 * 1024 * 1024)))  # 一次 multipart 请求合计
+MAX_PARTS = int(os.getenv("API_MAX_PARTS", "12"))  # 一次请求的字段数 (含多个 source)
+MAX_FIELD_BYTES = 256  # profile_name 等文本字段
+MAX_JSON_BYTES = int(os.getenv("API_MAX_JSON_BYTES", str(2 * 1024 * 1024)))
+CPU_WORKERS = int(os.getenv("API_CPU_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+LLM_WORKERS = int(os.getenv("API_LLM_WORKERS", "16"))
+JOB_TTL_SECONDS = int(os.getenv("API_JOB_TTL_SECONDS", str(6 * 3600)))
+JOB_STALE_SECONDS = int(os.getenv("API_JOB_STALE_SECONDS", "900"))
+LLM_BASE_URL = os.getenv("LLM_BASE_URL", "https://api.deepseek.com")
+
+DOCX_MIME = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+_CHUNK = 64 * 1024
+
+# 任务记录放在 state_store 中，任意副本都能查询/修改/生成；单个任务只保存 blob 句柄和少量元数据。
+_RUNNING_STATUSES = ("queued", "reading", "analyzing")
+
+
+# ================= 工作进程中执行的函数 (需可 pickle) =================
+def _validate_and_read(path):
+    valid, msg = logic.validate_file_format(path)
+    if not valid:
+        raise ValueError(msg)
+    return logic.read_template_structure(path)
+
+
+def _read_source(path):
+    # 源文件只用于生成方案，PDF 读满读取预算即停 (生成方案时再按模板检索相关段落)
+    return logic.read_file_content(path, char_budget=logic.SOURCE_READ_BUDGET)
+
+
+def _render(plan, template_path, template_hash):
+    data, _ = logic.render_document_cached(plan, template_path, template_hash=template_hash)
+    return data
+
+
+def _generate_plan(api_key, username, old_txt, new_txt):
+    from openai import OpenAI
+    client = OpenAI(api_key=api_key, base_url=LLM_BASE_URL, max_retries=0)  # 重试交给 llm_scheduler
+    return logic.generate_filling_plan_v2(client, old_txt, new_txt, user=username)
+
+
+# ================= 工具函数 =================
+def _json_error(status, msg):
+    return web.json_response({"error": msg}, status=status)
+
+
+def _take(budget, n):
+    """
+    从整个请求的剩余字节数中扣除 n，超出即中断
+    """
+    budget[0] -= n
+    if budget[0] < 0:
+        raise web.HTTPRequestEntityTooLarge(max_size=MAX_REQUEST_BYTES, actual_size=MAX_REQUEST_BYTES - budget[0])
+
+
+async def _read_field(part, budget):
+    data = b""
+    while True:
+        chunk = await part.read_chunk(_CHUNK)
+        if not chunk: break
+        _take(budget, len(chunk))
+        data += chunk
+        if len(data) > MAX_FIELD_BYTES:
+            raise web.HTTPBadRequest(reason=f"字段 {part.name} 过长")
+    return data.decode(part.get_charset(default="utf-8"), errors="replace")
+
+
+async def _drain(part, budget):
+    while True:
+        chunk = await part.read_chunk(_CHUNK)
+        if not chunk: break
+        _take(budget, len(chunk))
+
+
+async def _save_upload(part, allowed_exts, budget):
+    """
+    流式写入临时文件，超过单个文件或整个请求的大小限制立即中断；完成后纳入 blobstore 并返回句柄
+    """
+    filename = part.filename or ""
+    ext = os.path.splitext(filename)[1].lower()
+    if ext not in allowed_exts:
+        raise web.HTTPBadRequest(reason=f"不支持的文件类型: {filename}")
+    os.makedirs("temp", exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix=ext, dir="temp")
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                chunk = await part.read_chunk(_CHUNK)
+                if not chunk: break
+                size += len(chunk)
+                _take(budget, len(chunk))
+                if size > MAX_UPLOAD_BYTES:
+                    raise web.HTTPRequestEntityTooLarge(max_size=MAX_UPLOAD_BYTES, actual_size=size)
+                f.write(chunk)
+        handle = await asyncio.to_thread(blobstore.put_file, tmp_path, ext, True)
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+    return handle, filename
+
+
+async def _get_job(request):
+    job = await asyncio.to_thread(state_store.get_job, request.match_info["job_id"])
+    if job is None or job["username"] != request["username"]:
+        raise web.HTTPNotFound(reason="任务不存在")
+    if job["status"] in _RUNNING_STATUSES and time.time() - job["updated_at"] > JOB_STALE_SECONDS:
+        # 负责该任务的实例已退出 (重启/缩容)，不会再有人更新它
+        await _update_job(job, status="failed", error="任务中断，请重新提交")
+    return job
+
+
+async def _update_job(job, **fields):
+    job.update(fields, updated_at=time.time())
+    await asyncio.to_thread(state_store.put_job, job)
+
+
+def _cleanup_jobs():
+    now = time.time()
+    for job in state_store.list_jobs():
+        if now - job["updated_at"] > JOB_TTL_SECONDS:
+            state_store.delete_job(job["job_id"])
+            for key in ("template_blob", "source_blob", "plan_blob"):
+                blobstore.release(job.get(key))
+            for _, handle in job.get("source_blobs") or []:
+                blobstore.release(handle)
+
+
+# ================= 中间件 =================
+@web.middleware
+async def auth_middleware(request, handler):
+    if request.path == "/api/v1/health":
+        return await handler(request)
+    res = await asyncio.to_thread(auth.verify_api_key, request.headers.get("X-API-Key", ""))
+    if not res:
+        return _json_error(401, "无效的 API Key")
+    request["username"], request["role"] = res
+    return await handler(request)
+
+
+# ================= 接口 =================
+async def health(request):
+    return web.json_response({"status": "ok", "jobs": await asyncio.to_thread(state_store.count_jobs)})
+
+
+async def analyze(request):
+    if not request.content_type.startswith("multipart/"):
+        return _json_error(400, "请使用 multipart/form-data 上传")
+    username = request["username"]
+    api_key = await asyncio.to_thread(auth.get_user_apikey, username)
+    if not api_key:
+        return _json_error(400, "该用户尚未配置 DeepSeek API Key")
+
+    template_blob = None
+    source_blobs = []  # 多个 source 字段：[[文件名, 句柄], ...]
+    profile_name = ""
+    filename = "template.docx"
+    if request.content_length and request.content_length > MAX_REQUEST_BYTES:
+        return _json_error(413, "请求过大")
+    budget = [MAX_REQUEST_BYTES]  # 分块上传没有 Content-Length，边读边计数
+    parts = 0
+    reader = await request.multipart()
+    async for part in reader:
+        parts += 1
+        if parts > MAX_PARTS:
+            return _json_error(413, f"字段过多 (最多 {MAX_PARTS} 个)")
+        if part.name == "template":
+            template_blob, filename = await _save_upload(part, (".docx",), budget)
+        elif part.name == "source":
+            handle, source_name = await _save_upload(part, (".docx", ".pdf"), budget)
+            source_blobs.append([source_name, handle])
+        elif part.name == "profile_name":
+            profile_name = (await _read_field(part, budget)).strip()
+        else:
+            await _drain(part, budget)
+    if not template_blob or not (source_blobs or profile_name):
+        return _json_error(400, "需要 template，以及 source 或 profile_name 之一")
+
+    source_text = None
+    if not source_blobs:
+        source_text = await asyncio.to_thread(auth.get_profile_text, username, profile_name)
+        if source_text is None:
+            return _json_error(404, f"档案不存在: {profile_name}")
+
+    await asyncio.to_thread(_cleanup_jobs)
+    job_id = uuid.uuid4().hex
+    for handle in [template_blob] + [h for _, h in source_blobs]:
+        await asyncio.to_thread(blobstore.acquire, handle)
+    now = time.time()
+    job = {"job_id": job_id, "username": username, "status": "queued", "error": "",
+           "filename": filename, "template_blob": template_blob, "source_blobs": source_blobs,
+           "plan_blob": None, "created_at": now, "updated_at": now}
+    await asyncio.to_thread(state_store.put_job, job)
+    task = asyncio.create_task(_run_analysis(request.app, job, api_key, source_text))
+    request.app["tasks"].add(task)
+    task.add_done_callback(request.app["tasks"].discard)
+    return web.json_response({"job_id": job_id, "status": "queued"}, status=202)
+
+
+async def _run_analysis(app, job, api_key, source_text):
+    loop = asyncio.get_running_loop()
+    cpu_pool, llm_pool = app["cpu_pool"], app["llm_pool"]
+    try:
+        await _update_job(job, status="reading")
+        await asyncio.to_thread(auth.log_action, job["username"], "API Analysis Started")
+        template_path = await asyncio.to_thread(blobstore.blob_path, job["template_blob"])
+        reads = [loop.run_in_executor(cpu_pool, _validate_and_read, template_path)]
+        if source_text is None:
+            # 多个源文件各占一个工作进程并发读取，再去重合并
+            for _, handle in job["source_blobs"]:
+                path = await asyncio.to_thread(blobstore.blob_path, handle)
+                reads.append(loop.run_in_executor(cpu_pool, _read_source, path))
+        results = await asyncio.gather(*reads)
+        new_txt = results[0]
+        if source_text is None:
+            source_text = await asyncio.to_thread(
+                logic.merge_sources, [(name, text) for (name, _), text in zip(job["source_blobs"], results[1:])])
+        old_txt = source_text
+
+        await _update_job(job, status="analyzing")
+        plan = await loop.run_in_executor(llm_pool, _generate_plan, api_key, job["username"], old_txt, new_txt)
+        handle = await asyncio.to_thread(blobstore.put_json, plan)
+        plan_blob = await asyncio.to_thread(blobstore.swap, job["plan_blob"], handle)
+        await _update_job(job, plan_blob=plan_blob, status="ready")
+    except Exception as e:
+        await _update_job(job, status="failed", error=str(e))
+
+
+async def get_job(request):
+    job = await _get_job(request)
+    body = {k: job[k] for k in ("job_id", "status", "error", "filename", "created_at", "updated_at")}
+    if job["status"] == "ready":
+        body["plan"] = await asyncio.to_thread(blobstore.get_json, job["plan_blob"])
+    return web.json_response(body)
+
+
+async def put_plan(request):
+    job = await _get_job(request)
+    if job["status"] != "ready":
+        return _json_error(409, f"任务当前状态为 {job['status']}，不能修改方案")
+    if request.content_length and request.content_length > MAX_JSON_BYTES:
+        return _json_error(413, "方案过大")
+    try:
+        plan = await request.json()
+    except ValueError:
+        return _json_error(400, "方案不是合法的 JSON")
+    if not isinstance(plan, dict) or not all(isinstance(plan.get(k, []), list) for k in ("kv", "checkbox", "lists")):
+        return _json_error(400, "方案需要包含 kv / checkbox / lists 列表")
+    handle = await asyncio.to_thread(blobstore.put_json, plan)
+    await _update_job(job, plan_blob=await asyncio.to_thread(blobstore.swap, job["plan_blob"], handle))
+    return web.json_response({"job_id": job["job_id"], "status": job["status"]})
+
+
+async def render(request):
+    job = await _get_job(request)
+    if job["status"] != "ready":
+        return _json_error(409, f"任务当前状态为 {job['status']}，暂不能生成")
+    template_path = await asyncio.to_thread(blobstore.blob_path, job["template_blob"])
+    plan = await asyncio.to_thread(blobstore.get_json, job["plan_blob"])
+    if template_path is None or plan is None:
+        return _json_error(410, "任务数据已过期，请重新分析")
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(request.app["cpu_pool"], _render, plan, template_path, job["template_blob"])
+    await _update_job(job)
+    await asyncio.to_thread(auth.log_action, job["username"], "API Completed")
+    return web.Response(body=data, content_type=DOCX_MIME, headers={
+        "Content-Disposition": f"attachment; filename*=UTF-8''WordToWord_V1.0_{job['job_id']}.docx"})
+
+
+# ================= 应用装配 =================
+async def _on_startup(app):
+    app["cpu_pool"] = ProcessPoolExecutor(max_workers=CPU_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    app["llm_pool"] = ThreadPoolExecutor(max_workers=LLM_WORKERS, thread_name_prefix="llm")
+    app["tasks"] = set()
+
+
+async def _on_cleanup(app):
+    for task in list(app["tasks"]):
+        task.cancel()
+    app["cpu_pool"].shutdown(wait=False, cancel_futures=True)
+    app["llm_pool"].shutdown(wait=False, cancel_futures=True)
+
+
+def create_app():
+    auth.init_db()
+    # multipart 上传走流式读取并自行限流，这里的上限只约束普通请求体
+    app = web.Application(middlewares=[auth_middleware], client_max_size=MAX_JSON_BYTES)
+    app.router.add_get("/api/v1/health", health)
+    app.router.add_post("/api/v1/analyze", analyze)
+    app.router.add_get("/api/v1/jobs/{job_id}", get_job)
+    app.router.add_put("/api/v1/jobs/{job_id}/plan", put_plan)
+    app.router.add_post("/api/v1/jobs/{job_id}/render", render)
+    app.on_startup.append(_on_startup)
+    app.on_cleanup.append(_on_cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="WordToWord HTTP API")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+    web.run_app(create_app(), host=args.host, port=args.port)
@@ -1,9 +1,14 @@
 import sqlite3
 import hashlib
 import datetime
-import pandas as pd
+import secrets
 import os
-import streamlit as st
+import sys
+import threading
+import time
+import queue
+import re
+import atexit
 from dotenv import load_dotenv
 import json
 
@@ -12,45 +17,169 @@ load_dotenv()
 
 # 定义配置读取
 def get_config(key, default_value):
-    try:
-        return st.secrets[key]
-    except:
-        return os.getenv(key, default_value)
+    # 只在 Streamlit 进程里读 st.secrets，API 服务等其他进程不必加载 streamlit
+    if "streamlit" in sys.modules:
+        try:
+            return sys.modules["streamlit"].secrets[key]
+        except:
+            pass
+    return os.getenv(key, default_value)
 
 
 DB_FILE = get_config("DB_NAME", "wordtoword.db")
 ADMIN_USER = get_config("ADMIN_USERNAME", "admin")
 ADMIN_PASS = get_config("ADMIN_PASSWORD", "admin123")
 
+# ================= 档案检索索引 =================
+# - profiles_fts：FTS5 trigram (子串匹配，3 个字及以上的检索词)，需要 SQLite 3.34+
+# - profiles_grams：contentless FTS5，每份档案不重复的单字/双字各记一次，供两个字的姓名等短词使用。
+#   分词在 Python 里完成，由 save_profile / delete_profile 维护
+# 没有 FTS5 或版本过旧时不建索引，检索退回逐行 LIKE。
+_HAS_TRIGRAM = sqlite3.sqlite_version_info >= (3, 34, 0)
+_GRAM_RUN_RE = re.compile(r"[\u4e00-\u9fa5A-Za-z0-9]+")
+_GRAM_TERM_RE = re.compile(r"[\u4e00-\u9fa5A-Za-z0-9]{1,2}")
+
+_TRIGRAM_INDEX_SQL = [
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS profiles_fts USING fts5(profile_name, content_text, content='profiles', content_rowid='id', tokenize='trigram')''',
+    '''CREATE TRIGGER IF NOT EXISTS profiles_ai AFTER INSERT ON profiles BEGIN
+        INSERT INTO profiles_fts(rowid, profile_name, content_text) VALUES (new.id, new.profile_name, new.content_text);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS profiles_ad AFTER DELETE ON profiles BEGIN
+        INSERT INTO profiles_fts(profiles_fts, rowid, profile_name, content_text) VALUES ('delete', old.id, old.profile_name, old.content_text);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS profiles_au AFTER UPDATE ON profiles BEGIN
+        INSERT INTO profiles_fts(profiles_fts, rowid, profile_name, content_text) VALUES ('delete', old.id, old.profile_name, old.content_text);
+        INSERT INTO profiles_fts(rowid, profile_name, content_text) VALUES (new.id, new.profile_name, new.content_text);
+    END''',
+    # 已有档案建索引；排序时档案名命中的权重高于正文
+    '''INSERT INTO profiles_fts(profiles_fts) VALUES ('rebuild')''',
+    '''INSERT INTO profiles_fts(profiles_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0)')''',
+]
+
+
+def _has_table(c, name):
+    return c.execute("SELECT 1 FROM sqlite_master WHERE name=?", (name,)).fetchone() is not None
+
+
+def _create_trigram_index(c):
+    if not _HAS_TRIGRAM: return
+    try:
+        for sql in _TRIGRAM_INDEX_SQL:
+            c.execute(sql)
+    except sqlite3.OperationalError:
+        # 编译时未启用 FTS5：档案检索退回 LIKE
+        c.execute("DROP TABLE IF EXISTS profiles_fts")
+
+
+def _profile_grams(profile_name, content_text):
+    """
+    档案名与正文中连续的中文/字母/数字片段，取不重复的单字和相邻两字，空格分隔 (顺序固定，删除索引时可重算)
+    """
+    grams = set()
+    for run in _GRAM_RUN_RE.findall(f"{profile_name or ''}\n{content_text or ''}".lower()):
+        grams.update(run)
+        grams.update(run[i:i + 2] for i in range(len(run) - 1))
+    return " ".join(sorted(grams))
+
+
+def _create_gram_index(c):
+    try:
+        c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS profiles_grams USING fts5(grams, content='', tokenize='unicode61')")
+    except sqlite3.OperationalError:
+        return  # 编译时未启用 FTS5
+    for rowid, name, content in c.execute("SELECT id, profile_name, content_text FROM profiles").fetchall():
+        c.execute("INSERT INTO profiles_grams(rowid, grams) VALUES (?, ?)", (rowid, _profile_grams(name, content)))
+
+
+def _update_gram_index(c, rowid, profile_name, old_text=None, new_text=None):
+    """
+    contentless 表删除时必须提供与写入时相同的内容，因此由调用方给出修改前的正文
+    """
+    if not _has_table(c, "profiles_grams"): return
+    if old_text is not None:
+        c.execute("INSERT INTO profiles_grams(profiles_grams, rowid, grams) VALUES ('delete', ?, ?)",
+                  (rowid, _profile_grams(profile_name, old_text)))
+    if new_text is not None:
+        c.execute("INSERT INTO profiles_grams(rowid, grams) VALUES (?, ?)", (rowid, _profile_grams(profile_name, new_text)))
+
+
+# ================= 数据库结构版本 =================
+# 每个元素是一次迁移 (一组 SQL，或接收游标的函数)，版本号 = 下标 + 1，记录在 PRAGMA user_version 中。
+# 只能在末尾追加新迁移，不要修改已发布的迁移。
+MIGRATIONS = [
+    # v1: 初始结构
+    [
+        # 用户表
+        '''CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT, role TEXT, created_at TEXT)''',
+        # 日志表
+        '''CREATE TABLE IF NOT EXISTS logs (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, action TEXT, timestamp TEXT)''',
+        # 反馈表
+        '''CREATE TABLE IF NOT EXISTS feedback (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, content TEXT, rating INTEGER, timestamp TEXT)''',
+        # 用户配置表 (用于记忆 API Key 等设置)
+        '''CREATE TABLE IF NOT EXISTS user_config (username TEXT PRIMARY KEY, api_key TEXT, updated_at TEXT)''',
+        # 用户档案表 (用于记忆上传过的简历/文档内容)
+        '''CREATE TABLE IF NOT EXISTS profiles (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, profile_name TEXT, content_text TEXT, created_at TEXT)''',
+    ],
+    # v2: 常用查询的索引
+    [
+        '''CREATE INDEX IF NOT EXISTS idx_logs_timestamp ON logs(timestamp)''',
+        '''CREATE INDEX IF NOT EXISTS idx_profiles_user ON profiles(username, profile_name)''',
+    ],
+    # v3: HTTP API 访问密钥 (只存哈希)
+    [
+        '''CREATE TABLE IF NOT EXISTS api_keys (key_hash TEXT PRIMARY KEY, username TEXT, name TEXT, created_at TEXT, last_used TEXT)''',
+        '''CREATE INDEX IF NOT EXISTS idx_api_keys_user ON api_keys(username)''',
+    ],
+    # v4: 过期日志按天汇总
+    [
+        '''CREATE TABLE IF NOT EXISTS logs_daily (day TEXT, username TEXT, action TEXT, count INTEGER, PRIMARY KEY (day, username, action))''',
+    ],
+    # v5: 档案全文索引 (FTS5 trigram，外部内容表，由触发器与 profiles 保持同步；SQLite 过旧时跳过)
+    [
+        _create_trigram_index,
+        '''CREATE INDEX IF NOT EXISTS idx_profiles_created ON profiles(created_at)''',
+    ],
+    # v6: 短检索词 (一两个字) 的单字/双字索引
+    [
+        _create_gram_index,
+    ],
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+_db_ready = False
+_db_lock = threading.Lock()
+
 
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    # 用户表
-    c.execute(
-        '''CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT, role TEXT, created_at TEXT)''')
-    # 日志表
-    c.execute(
-        '''CREATE TABLE IF NOT EXISTS logs (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, action TEXT, timestamp TEXT)''')
-    # 反馈表
-    c.execute(
-        '''CREATE TABLE IF NOT EXISTS feedback (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, content TEXT, rating INTEGER, timestamp TEXT)''')
-
-    # 【新增 1】用户配置表 (用于记忆 API Key 等设置)
-    c.execute('''CREATE TABLE IF NOT EXISTS user_config (username TEXT PRIMARY KEY, api_key TEXT, updated_at TEXT)''')
-
-    # 【新增 2】用户档案表 (用于记忆上传过的简历/文档内容)
-    c.execute(
-        '''CREATE TABLE IF NOT EXISTS profiles (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, profile_name TEXT, content_text TEXT, created_at TEXT)''')
-
-    # 初始化管理员
-    c.execute("SELECT * FROM users WHERE username=?", (ADMIN_USER,))
-    if not c.fetchone():
-        pwd_hash = hashlib.sha256(ADMIN_PASS.encode()).hexdigest()
-        c.execute("INSERT INTO users VALUES (?, ?, ?, ?)",
-                  (ADMIN_USER, pwd_hash, 'admin', datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-    conn.commit()
-    conn.close()
+    """
+    进程内只真正执行一次 (Streamlit 每次重跑都会调用，之后直接返回)。
+    按 user_version 依次执行尚未应用的迁移，并确保管理员账号存在。
+    """
+    global _db_ready
+    if _db_ready: return
+    with _db_lock:
+        if _db_ready: return
+        conn = sqlite3.connect(DB_FILE)
+        c = conn.cursor()
+        version = c.execute("PRAGMA user_version").fetchone()[0]
+        for v in range(version, SCHEMA_VERSION):
+            for step in MIGRATIONS[v]:
+                step(c) if callable(step) else c.execute(step)
+            c.execute(f"PRAGMA user_version = {v + 1}")
+            conn.commit()
+        # 数据库在旧版 SQLite 上迁移过、之后升级了 SQLite：补建 trigram 索引
+        if _HAS_TRIGRAM and not _has_table(c, "profiles_fts"):
+            _create_trigram_index(c)
+
+        # 初始化管理员
+        c.execute("SELECT * FROM users WHERE username=?", (ADMIN_USER,))
+        if not c.fetchone():
+            pwd_hash = hashlib.sha256(ADMIN_PASS.encode()).hexdigest()
+            c.execute("INSERT INTO users VALUES (?, ?, ?, ?)",
+                      (ADMIN_USER, pwd_hash, 'admin', datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        conn.commit()
+        conn.close()
+        _db_ready = True
 
 
 # --- 用户认证 ---
@@ -99,24 +228,80 @@ def get_user_apikey(username):
     return res[0] if res else ""
 
 
+# --- HTTP API 访问密钥 ---
+def create_api_key(username, name=""):
+    """
+    生成新的访问密钥，明文只在此处返回一次，库里只保存 sha256
+    """
+    raw_key = "w2w_" + secrets.token_urlsafe(32)
+    conn = sqlite3.connect(DB_FILE)
+    c = conn.cursor()
+    c.execute("INSERT INTO api_keys (key_hash, username, name, created_at, last_used) VALUES (?, ?, ?, ?, ?)",
+              (hashlib.sha256(raw_key.encode()).hexdigest(), username, name,
+               datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), ""))
+    conn.commit()
+    conn.close()
+    return raw_key
+
+
+def verify_api_key(raw_key):
+    """
+    校验访问密钥，返回 (用户名, 角色)；无效则返回 None
+    """
+    if not raw_key: return None
+    conn = sqlite3.connect(DB_FILE)
+    c = conn.cursor()
+    key_hash = hashlib.sha256(raw_key.encode()).hexdigest()
+    c.execute("SELECT k.username, u.role FROM api_keys k JOIN users u ON u.username = k.username WHERE k.key_hash=?",
+              (key_hash,))
+    res = c.fetchone()
+    if res:
+        c.execute("UPDATE api_keys SET last_used=? WHERE key_hash=?",
+                  (datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), key_hash))
+        conn.commit()
+    conn.close()
+    return res
+
+
+def list_api_keys(username):
+    conn = sqlite3.connect(DB_FILE)
+    c = conn.cursor()
+    c.execute("SELECT substr(key_hash, 1, 8), name, created_at, last_used FROM api_keys WHERE username=? ORDER BY created_at DESC",
+              (username,))
+    res = c.fetchall()
+    conn.close()
+    return res
+
+
+def revoke_api_key(username, key_prefix):
+    conn = sqlite3.connect(DB_FILE)
+    c = conn.cursor()
+    c.execute("DELETE FROM api_keys WHERE username=? AND key_hash LIKE ?", (username, key_prefix + "%"))
+    conn.commit()
+    conn.close()
+
+
 # --- 档案记忆 (简历内容) ---
 def save_profile(username, profile_name, content_text):
     conn = sqlite3.connect(DB_FILE)
     c = conn.cursor()
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     # 检查是否已存在同名档案，存在则更新
-    c.execute("SELECT id FROM profiles WHERE username=? AND profile_name=?", (username, profile_name))
+    c.execute("SELECT id, content_text FROM profiles WHERE username=? AND profile_name=?", (username, profile_name))
     exist = c.fetchone()
     if exist:
         c.execute("UPDATE profiles SET content_text=?, created_at=? WHERE id=?", (content_text, timestamp, exist[0]))
+        _update_gram_index(c, exist[0], profile_name, old_text=exist[1], new_text=content_text)
     else:
         c.execute("INSERT INTO profiles (username, profile_name, content_text, created_at) VALUES (?, ?, ?, ?)",
                   (username, profile_name, content_text, timestamp))
+        _update_gram_index(c, c.lastrowid, profile_name, new_text=content_text)
     conn.commit()
     conn.close()
 
 
 def get_user_profiles(username):
+    import pandas as pd
     conn = sqlite3.connect(DB_FILE)
     # 返回 profile_name 列表
     df = pd.read_sql(
@@ -129,19 +314,276 @@ def get_user_profiles(username):
 def delete_profile(username, profile_name):
     conn = sqlite3.connect(DB_FILE)
     c = conn.cursor()
+    for rowid, content in c.execute("SELECT id, content_text FROM profiles WHERE username=? AND profile_name=?",
+                                    (username, profile_name)).fetchall():
+        _update_gram_index(c, rowid, profile_name, old_text=content)
     c.execute("DELETE FROM profiles WHERE username=? AND profile_name=?", (username, profile_name))
     conn.commit()
     conn.close()
 
 
+def get_profile_text(username, profile_name):
+    conn = sqlite3.connect(DB_FILE)
+    row = conn.execute("SELECT content_text FROM profiles WHERE username=? AND profile_name=?",
+                       (username, profile_name)).fetchone()
+    conn.close()
+    return row[0] if row else None
+
+
+def list_profiles(username, limit=20, offset=0):
+    """
+    最近的档案 (不含正文)，返回 [(profile_name, created_at)]
+    """
+    conn = sqlite3.connect(DB_FILE)
+    rows = conn.execute("SELECT profile_name, created_at FROM profiles WHERE username=? ORDER BY created_at DESC LIMIT ? OFFSET ?",
+                        (username, limit, offset)).fetchall()
+    conn.close()
+    return rows
+
+
+def count_profiles(username=None):
+    conn = sqlite3.connect(DB_FILE)
+    if username is None:
+        n = conn.execute("SELECT COUNT(*) FROM profiles").fetchone()[0]
+    else:
+        n = conn.execute("SELECT COUNT(*) FROM profiles WHERE username=?", (username,)).fetchone()[0]
+    conn.close()
+    return n
+
+
+# --- 档案检索 ---
+# - 全库 (管理员) 或档案很多的用户：3 个字及以上的检索词走 FTS5 trigram 索引 (子串匹配，bm25 排序)，
+#   一两个字的词 (如姓名) 走单字/双字索引
+# - 普通用户的档案不多，直接按 username 索引取出自己的档案逐行匹配，比在全库索引里求交集更快
+# - 带标点等无法索引的短词、或 SQLite 不支持相应索引时，逐行 LIKE 过滤
+PROFILE_PAGE_SIZE = 20
+PROFILE_SCAN_LIMIT = int(get_config("PROFILE_SCAN_LIMIT", 2000))
+HIGHLIGHT = ("**", "**")
+
+
+def _like_pattern(term):
+    return "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def _fts_phrase(term):
+    return '"' + term.replace('"', '""') + '"'
+
+
+def _make_snippet(text, terms, width=40):
+    """
+    截取第一个命中词附近的一段正文并高亮所有检索词 (不区分大小写，与 trigram 索引一致)
+    """
+    text = (text or "").replace("\n", " ")
+    if not terms:
+        return text[:width]
+    pattern = re.compile("|".join(re.escape(t) for t in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    m = pattern.search(text)
+    start = max(0, m.start() - width // 2) if m else 0
+    snippet = text[start:start + width]
+    snippet = pattern.sub(lambda m: f"{HIGHLIGHT[0]}{m.group(0)}{HIGHLIGHT[1]}", snippet)
+    return ("…" if start else "") + snippet + ("…" if start + width < len(text) else "")
+
+
+def search_profiles(query, username=None, page=1, page_size=PROFILE_PAGE_SIZE):
+    """
+    分页检索档案名与正文 (多个词之间为“且”)。username 为 None 时检索全部用户 (管理员)。
+    返回 (结果列表, 总数)，结果每项为 {"username", "profile_name", "created_at", "snippet"}。
+    """
+    terms = [t for t in (query or "").split() if t]
+    offset = (max(1, page) - 1) * page_size
+
+    conn = sqlite3.connect(DB_FILE)
+    use_index = bool(terms) and (username is None or count_profiles(username) > PROFILE_SCAN_LIMIT)
+    long_terms, gram_terms, like_terms = [], [], []
+    for t in terms:
+        if use_index and len(t) >= 3 and _HAS_TRIGRAM and _has_table(conn, "profiles_fts"):
+            long_terms.append(t)
+        elif use_index and _GRAM_TERM_RE.fullmatch(t) and _has_table(conn, "profiles_grams"):
+            gram_terms.append(t.lower())
+        else:
+            like_terms.append(t)
+    use_fts = bool(long_terms)
+
+    where, params = [], []
+    if username is not None:
+        where.append("p.username = ?")
+        params.append(username)
+    if gram_terms:
+        where.append("p.id IN (SELECT rowid FROM profiles_grams WHERE profiles_grams MATCH ?)")
+        params.append(" AND ".join(_fts_phrase(t) for t in gram_terms))
+    for t in like_terms:
+        where.append("(p.profile_name LIKE ? ESCAPE '\\' OR p.content_text LIKE ? ESCAPE '\\')")
+        params += [_like_pattern(t)] * 2
+
+    if use_fts:
+        match = "{profile_name content_text} : (" + " AND ".join(_fts_phrase(t) for t in long_terms) + ")"
+        sql_from = ("FROM profiles_fts JOIN profiles p ON p.id = profiles_fts.rowid WHERE profiles_fts MATCH ?"
+                    + "".join(" AND " + w for w in where))
+        params = [match] + params
+        order, order_params = "rank", []
+    else:
+        sql_from = "FROM profiles p" + (" WHERE " + " AND ".join(where) if where else "")
+        # 逐行匹配时的排序：档案名命中数 > 正文出现次数 > 时间
+        order, order_params = "p.created_at DESC", []
+        if terms:
+            name_hits = " + ".join("(p.profile_name LIKE ? ESCAPE '\\')" for _ in terms)
+            text_hits = " + ".join("(LENGTH(p.content_text) - LENGTH(REPLACE(p.content_text, ?, ''))) / LENGTH(?)"
+                                   for _ in terms)
+            order = f"({name_hits}) DESC, ({text_hits}) DESC, " + order
+            order_params = [_like_pattern(t) for t in terms] + [x for t in terms for x in (t, t)]
+
+    total = conn.execute("SELECT COUNT(*) " + sql_from, params).fetchone()[0]
+    rows = conn.execute(f"SELECT p.username, p.profile_name, p.created_at, p.content_text {sql_from} "
+                        f"ORDER BY {order} LIMIT ? OFFSET ?", params + order_params + [page_size, offset]).fetchall()
+    conn.close()
+
+    # 摘要在 Python 里按原词截取并高亮 (trigram 的 snippet() 按三字切分，高亮常常截断半个词)
+    results = [{"username": user, "profile_name": name, "created_at": created_at, "snippet": _make_snippet(content, terms)}
+               for user, name, created_at, content in rows]
+    return results, total
+
+
 # --- 日志与反馈 ---
+# 日志先进内存队列，由后台线程批量写库 (攒够条数或到时间就写，进程退出时写完剩余)，
+# 用户请求里不再包含一次 SQLite 提交。超过保留天数的明细按天汇总进 logs_daily。
+LOG_FLUSH_SIZE = int(get_config("LOG_FLUSH_SIZE", 100))
+LOG_FLUSH_INTERVAL = float(get_config("LOG_FLUSH_INTERVAL", 2.0))
+LOG_RETENTION_DAYS = int(get_config("LOG_RETENTION_DAYS", 30))
+LOG_ROLLUP_INTERVAL = 3600
+
+_log_queue = queue.Queue()
+_log_thread = None
+_log_thread_lock = threading.Lock()
+
+
 def log_action(username, action):
-    conn = sqlite3.connect(DB_FILE)
+    _ensure_log_writer()
+    _log_queue.put((username, action, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+
+
+def _write_logs(batch):
+    conn = sqlite3.connect(DB_FILE, timeout=30)
+    conn.executemany("INSERT INTO logs (username, action, timestamp) VALUES (?, ?, ?)", batch)
+    conn.commit()
+    conn.close()
+
+
+class _FlushRequest:
+    """
+    flush_logs() 放进队列的同步请求：写完后置位 done，写入失败时 error 带上异常
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+
+def _log_writer_loop():
+    batch = []
+    last_flush = time.monotonic()
+    last_rollup = 0.0
+    while True:
+        waiters = []
+        try:
+            item = _log_queue.get(timeout=LOG_FLUSH_INTERVAL)
+        except queue.Empty:
+            item = None
+        if isinstance(item, _FlushRequest):
+            # flush_logs() 的同步请求：把目前为止收到的日志全部写入后再通知
+            waiters.append(item)
+            while True:
+                try:
+                    item = _log_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(item, _FlushRequest):
+                    waiters.append(item)
+                else:
+                    batch.append(item)
+        elif item is not None:
+            batch.append(item)
+
+        now = time.monotonic()
+        error = None
+        if batch and (waiters or len(batch) >= LOG_FLUSH_SIZE or now - last_flush >= LOG_FLUSH_INTERVAL):
+            try:
+                _write_logs(batch)
+                batch = []
+            except sqlite3.Error as e:
+                error = e  # 数据库暂时被锁：日志留在 batch 里下一轮重试，但本次 flush 的调用方要知道没写成
+            last_flush = now
+        for w in waiters:
+            w.error = error
+            w.done.set()
+        if now - last_rollup >= LOG_ROLLUP_INTERVAL:
+            last_rollup = now
+            try:
+                rollup_logs()
+            except sqlite3.Error:
+                pass
+
+
+def _ensure_log_writer():
+    global _log_thread
+    if _log_thread is not None and _log_thread.is_alive(): return
+    with _log_thread_lock:
+        if _log_thread is not None and _log_thread.is_alive(): return
+        _log_thread = threading.Thread(target=_log_writer_loop, name="log-writer", daemon=True)
+        _log_thread.start()
+
+
+def flush_logs(timeout=5.0):
+    """
+    阻塞直到队列中已有的日志全部落库 (进程退出、测试或需要立即可见时使用)。
+    写入失败时抛出 sqlite3.Error，超时抛出 TimeoutError (日志仍在队列中，后台会继续重试)
+    """
+    if _log_thread is None or not _log_thread.is_alive(): return
+    req = _FlushRequest()
+    _log_queue.put(req)
+    if not req.done.wait(timeout):
+        raise TimeoutError("日志写入超时")
+    if req.error is not None:
+        raise req.error
+
+
+def _flush_logs_at_exit():
+    try:
+        flush_logs()
+    except (sqlite3.Error, TimeoutError) as e:
+        print(f"[auth] 退出时日志未能全部写入: {e}", file=sys.stderr)
+
+
+atexit.register(_flush_logs_at_exit)
+
+
+def rollup_logs(retention_days=None):
+    """
+    把 retention_days 天之前的日志明细按 (日期, 用户, 动作) 汇总进 logs_daily 并删除明细
+    """
+    days = LOG_RETENTION_DAYS if retention_days is None else retention_days
+    cutoff = (datetime.datetime.now() - datetime.timedelta(days=days)).strftime("%Y-%m-%d 00:00:00")
+    conn = sqlite3.connect(DB_FILE, timeout=30)
     c = conn.cursor()
-    c.execute("INSERT INTO logs (username, action, timestamp) VALUES (?, ?, ?)",
-              (username, action, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+    c.execute("""INSERT INTO logs_daily (day, username, action, count)
+                 SELECT substr(timestamp, 1, 10), username, action, COUNT(*) FROM logs WHERE timestamp < ?
+                 GROUP BY substr(timestamp, 1, 10), username, action
+                 ON CONFLICT(day, username, action) DO UPDATE SET count = count + excluded.count""", (cutoff,))
+    c.execute("DELETE FROM logs WHERE timestamp < ?", (cutoff,))
+    removed = c.rowcount
     conn.commit()
     conn.close()
+    return removed
+
+
+def count_logs():
+    """
+    累计事件数 = 明细 + 已汇总
+    """
+    conn = sqlite3.connect(DB_FILE)
+    c = conn.cursor()
+    total = c.execute("SELECT (SELECT COUNT(*) FROM logs) + (SELECT COALESCE(SUM(count), 0) FROM logs_daily)").fetchone()[0]
+    conn.close()
+    return total
 
 
 def submit_feedback(username, content, rating):
@@ -154,6 +596,7 @@ def submit_feedback(username, content, rating):
 
 
 def get_admin_data():
+    import pandas as pd
     conn = sqlite3.connect(DB_FILE)
     users = pd.read_sql("SELECT username, role, created_at FROM users", conn)
     logs = pd.read_sql("SELECT * FROM logs ORDER BY timestamp DESC LIMIT 50", conn)
@@ -0,0 +1,522 @@
+"""
+性能基准脚本 (开发用，不参与线上运行)
+
+用法:
+    python benchmark.py coldstart --baseline-ref <提交>  # 冷启动导入耗时 + init_db 每次重跑的开销 (与旧版本对比)
+    python benchmark.py writer --media-mb 15  # 补丁式保存 vs python-docx 完整保存
+    python benchmark.py prepared --rows 60    # 步骤 3 写入：现场打开模板 vs 使用步骤 1 预处理好的状态
+    python benchmark.py read --pages 100      # lxml 流式读取 vs python-docx 读取 DOCX
+    python benchmark.py pdf --pages 60        # PDF 表格预判 vs 每页都 extract_tables
+    python benchmark.py pdfbudget --pages 200 # PDF 全文读取 vs 按字数预算提前停止
+    python benchmark.py plansplit             # 方案生成：单次请求 vs 按分区并发 (模拟大模型，耗时与输出长度成正比)
+    python benchmark.py slots --rows 200      # 写入：按格子编号直接定位 vs 按 anchor 模糊定位
+    python benchmark.py retrieval --pages 60  # 长源数据：截取开头 vs 按模板标签检索段落
+    python benchmark.py sources --files 3 --workers 3  # 多个源文件：逐个读取 vs 线程并发 vs 进程池 (SOURCE_PROCESS_WORKERS)
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _timeit(fn, rounds):
+    best = float("inf")
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def _import_time(code, cwd=HERE):
+    # 每次都在新进程里导入，才能测到真正的冷启动
+    t0 = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], cwd=cwd, check=True)
+    return time.perf_counter() - t0
+
+
+def _random_png(path, size_mb):
+    # 随机像素的 PNG，几乎不可压缩，模拟模板里的照片/签名/Logo
+    import struct
+    import zlib
+    width = 1024
+    height = max(1, int(size_mb * 1024 * 1024 / (width * 3)))
+    raw = b"".join(b"\x00" + os.urandom(width * 3) for _ in range(height))
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(raw, 1)))
+        f.write(chunk(b"IEND", b""))
+
+
+def _make_template(path, media_mb=0, rows=20):
+    """
+    生成测试模板：基础信息表 + 列表表格 (+ 可选的大图片)
+    """
+    from docx import Document
+    doc = Document()
+    doc.add_paragraph("奖学金申请审批表")
+    if media_mb:
+        png = path + ".png"
+        _random_png(png, media_mb)
+        doc.add_picture(png)
+        os.remove(png)
+    t = doc.add_table(rows=rows, cols=4)
+    for r in range(rows):
+        t.cell(r, 0).text = f"字段{r}"
+        t.cell(r, 2).text = f"项目{r}"
+    t.cell(rows - 1, 0).text = "自我鉴定（此栏填写）"
+    t2 = doc.add_table(rows=3, cols=3)
+    t2.cell(0, 0).text = "获奖情况"
+    for c, h in enumerate(["时间", "奖项", "等级"]):
+        t2.cell(1, c).text = h
+    doc.save(path)
+
+
+def _sample_plan(rows=20):
+    return {
+        "kv": [{"anchor": f"字段{r}", "val": f"值{r}"} for r in range(rows - 1)] +
+              [{"anchor": "自我鉴定", "val": "本人在校期间学习刻苦，积极参加各类活动。" * 5}],
+        "checkbox": [],
+        "lists": [{"keyword": "获奖情况", "headers": ["时间", "奖项", "等级"],
+                   "data": [[f"2023.{m:02d}", f"奖项{m}", "校级"] for m in range(1, 10)]}],
+    }
+
+
+# ================= coldstart =================
+_COLDSTART_MODULES = ("auth.py", "logic.py", "blobstore.py", "styles.py")
+_INIT_DB_CODE = (
+    "import os, sys, time, tempfile, auth\n"
+    "auth.DB_FILE = os.path.join(tempfile.mkdtemp(), 'bench.db')\n"
+    "auth.init_db()\n"
+    "n = int(sys.argv[1]); t0 = time.perf_counter()\n"
+    "for _ in range(n): auth.init_db()\n"
+    "print((time.perf_counter() - t0) / n)"
+)
+
+
+def _export_ref(ref, dest):
+    """
+    把 ref 版本的模块导出到 dest，用于和当前代码对比 (只导出该版本中存在的文件)
+    """
+    for name in _COLDSTART_MODULES:
+        out = subprocess.run(["git", "show", f"{ref}:{name}"], cwd=HERE, capture_output=True)
+        if out.returncode == 0:
+            with open(os.path.join(dest, name), "wb") as f:
+                f.write(out.stdout)
+
+
+def _coldstart_numbers(code_dir, rounds):
+    # 登录页需要的模块导入 + 每次 Streamlit 重跑都会执行的 init_db，均在新进程里测
+    present = [n[:-3] for n in _COLDSTART_MODULES if os.path.exists(os.path.join(code_dir, n))]
+    t_import = min(_import_time("import streamlit; import " + ", ".join(present), cwd=code_dir) for _ in range(rounds))
+    out = subprocess.run([sys.executable, "-c", _INIT_DB_CODE, str(rounds * 100)], cwd=code_dir, check=True,
+                         capture_output=True, text=True)
+    return t_import, float(out.stdout.split()[-1])
+
+
+def bench_coldstart(args):
+    rows = [("当前代码", HERE)]
+    with tempfile.TemporaryDirectory() as d:
+        if args.baseline_ref:
+            _export_ref(args.baseline_ref, d)
+            rows.insert(0, (f"基线 {args.baseline_ref}", d))
+        for label, code_dir in rows:
+            t_import, t_init = _coldstart_numbers(code_dir, args.rounds)
+            print(f"[coldstart] {label:16s} 登录页模块导入 {t_import * 1000:8.1f} ms   init_db 每次重跑 {t_init * 1000:8.4f} ms")
+    if not args.baseline_ref:
+        print("[coldstart] 用 --baseline-ref <提交> 与改动前的代码对比")
+
+
+# ================= writer =================
+def bench_writer(args):
+    sys.path.insert(0, HERE)
+    import logic
+    plan = _sample_plan()
+    with tempfile.TemporaryDirectory() as d:
+        tpl = os.path.join(d, "template.docx")
+        _make_template(tpl, media_mb=args.media_mb)
+        print(f"[writer] 模板大小 {os.path.getsize(tpl) / 1024 / 1024:.2f} MB (图片约 {args.media_mb} MB)")
+        for mode in ("docx", "patch"):
+            out = os.path.join(d, f"out_{mode}.docx")
+            t = _timeit(lambda: logic.execute_word_writing_v2(plan, tpl, out, mode=mode), args.rounds)
+            print(f"[writer] {mode:5s}  渲染 {t * 1000:8.1f} ms   输出 {os.path.getsize(out) / 1024 / 1024:.2f} MB")
+
+
+def bench_prepared(args):
+    sys.path.insert(0, HERE)
+    import logic
+    plan = _sample_plan(args.rows)
+    with tempfile.TemporaryDirectory() as d:
+        tpl = os.path.join(d, "template.docx")
+        _make_template(tpl, media_mb=args.media_mb, rows=args.rows)
+        out = os.path.join(d, "out.docx")
+        print(f"[prepared] {args.rows} 行模板, 方案 {len(plan['kv'])} 个 KV")
+        t_full = _timeit(lambda: logic.execute_word_writing_v2(plan, tpl, out), args.rounds)
+        t_prep = _timeit(lambda: logic.prepare_template(tpl), args.rounds)
+        times = []
+        for _ in range(args.rounds):
+            prepared = logic.prepare_template(tpl)  # 一次性状态，每轮重新准备 (不计时)
+            t0 = time.perf_counter()
+            logic.execute_word_writing_v2(plan, tpl, out, prepared=prepared)
+            times.append(time.perf_counter() - t0)
+        print(f"[prepared] 现场打开模板并写入        {t_full * 1000:8.1f} ms")
+        print(f"[prepared] 预处理 (与大模型请求并行)  {t_prep * 1000:8.1f} ms")
+        print(f"[prepared] 使用预处理状态写入        {min(times) * 1000:8.1f} ms")
+
+
+def bench_slots(args):
+    sys.path.insert(0, HERE)
+    import logic
+    from docx import Document
+    fuzzy = _sample_plan(args.rows)
+    # 与 _make_template 的布局对应：字段在第 0 列，右侧空白格 T0R{r}C1；列表表头在第二个表格第 1 行
+    by_id = {"kv": [dict(item, id=f"T0R{r}C1") for r, item in enumerate(fuzzy["kv"][:-1])] +
+                   [dict(fuzzy["kv"][-1], id=f"T0R{args.rows - 1}C0")],
+             "checkbox": [], "lists": [dict(item, id="T1R1") for item in fuzzy["lists"]]}
+    with tempfile.TemporaryDirectory() as d:
+        tpl = os.path.join(d, "template.docx")
+        _make_template(tpl, rows=args.rows)
+        print(f"[slots] {args.rows} 行模板, 方案 {len(fuzzy['kv'])} 个 KV")
+        outputs = {}
+        for label, plan in (("按 anchor 模糊定位", fuzzy), ("按格子编号定位", by_id)):
+            out = os.path.join(d, f"{len(outputs)}.docx")
+            times = []
+            for _ in range(args.rounds):
+                prepared = logic.prepare_template(tpl)
+                t0 = time.perf_counter()
+                logic.execute_word_writing_v2(plan, tpl, out, prepared=prepared)
+                times.append(time.perf_counter() - t0)
+            outputs[label] = [[c.text for c in row.cells] for t in Document(out).tables for row in t.rows]
+            print(f"[slots] {label:12s} {min(times) * 1000:8.1f} ms")
+        fuzzy_rows, id_rows = outputs.values()
+        # 模糊匹配会把相近标签写错位置 (如“字段1”的值写进“字段10”右侧)
+        print(f"[slots] 两种方式结果不同的行: {sum(a != b for a, b in zip(fuzzy_rows, id_rows))}")
+
+
+def bench_retrieval(args):
+    sys.path.insert(0, HERE)
+    import random
+    import logic
+    import retrieval
+    rnd = random.Random(0)
+    filler = "课程内容涵盖理论讲授与实验实践学生需要完成课堂作业期末考试以及课程设计报告成绩按百分制记录"
+    facts = {args.pages * 2 // 3: "获奖情况：2023.09 全国大学生数学建模竞赛 一等奖 国家级",
+             args.pages // 2: "政治面貌：中共党员  籍贯：浙江杭州"}
+    pages = []
+    for i in range(args.pages):
+        lines = ["".join(rnd.sample(filler, 30)) for _ in range(30)]
+        if i in facts: lines.insert(rnd.randrange(len(lines)), facts[i])
+        pages.append(f"[PDF_第{i + 1}页] 姓名 张三 学号 20201101\n" + "\n".join(lines))
+    source = "\n".join(pages)
+    structure = "【表格区_0】\n姓名 | #T0R0C1 | 学号 | #T0R0C3\n政治面貌 | #T0R1C1 | 籍贯 | #T0R1C3\n" \
+                "获奖情况\n时间 | 奖项 | 等级\n〔列表区 #T0R3：上一行为表头，下有 3 行空白〕"
+    print(f"[retrieval] 源数据 {len(source)} 字 ({args.pages} 页), 预算 {logic.RETRIEVAL_CHAR_BUDGET} 字")
+    head = source[:logic.SOURCE_CHAR_BUDGET]
+    print(f"[retrieval] 截取开头 {len(head):6d} 字  包含埋藏信息 {sum(f in head for f in facts.values())}/{len(facts)}")
+    t0 = time.perf_counter()
+    retrieval.build_index(source)
+    t_build = time.perf_counter() - t0
+    logic.select_source_passages(source, structure)  # 建索引并放入缓存
+    t_query = _timeit(lambda: logic.select_source_passages(source, structure), args.rounds)
+    packed = logic.select_source_passages(source, structure)
+    print(f"[retrieval] 检索拼装 {len(packed):6d} 字  包含埋藏信息 {sum(f in packed for f in facts.values())}/{len(facts)}")
+    print(f"[retrieval] 建索引 {t_build * 1000:.1f} ms, 命中缓存后每次检索 {t_query * 1000:.1f} ms")
+
+
+# ================= read =================
+def _make_long_docx(path, pages):
+    # 每页约 1 个 12 行表格 (含合并单元格) + 15 段正文
+    from docx import Document
+    doc = Document()
+    for p in range(pages):
+        doc.add_paragraph(f"第 {p + 1} 页")
+        t = doc.add_table(rows=12, cols=6)
+        t.cell(0, 0).merge(t.cell(0, 2)).text = f"表格 {p}"
+        t.cell(1, 0).merge(t.cell(11, 0)).text = "侧栏"
+        for r in range(1, 12):
+            for c in range(1, 6):
+                t.cell(r, c).text = f"{p}-{r}-{c}"
+        for i in range(15):
+            doc.add_paragraph(f"第 {p + 1} 页第 {i + 1} 段：本人在校期间积极参加科研项目与社会实践活动。")
+    doc.save(path)
+
+
+def bench_read(args):
+    with tempfile.TemporaryDirectory() as d:
+        src = os.path.join(d, "long.docx")
+        sys.path.insert(0, HERE)
+        _make_long_docx(src, args.pages)
+        print(f"[read] {args.pages} 页 DOCX, {os.path.getsize(src) / 1024:.0f} KB")
+        for name in ("_read_docx_legacy", "_read_docx"):
+            # 每个实现单独起进程，分别统计耗时和峰值常驻内存
+            code = (
+                "import resource, time, logic\n"
+                f"best = min((lambda t0: (logic.{name}({src!r}), time.perf_counter() - t0)[1])(time.perf_counter())"
+                f" for _ in range({args.rounds}))\n"
+                f"n = len(logic.{name}({src!r}))\n"
+                "print(best, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, n)"
+            )
+            out = subprocess.run([sys.executable, "-c", code], cwd=HERE, check=True, capture_output=True, text=True)
+            t, rss, n = out.stdout.split()
+            print(f"[read] {name:18s} {float(t) * 1000:8.1f} ms   峰值 RSS {int(rss) / 1024:6.1f} MB   输出 {n} 字")
+
+
+# ================= pdf =================
+def _make_pdf(path, pages, table_every=10):
+    """
+    手写一个最小 PDF：每页 45 行正文 + 版式线；每 table_every 页带一个 6x4 的框线表格
+    """
+    objects = []
+
+    def add(body):
+        objects.append(body)
+        return len(objects)
+
+    font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    page_ids = []
+    pages_id = len(objects) + 2 * pages + 1
+    for p in range(pages):
+        ops = ["BT /F1 10 Tf 14 TL 50 800 Td"]
+        for line in range(45):
+            ops.append(f"(Page {p + 1} line {line + 1}: research projects, internships and awards summary.) '")
+        ops.append("ET")
+        # 简历常见的版式线：左侧竖向装饰条 + 每个小节下方的分隔横线
+        ops.append("1 w 40 20 m 40 820 l S")
+        for y in range(780, 60, -84):
+            ops.append(f"50 {y} m 545 {y} l S")
+        if table_every and p % table_every == 0:
+            ops.append("BT /F1 10 Tf ET 0.5 w")
+            for r in range(7):
+                ops.append(f"60 {150 - r * 18} m 460 {150 - r * 18} l S")
+            for c in range(5):
+                ops.append(f"{60 + c * 100} 150 m {60 + c * 100} 42 l S")
+            for r in range(6):
+                for c in range(4):
+                    ops.append(f"BT /F1 9 Tf {65 + c * 100} {137 - r * 18} Td (R{r}C{c}) Tj ET")
+        stream = "\n".join(ops).encode("latin-1")
+        content = add(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        page_ids.append(add(b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 595 842] /Contents %d 0 R "
+                            b"/Resources << /Font << /F1 %d 0 R >> >> >>" % (pages_id, content, font)))
+    kids = b" ".join(b"%d 0 R" % i for i in page_ids)
+    assert add(b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, pages)) == pages_id
+    catalog = add(b"<< /Type /Catalog /Pages %d 0 R >>" % pages_id)
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % i + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for off in offsets:
+        out += b"%010d 00000 n \n" % off
+    out += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, catalog, xref)
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def bench_pdf(args):
+    sys.path.insert(0, HERE)
+    import logic
+    with tempfile.TemporaryDirectory() as d:
+        src = os.path.join(d, "long.pdf")
+        _make_pdf(src, args.pages)
+        print(f"[pdf] {args.pages} 页 PDF (每 10 页一个框线表格)")
+
+        precheck = logic._page_may_have_table
+        for strategy in ("lines", "text"):
+            for label, check in (("每页都提取", lambda page, st: True), ("先预判再提取", precheck)):
+                logic._page_may_have_table = check
+                t = _timeit(lambda: logic._read_pdf(src, strategy), args.rounds)
+                n = logic._read_pdf(src, strategy).count("[PDF_表格_")
+                print(f"[pdf] {strategy:5s} {label:8s} {t * 1000:8.1f} ms   表格 {n}")
+        logic._page_may_have_table = precheck
+        t = _timeit(lambda: logic._read_pdf(src, "off"), args.rounds)
+        print(f"[pdf] off   只取文本     {t * 1000:8.1f} ms   表格 0")
+
+
+def bench_pdf_budget(args):
+    with tempfile.TemporaryDirectory() as d:
+        src = os.path.join(d, "long.pdf")
+        _make_pdf(src, args.pages)
+        print(f"[pdfbudget] {args.pages} 页 PDF, 预算 {args.budget} 字")
+        variants = (
+            ("全文读取", "{}"),
+            ("按预算停止", f"{{'char_budget': {args.budget}}}"),
+        )
+        for label, kwargs in variants:
+            # 每种方式单独起进程，分别统计耗时和峰值常驻内存
+            code = (
+                "import resource, time, logic\n"
+                f"t0 = time.perf_counter(); txt = logic._read_pdf({src!r}, **{kwargs}); t = time.perf_counter() - t0\n"
+                "print(t, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, len(txt))"
+            )
+            out = subprocess.run([sys.executable, "-c", code], cwd=HERE, check=True, capture_output=True, text=True)
+            t, rss, n = out.stdout.split()
+            print(f"[pdfbudget] {label:10s} {float(t) * 1000:9.1f} ms   峰值 RSS {int(rss) / 1024:6.1f} MB   输出 {n} 字")
+
+
+# ================= plansplit =================
+class _SimulatedLLM:
+    """
+    模拟大模型：首 token 延迟 + 按输出字数计时，输出取自示例方案的对应分区
+    """
+
+    def __init__(self, plan, first_token_s, ms_per_char):
+        import types
+        self.plan, self.first_token_s, self.ms_per_char = plan, first_token_s, ms_per_char
+        self.api_key, self.base_url = "bench", "simulated"
+        self.prompt_chars = 0
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+
+    def create(self, messages, **kwargs):
+        import json
+        import re
+        import types
+        m = re.search(r"只负责填写方案中的 (\w+) 部分", messages[0]["content"])
+        sections = [m.group(1)] if m else ["kv", "checkbox", "lists"]
+        self.prompt_chars += len(messages[0]["content"])
+        content = json.dumps({sec: self.plan[sec] for sec in sections}, ensure_ascii=False)
+        time.sleep(self.first_token_s + len(content) * self.ms_per_char / 1000)
+        message = types.SimpleNamespace(content=content)
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=None)
+
+
+def bench_sources(args):
+    sys.path.insert(0, HERE)
+    import logic
+    with tempfile.TemporaryDirectory() as d:
+        sources = []
+        for i in range(args.files):
+            path = os.path.join(d, f"source_{i}.pdf")
+            _make_pdf(path, args.pages)
+            sources.append((f"材料{i + 1}.pdf", path))
+        print(f"[sources] {args.files} 个 {args.pages} 页 PDF (内容相同，用于观察去重)，CPU {os.cpu_count()} 核，"
+              f"进程池 {args.workers} 个进程")
+
+        t0 = time.perf_counter()
+        texts = [logic.read_file_content(path) for _, path in sources]
+        t_seq = time.perf_counter() - t0
+        print(f"[sources] 逐个读取         {t_seq * 1000:8.1f} ms   合计 {sum(map(len, texts))} 字")
+
+        t0 = time.perf_counter()
+        logic.read_file_content(sources[0][1])
+        print(f"[sources] 单个最大文件     {(time.perf_counter() - t0) * 1000:8.1f} ms")
+
+        runs = [("线程并发", 0)]
+        if args.workers > 0:
+            runs += [("进程池 (冷启动)", args.workers), ("进程池 (已预热)", args.workers)]
+        for label, workers in runs:
+            logic.SOURCE_PROCESS_WORKERS = workers
+            before = logic.get_metrics()
+            t0 = time.perf_counter()
+            merged = logic.read_sources(sources)
+            t = time.perf_counter() - t0
+            after = logic.get_metrics()
+            deduped = after.get("source_lines_deduped", 0) - before.get("source_lines_deduped", 0)
+            pages = after.get("pdf_pages_read", 0) - before.get("pdf_pages_read", 0)
+            print(f"[sources] {label:14s} {t * 1000:8.1f} ms   合并后 {len(merged)} 字，去重 {deduped} 行，"
+                  f"读取 {pages} 页")
+        logic._reset_source_pool(wait=True)
+
+
+def bench_plan_split(args):
+    sys.path.insert(0, HERE)
+    import logic
+    plan = _sample_plan(args.rows)
+    plan["checkbox"] = [{"keyword": f"选项{i}", "status": "有" if i % 2 else "无"} for i in range(args.checkboxes)]
+    client = _SimulatedLLM(plan, args.first_token, args.ms_per_char)
+    with tempfile.TemporaryDirectory() as d:
+        tpl = os.path.join(d, "template.docx")
+        _make_template(tpl, rows=args.rows)
+        structure = logic.read_file_content(tpl) + "\n\n【表格区_9】\n" + " | ".join(
+            f"□ 选项{i}" for i in range(args.checkboxes))
+        source = "姓名 张三 学号 20201101\n\n" + "\n\n".join(
+            f"项目经历{i}：参与字段{i % args.rows}相关的课题研究，负责数据整理与分析，获奖情况良好。" * 3
+            for i in range(args.source_chars // 100))
+        print(f"[plansplit] KV {len(plan['kv'])} 项, 勾选 {len(plan['checkbox'])} 项, "
+              f"列表 {sum(len(x['data']) for x in plan['lists'])} 行")
+        for mode in ("single", "split"):
+            client.prompt_chars = 0
+            t0 = time.perf_counter()
+            logic.generate_filling_plan_v2(client, source, structure, mode=mode)
+            print(f"[plansplit] {mode:6s} {(time.perf_counter() - t0) * 1000:8.1f} ms   Prompt 合计 {client.prompt_chars} 字")
+        m = logic.get_metrics()
+        print("[plansplit] 分区耗时 " + "  ".join(
+            f"{sec} {m.get(f'plan_section_{sec}_ms', 0)} ms" for sec in logic.PLAN_SECTIONS))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WordToWord 性能基准")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("coldstart", help="冷启动与每次重跑的固定开销")
+    p.add_argument("--rounds", type=int, default=3)
+    p.add_argument("--baseline-ref", default="", help="对比用的旧版本 (git 提交/分支)，不填只测当前代码")
+    p.set_defaults(func=bench_coldstart)
+
+    p = sub.add_parser("writer", help="补丁式保存 vs python-docx 完整保存")
+    p.add_argument("--media-mb", type=float, default=15)
+    p.add_argument("--rounds", type=int, default=3)
+    p.set_defaults(func=bench_writer)
+
+    p = sub.add_parser("prepared", help="步骤 3 写入：现场打开模板 vs 使用预处理状态")
+    p.add_argument("--rows", type=int, default=60)
+    p.add_argument("--media-mb", type=float, default=5)
+    p.add_argument("--rounds", type=int, default=3)
+    p.set_defaults(func=bench_prepared)
+
+    p = sub.add_parser("slots", help="写入：按格子编号直接定位 vs 按 anchor 模糊定位")
+    p.add_argument("--rows", type=int, default=200)
+    p.add_argument("--rounds", type=int, default=3)
+    p.set_defaults(func=bench_slots)
+
+    p = sub.add_parser("retrieval", help="长源数据：截取开头 vs 按模板标签检索段落")
+    p.add_argument("--pages", type=int, default=60)
+    p.add_argument("--rounds", type=int, default=5)
+    p.set_defaults(func=bench_retrieval)
+
+    p = sub.add_parser("sources", help="多个源文件：逐个读取 vs 并发读取")
+    p.add_argument("--files", type=int, default=3)
+    p.add_argument("--pages", type=int, default=40)
+    p.add_argument("--workers", type=int, default=max((os.cpu_count() or 1) - 1, 1), help="进程池大小，0 时只测线程")
+    p.set_defaults(func=bench_sources)
+
+    p = sub.add_parser("read", help="lxml 流式读取 vs python-docx 读取 DOCX")
+    p.add_argument("--pages", type=int, default=100)
+    p.add_argument("--rounds", type=int, default=3)
+    p.set_defaults(func=bench_read)
+
+    p = sub.add_parser("pdf", help="PDF 表格预判 vs 每页都 extract_tables")
+    p.add_argument("--pages", type=int, default=60)
+    p.add_argument("--rounds", type=int, default=2)
+    p.set_defaults(func=bench_pdf)
+
+    p = sub.add_parser("pdfbudget", help="PDF 全文读取 vs 按字数预算提前停止")
+    p.add_argument("--pages", type=int, default=200)
+    p.add_argument("--budget", type=int, default=12000)
+    p.set_defaults(func=bench_pdf_budget)
+
+    p = sub.add_parser("plansplit", help="方案生成：单次请求 vs 按分区并发")
+    p.add_argument("--rows", type=int, default=40)
+    p.add_argument("--checkboxes", type=int, default=20)
+    p.add_argument("--source-chars", type=int, default=20000, help="源数据字数")
+    p.add_argument("--first-token", type=float, default=0.5, help="首 token 延迟 (秒)")
+    p.add_argument("--ms-per-char", type=float, default=1.0, help="每输出一个字符的耗时 (毫秒)")
+    p.set_defaults(func=bench_plan_split)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
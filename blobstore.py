@@ -0,0 +1,341 @@
+import abc
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# ================= 内容寻址 Blob 存储 =================
+# 会话里只保存很短的句柄 (sha256 + 扩展名)，真正的数据落在磁盘上：
+#   - 相同内容只存一份 (例如多人上传同一个模板)
+#   - 引用计数 + TTL + 容量上限的 LRU 淘汰，temp/ 目录不再无限增长
+# 索引放在 SQLite 里，多个进程共享同一目录时也能保持一致。
+# 数据本身的存取 (写入/读取/删除) 经由 BlobBackend：默认存在本地目录 BLOB_DIR；
+# 接入对象存储等其他存储时，实现 BlobBackend 并用 register_backend 注册，再通过环境变量 BLOB_BACKEND 选择。
+
+BLOB_BACKEND = os.getenv("BLOB_BACKEND", "local")
+BLOB_DIR = os.getenv("BLOB_DIR", os.path.join("temp", "blobs"))
+BLOB_INDEX_FILE = os.getenv("BLOB_INDEX_FILE", "")  # 引用计数索引，默认 BLOB_DIR/index.db
+BLOB_TTL_SECONDS = int(os.getenv("BLOB_TTL_SECONDS", str(6 * 3600)))
+BLOB_MAX_BYTES = int(os.getenv("BLOB_MAX_BYTES", str(512 * 1024 * 1024)))
+
+_HANDLE_RE = re.compile(r"^[0-9a-f]{64}(\.[A-Za-z0-9]{1,8})?$")
+_TOUCH_INTERVAL = 60  # 访问时间的最小更新间隔，避免每次读取都写库
+_EVICT_INTERVAL = 60
+
+_init_lock = threading.Lock()
+_initialized_index = None
+_last_evict = 0.0
+_touched = {}  # 句柄 -> 本进程上次更新访问时间的时刻
+
+
+def _connect():
+    global _initialized_index
+    index_file = BLOB_INDEX_FILE or os.path.join(BLOB_DIR, "index.db")
+    os.makedirs(os.path.dirname(index_file) or ".", exist_ok=True)
+    conn = sqlite3.connect(index_file, timeout=30)
+    if _initialized_index != index_file:
+        with _init_lock:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                '''CREATE TABLE IF NOT EXISTS blobs (handle TEXT PRIMARY KEY, size INTEGER, refcount INTEGER, created_at REAL, last_access REAL)''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_blobs_access ON blobs(last_access)")
+            conn.commit()
+            _initialized_index = index_file
+    return conn
+
+
+def _check(handle):
+    if not handle or not _HANDLE_RE.match(handle):
+        raise ValueError(f"非法的 blob 句柄: {handle}")
+    return handle
+
+
+def _path(handle):
+    return os.path.join(BLOB_DIR, _check(handle)[:2], handle)
+
+
+# ================= 存储后端 =================
+class BlobBackend(abc.ABC):
+    """
+    后端接口：按句柄存取 blob 内容。句柄就是内容哈希，同一句柄的内容不会改变，后端无需处理覆盖
+    """
+
+    @abc.abstractmethod
+    def put_bytes(self, handle, data):
+        """保存内容 (已存在时可直接返回)"""
+
+    @abc.abstractmethod
+    def get(self, handle):
+        """返回内容，不存在时返回 None"""
+
+    @abc.abstractmethod
+    def local_path(self, handle):
+        """返回本机可读的文件路径 (远端存储先下载到本地缓存)，不存在时返回 None"""
+
+    @abc.abstractmethod
+    def delete(self, handle):
+        """删除，不存在时不报错"""
+
+    def put_file(self, handle, src_path, move=False):
+        with open(src_path, "rb") as f:
+            self.put_bytes(handle, f.read())
+        if move: os.remove(src_path)
+
+    def touch(self, handle):
+        """被访问时调用，需要自行记录访问时间的后端可覆盖"""
+
+
+class LocalBlobBackend(BlobBackend):
+    """
+    本地目录 BLOB_DIR (多副本时放在共享卷上)，按句柄前两位分子目录
+    """
+
+    def put_bytes(self, handle, data):
+        path = _path(handle)
+        if os.path.exists(path): return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def put_file(self, handle, src_path, move=False):
+        path = _path(handle)
+        if os.path.exists(path):
+            if move: os.remove(src_path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if move:
+            os.replace(src_path, path)
+            return
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(src_path, "rb") as fin, open(tmp, "wb") as fout:
+            for chunk in iter(lambda: fin.read(1024 * 1024), b""):
+                fout.write(chunk)
+        os.replace(tmp, path)
+
+    def get(self, handle):
+        try:
+            with open(_path(handle), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def local_path(self, handle):
+        path = _path(handle)
+        return path if os.path.exists(path) else None
+
+    def delete(self, handle):
+        try:
+            os.remove(_path(handle))
+        except OSError:
+            pass
+
+    def touch(self, handle):
+        now = time.time()
+        try:
+            os.utime(_path(handle), (now, now))
+        except OSError:
+            pass
+
+
+_BACKENDS = {"local": LocalBlobBackend}
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def register_backend(name, factory):
+    _BACKENDS[name] = factory
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if BLOB_BACKEND not in _BACKENDS:
+                    raise ValueError(f"未知的 blob 存储后端: {BLOB_BACKEND}")
+                _backend = _BACKENDS[BLOB_BACKEND]()
+    return _backend
+
+
+def _normalize_ext(ext):
+    ext = (ext or "").lower()
+    if ext and not ext.startswith("."): ext = "." + ext
+    return ext
+
+
+def _register(handle, size):
+    now = time.time()
+    conn = _connect()
+    conn.execute("INSERT OR IGNORE INTO blobs (handle, size, refcount, created_at, last_access) VALUES (?, ?, 0, ?, ?)",
+                 (handle, size, now, now))
+    conn.execute("UPDATE blobs SET last_access=? WHERE handle=?", (now, handle))
+    conn.commit()
+    conn.close()
+    _maybe_evict()
+
+
+# --- 写入 ---
+def put_bytes(data, ext=""):
+    """
+    写入字节，返回句柄。相同内容 + 相同扩展名只会落盘一次。
+    """
+    if isinstance(data, memoryview): data = data.tobytes()
+    handle = hashlib.sha256(data).hexdigest() + _normalize_ext(ext)
+    get_backend().put_bytes(_check(handle), data)
+    _register(handle, len(data))
+    return handle
+
+
+def put_file(src_path, ext=None, move=False):
+    """
+    分块哈希已有文件并纳入存储 (适合大文件/流式上传后的临时文件)。
+    """
+    if ext is None: ext = os.path.splitext(src_path)[1]
+    h = hashlib.sha256()
+    size = 0
+    with open(src_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+            size += len(chunk)
+    handle = h.hexdigest() + _normalize_ext(ext)
+    get_backend().put_file(_check(handle), src_path, move)
+    _register(handle, size)
+    return handle
+
+
+def put_text(text):
+    return put_bytes((text or "").encode("utf-8"), ".txt")
+
+
+def put_json(obj):
+    return put_bytes(json.dumps(obj, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8"), ".json")
+
+
+# --- 读取 ---
+def _maybe_touch(handle):
+    now = time.time()
+    if now - _touched.get(handle, 0) > _TOUCH_INTERVAL:
+        if len(_touched) > 10000: _touched.clear()
+        _touched[handle] = now
+        touch(handle)
+
+
+def blob_path(handle):
+    """
+    返回 blob 在本机可读的文件路径；已被淘汰则返回 None。
+    """
+    if not handle: return None
+    path = get_backend().local_path(_check(handle))
+    if path is not None: _maybe_touch(handle)
+    return path
+
+
+def get_bytes(handle):
+    if not handle: return None
+    data = get_backend().get(_check(handle))
+    if data is not None: _maybe_touch(handle)
+    return data
+
+
+def get_text(handle):
+    data = get_bytes(handle)
+    return data.decode("utf-8") if data is not None else None
+
+
+def get_json(handle):
+    data = get_bytes(handle)
+    return json.loads(data.decode("utf-8")) if data is not None else None
+
+
+def touch(handle):
+    now = time.time()
+    get_backend().touch(handle)
+    conn = _connect()
+    conn.execute("UPDATE blobs SET last_access=? WHERE handle=?", (now, handle))
+    conn.commit()
+    conn.close()
+
+
+# --- 引用计数 ---
+def acquire(handle):
+    if not handle: return
+    conn = _connect()
+    conn.execute("UPDATE blobs SET refcount=refcount+1, last_access=? WHERE handle=?", (time.time(), handle))
+    conn.commit()
+    conn.close()
+
+
+def release(handle):
+    if not handle: return
+    conn = _connect()
+    conn.execute("UPDATE blobs SET refcount=MAX(refcount-1, 0) WHERE handle=?", (handle,))
+    conn.commit()
+    conn.close()
+
+
+def swap(old_handle, new_handle):
+    """
+    会话字段换绑：先引用新句柄，再释放旧句柄 (两者相同时不做任何事)。
+    """
+    if old_handle == new_handle: return new_handle
+    acquire(new_handle)
+    release(old_handle)
+    return new_handle
+
+
+# --- 淘汰 ---
+def _delete(conn, handle):
+    get_backend().delete(handle)
+    conn.execute("DELETE FROM blobs WHERE handle=?", (handle,))
+
+
+def evict(now=None):
+    """
+    1. 超过 TTL 未被访问的 blob 一律删除 (视为会话已失效，即使仍有引用)
+    2. 总量超过上限时，按 LRU 删除无引用的 blob
+    返回删除的数量。
+    """
+    now = now or time.time()
+    removed = 0
+    conn = _connect()
+    c = conn.cursor()
+    c.execute("SELECT handle FROM blobs WHERE last_access < ?", (now - BLOB_TTL_SECONDS,))
+    for (handle,) in c.fetchall():
+        _delete(conn, handle)
+        removed += 1
+
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+    if total > BLOB_MAX_BYTES:
+        c.execute("SELECT handle, size FROM blobs WHERE refcount=0 ORDER BY last_access ASC")
+        for handle, size in c.fetchall():
+            if total <= BLOB_MAX_BYTES: break
+            _delete(conn, handle)
+            total -= size
+            removed += 1
+    conn.commit()
+    conn.close()
+    return removed
+
+
+def _maybe_evict():
+    global _last_evict
+    now = time.time()
+    if now - _last_evict < _EVICT_INTERVAL: return
+    _last_evict = now
+    try:
+        evict(now)
+    except sqlite3.Error:
+        pass
+
+
+def get_stats():
+    conn = _connect()
+    count, total, referenced = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(refcount > 0), 0) FROM blobs").fetchone()
+    conn.close()
+    return {"count": count, "bytes": total, "referenced": referenced}
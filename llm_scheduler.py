@@ -0,0 +1,243 @@
+import hashlib
+import os
+import random
+import threading
+import time
+from collections import deque
+
+# ================= 大模型请求调度 (按 API Key 限流 + 用户间公平排队) =================
+# 同一个组织的 Key 被很多会话共用时：
+#   - 每个 Key 有并发上限和每分钟 token 预算 (令牌桶)
+#   - 等待中的请求按用户轮转放行，一个用户的大批量润色不会饿死其他人
+#   - 收到 429 时整体冷却，冷却时间带随机抖动并指数增长，同时减半并发 (AIMD)，成功后逐步恢复
+# Streamlit 的所有会话在同一进程内，因此模块级状态即为进程级共享。
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+LLM_TPM_LIMIT = int(os.getenv("LLM_TPM_LIMIT", "300000"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_MAX_BACKOFF = float(os.getenv("LLM_MAX_BACKOFF", "60"))
+
+_states = {}
+_states_lock = threading.Lock()
+
+
+class Cancelled(Exception):
+    """排队中的请求被调用方取消 (例如投机预取的输入已经变化)"""
+
+
+class _Ticket:
+    __slots__ = ("user", "tokens", "granted", "enqueued_at")
+
+    def __init__(self, user, tokens):
+        self.user = user
+        self.tokens = tokens
+        self.granted = False
+        self.enqueued_at = time.monotonic()
+
+
+class _KeyState:
+    def __init__(self, key_id):
+        self.key_id = key_id
+        self.cond = threading.Condition()
+        self.limit = LLM_MAX_CONCURRENCY  # 当前并发上限 (被 429 压低后逐步恢复)
+        self.active = 0
+        self.queues = {}  # 用户 -> 等待中的请求
+        self.rr = deque()  # 有请求在等的用户，按轮转顺序
+        self.tokens = float(LLM_TPM_LIMIT)
+        self.last_refill = time.monotonic()
+        self.cooldown_until = 0.0
+        self.backoff = 0
+        self.successes = 0
+        # 统计
+        self.granted_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.rate_limited = 0
+
+    def refill(self, now):
+        self.tokens = min(float(LLM_TPM_LIMIT), self.tokens + (now - self.last_refill) * LLM_TPM_LIMIT / 60.0)
+        self.last_refill = now
+
+    def dispatch(self, now):
+        """
+        在持锁状态下尽可能多地放行请求 (每个用户每轮最多一个)
+        """
+        self.refill(now)
+        granted = False
+        while self.rr and self.active < self.limit and now >= self.cooldown_until:
+            user = self.rr[0]
+            ticket = self.queues[user][0]
+            need = min(ticket.tokens, LLM_TPM_LIMIT)
+            if self.tokens < need:
+                break
+            self.queues[user].popleft()
+            self.rr.popleft()
+            if self.queues[user]:
+                self.rr.append(user)
+            else:
+                del self.queues[user]
+            self.tokens -= need
+            self.active += 1
+            ticket.granted = True
+            waited = now - ticket.enqueued_at
+            self.granted_count += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            granted = True
+        if granted:
+            self.cond.notify_all()
+
+    def next_wakeup(self, now):
+        if now < self.cooldown_until:
+            return self.cooldown_until - now
+        if self.rr:
+            need = min(self.queues[self.rr[0]][0].tokens, LLM_TPM_LIMIT)
+            if self.tokens < need:
+                return (need - self.tokens) * 60.0 / LLM_TPM_LIMIT
+        return 1.0
+
+
+def _key_id(api_key):
+    # 统计与展示只用 Key 的哈希前缀，不在内存里按明文索引
+    return hashlib.sha256((api_key or "").encode()).hexdigest()[:10]
+
+
+def _get_state(api_key):
+    key_id = _key_id(api_key)
+    with _states_lock:
+        state = _states.get(key_id)
+        if state is None:
+            state = _states[key_id] = _KeyState(key_id)
+        return state
+
+
+def estimate_tokens(messages, max_tokens=None):
+    """
+    粗略估算一次请求的 token 数 (中文约 1 字 1 token)，再加上预计输出
+    """
+    chars = sum(len(str(m.get("content", ""))) for m in messages)
+    return chars + (max_tokens or 2048)
+
+
+def _acquire(state, user, tokens, cancel_event=None):
+    ticket = _Ticket(user, tokens)
+    with state.cond:
+        state.queues.setdefault(user, deque()).append(ticket)
+        if user not in state.rr:
+            state.rr.append(user)
+        while True:
+            now = time.monotonic()
+            state.dispatch(now)
+            if cancel_event is not None and cancel_event.is_set():
+                if ticket.granted:
+                    # 放行与取消同时发生：归还名额和预扣的 token
+                    state.active -= 1
+                    state.tokens += min(ticket.tokens, LLM_TPM_LIMIT)
+                    state.dispatch(now)
+                else:
+                    state.queues[user].remove(ticket)
+                    if not state.queues[user]:
+                        del state.queues[user]
+                        state.rr.remove(user)
+                raise Cancelled()
+            if ticket.granted:
+                return ticket
+            state.cond.wait(timeout=max(0.01, min(state.next_wakeup(now), 1.0)))
+
+
+def _release(state, ticket, used_tokens=None, rate_limited=False, retry_after=None):
+    with state.cond:
+        state.active -= 1
+        now = time.monotonic()
+        if used_tokens is not None:
+            # 按实际用量修正预估 (允许暂时为负，即透支)
+            state.tokens -= used_tokens - min(ticket.tokens, LLM_TPM_LIMIT)
+        if rate_limited:
+            state.rate_limited += 1
+            state.backoff += 1
+            state.successes = 0
+            state.limit = max(1, state.limit // 2)
+            delay = retry_after if retry_after else min(LLM_MAX_BACKOFF, 2 ** state.backoff)
+            # 抖动：避免所有请求在同一时刻一起重试
+            state.cooldown_until = max(state.cooldown_until, now + delay * (0.5 + random.random()))
+        else:
+            state.backoff = max(0, state.backoff - 1)
+            state.successes += 1
+            if state.limit < LLM_MAX_CONCURRENCY and state.successes >= state.limit:
+                state.limit += 1
+                state.successes = 0
+        state.dispatch(now)
+        state.cond.notify_all()
+
+
+def _status_code(e):
+    code = getattr(e, "status_code", None)
+    if code is None:
+        code = getattr(getattr(e, "response", None), "status_code", None)
+    return code
+
+
+def _retry_after(e):
+    try:
+        return float(e.response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def _is_transient(e):
+    code = _status_code(e)
+    if code is not None:
+        return code >= 500
+    return type(e).__name__ in ("APIConnectionError", "APITimeoutError")
+
+
+def submit(api_key, user, fn, est_tokens=2048, cancel_event=None):
+    """
+    经调度器执行一次大模型调用 fn()，阻塞直到拿到执行名额并返回其结果。
+    429 会触发整个 Key 的冷却并自动重试；5xx/网络错误按指数退避重试。
+    cancel_event 被置位时，仍在排队 (含等待重试) 的请求抛出 Cancelled，不再占用名额。
+    """
+    state = _get_state(api_key)
+    attempt = 0
+    while True:
+        ticket = _acquire(state, user or "", est_tokens, cancel_event)
+        try:
+            result = fn()
+        except Exception as e:
+            rate_limited = _status_code(e) == 429
+            retry = attempt < LLM_MAX_RETRIES and (rate_limited or _is_transient(e))
+            _release(state, ticket, rate_limited=rate_limited, retry_after=_retry_after(e) if rate_limited else None)
+            if not retry:
+                raise
+            if not rate_limited:
+                time.sleep(min(LLM_MAX_BACKOFF, 2 ** attempt) * (0.5 + random.random()))
+            attempt += 1
+            continue
+        usage = getattr(result, "usage", None)
+        _release(state, ticket, used_tokens=getattr(usage, "total_tokens", None))
+        return result
+
+
+def get_stats():
+    """
+    每个 Key 的排队情况，供管理员控制台展示
+    """
+    rows = []
+    now = time.monotonic()
+    with _states_lock:
+        states = list(_states.values())
+    for state in states:
+        with state.cond:
+            rows.append({
+                "key": state.key_id,
+                "running": state.active,
+                "concurrency_limit": state.limit,
+                "queued": sum(len(q) for q in state.queues.values()),
+                "queued_users": len(state.queues),
+                "avg_wait_ms": round(state.wait_total / state.granted_count * 1000, 1) if state.granted_count else 0.0,
+                "max_wait_ms": round(state.wait_max * 1000, 1),
+                "requests": state.granted_count,
+                "rate_limited": state.rate_limited,
+                "cooldown_s": round(max(0.0, state.cooldown_until - now), 1),
+            })
+    return rows
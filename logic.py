@@ -1,20 +1,43 @@
+import atexit
 import json
 import re
-from docx import Document
-from docx.oxml import OxmlElement
-from docx.shared import Pt, RGBColor
-from docx.oxml.ns import qn
-from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
-from copy import deepcopy
-from openai import OpenAI
+from copy import copy, deepcopy
+from collections import OrderedDict
 import os
 import zipfile
 import difflib
+import hashlib
+import tempfile
+import threading
+import time
 
-try:
-    import pdfplumber
-except ImportError:
-    pdfplumber = None
+import llm_scheduler
+import retrieval
+
+# 重型依赖 (python-docx / pdfplumber) 延迟到真正用到时再导入，登录页等不需要它们的页面冷启动更快
+
+
+def _load_pdfplumber():
+    try:
+        import pdfplumber
+        return pdfplumber
+    except ImportError:
+        return None
+
+
+# ================= 运行指标 (进程内计数，管理员控制台展示) =================
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def record_metric(name, value=1):
+    with _metrics_lock:
+        _metrics[name] = _metrics.get(name, 0) + value
+
+
+def get_metrics():
+    with _metrics_lock:
+        return dict(_metrics)
 
 
 # ================== 文件格式预检 (保持不变) ==================
@@ -25,6 +48,7 @@ def validate_file_format(file_path):
     ext = os.path.splitext(filename)[1].lower()
 
     if ext == '.docx':
+        from docx import Document
         if not zipfile.is_zipfile(file_path):
             return False, f"❌ 文件【{filename}】格式错误！\n它看起来像是旧版 .doc 或已损坏。\n💡 请用 Word 打开并‘另存为’ .docx 格式。"
         try:
@@ -32,6 +56,7 @@ def validate_file_format(file_path):
         except Exception as e:
             return False, f"❌ 文件【{filename}】内容损坏: {str(e)}"
     elif ext == '.pdf':
+        pdfplumber = _load_pdfplumber()
         if pdfplumber is None:
             return False, "缺少 pdfplumber 库。"
         try:
@@ -42,63 +67,847 @@ def validate_file_format(file_path):
     return True, "OK"
 
 
-# ================= 文本读取 (保持不变) =================
-def _read_pdf(file_path):
-    if pdfplumber is None: return ""
+# ================= 文本读取 =================
+# PDF 表格提取策略：lines = 只按框线识别 (默认)；text = 按文字对齐识别无框线表格；off = 不提取表格
+PDF_TABLE_STRATEGY = os.getenv("PDF_TABLE_STRATEGY", "lines")
+
+_PDF_TABLE_SETTINGS = {
+    "lines": {"vertical_strategy": "lines", "horizontal_strategy": "lines"},
+    "text": {"vertical_strategy": "text", "horizontal_strategy": "text"},
+}
+
+
+def _page_may_have_table(page, strategy):
+    """
+    extract_tables 是 pdfplumber 最贵的操作。先用页面上已有的线段/矩形/字符位置做廉价判断，
+    明显没有表格的页面直接跳过。
+    """
+    if strategy == "lines":
+        # 有框线的表格至少需要两条横线和两条竖线
+        h = v = 0
+        for e in page.edges:
+            if e["orientation"] == "h" and e["width"] > 10:
+                h += 1
+            elif e["orientation"] == "v" and e["height"] > 5:
+                v += 1
+            if h >= 2 and v >= 2:
+                return True
+        return False
+    if strategy == "text":
+        # 无框线表格：至少 3 行文字，每行内部有 2 处以上的大间距 (即 3 列以上)
+        lines = {}
+        for ch in page.chars:
+            lines.setdefault(round(ch["top"]), []).append(ch)
+        column_lines = 0
+        for chars in lines.values():
+            chars.sort(key=lambda ch: ch["x0"])
+            gaps = 0
+            for a, b in zip(chars, chars[1:]):
+                if b["x0"] - a["x1"] > 3 * max(a["x1"] - a["x0"], 1):
+                    gaps += 1
+            if gaps >= 2:
+                column_lines += 1
+                if column_lines >= 3:
+                    return True
+        return False
+    return False
+
+
+def _pdf_page_blocks(page, i, strategy):
+    """
+    单页的文本块：正文 + (可能存在的) 表格
+    """
+    blocks = []
+    if not page.chars:
+        return blocks  # 没有文字层 (扫描件)，既无文本也无可用表格
+    txt = page.extract_text()
+    if txt: blocks.append(f"[PDF_第{i + 1}页] {txt}")
+    if strategy not in _PDF_TABLE_SETTINGS or not _page_may_have_table(page, strategy):
+        return blocks
+    tables = page.extract_tables(_PDF_TABLE_SETTINGS[strategy])
+    for t_idx, table in enumerate(tables):
+        clean_table = []
+        for row in table:
+            clean_row = [str(c).replace('\n', ' ') for c in row if c]
+            if clean_row: clean_table.append(" | ".join(clean_row))
+        if clean_table:
+            blocks.append(f"[PDF_表格_{i + 1}_{t_idx}]\n" + "\n".join(clean_table))
+    return blocks
+
+
+def iter_pdf_pages(file_path, table_strategy=None):
+    """
+    逐页产出 (页码, 文本块列表)。每页处理完立即释放 pdfplumber 的页面缓存，
+    调用方提前停止迭代时后续页面不会被解析，内存也不会随页数增长。
+    """
+    pdfplumber = _load_pdfplumber()
+    if pdfplumber is None: return
+    strategy = table_strategy or PDF_TABLE_STRATEGY
+    with pdfplumber.open(file_path) as pdf:
+        for i, page in enumerate(pdf.pages):
+            try:
+                yield i, _pdf_page_blocks(page, i, strategy)
+            finally:
+                page.close()
+
+
+def template_keywords(target_structure, limit=200):
+    """
+    从目标表结构中取出标签词 (如“学号”“获奖情况”)，作为源数据检索的查询词
+    """
+    seen = {}
+    for word in re.findall(r"[\u4e00-\u9fa5]{2,8}|[A-Za-z]{3,20}", target_structure or ""):
+        if word not in seen: seen[word] = True
+        if len(seen) >= limit: break
+    return list(seen)
+
+
+def _read_pdf(file_path, table_strategy=None, char_budget=None):
+    """
+    char_budget: 读满该字数即停止 (生成方案时再按模板检索相关段落)，None 表示全文
+    """
+    if _load_pdfplumber() is None: return ""
     text_content = []
     try:
-        with pdfplumber.open(file_path) as pdf:
-            for i, page in enumerate(pdf.pages):
-                txt = page.extract_text()
-                if txt: text_content.append(f"[PDF_第{i + 1}页] {txt}")
-                tables = page.extract_tables()
-                for t_idx, table in enumerate(tables):
-                    clean_table = []
-                    for row in table:
-                        clean_row = [str(c).replace('\n', ' ') for c in row if c]
-                        if clean_row: clean_table.append(" | ".join(clean_row))
-                    if clean_table:
-                        text_content.append(f"[PDF_表格_{i + 1}_{t_idx}]\n" + "\n".join(clean_table))
+        total = pages_read = 0
+        for i, blocks in iter_pdf_pages(file_path, table_strategy):
+            text_content.extend(blocks)
+            pages_read += 1
+            total += sum(len(b) + 1 for b in blocks)
+            if char_budget and total >= char_budget:
+                break
+        record_metric("pdf_pages_read", pages_read)
     except Exception as e:
         return f"[PDF读取失败] {str(e)}"
     return "\n".join(text_content)
 
 
-def read_file_content(file_path):
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_MC_FALLBACK = "{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback"
+
+# ----- 单元格编号 (模板序列化与写入共用，保证两边编号一致) -----
+# 顶层表格按文档顺序编号 T，表内按 w:tr / w:tc 出现顺序编号 R / C (含纵向合并的续格)，
+# 如 T0R3C1。嵌套表格不编号，写入时走模糊匹配。
+SLOT_HINTS = ("此栏", "填写")  # 带这些字样的格子本身就是填写区 (如“自我鉴定（此栏填写）”)
+
+
+def _is_slot_text(text):
+    text = text.strip()
+    return not text or any(h in text for h in SLOT_HINTS)
+
+
+class _SlotCounter:
+    def __init__(self):
+        self.top_tables = 0
+        self.stack = []  # 每个打开的表格：[表格号或 None (嵌套), 行号, 列号]
+
+    def start(self, tag):
+        if tag == _W + "tbl":
+            if self.stack:
+                self.stack.append([None, -1, -1])
+            else:
+                self.stack.append([self.top_tables, -1, -1])
+                self.top_tables += 1
+        elif tag == _W + "tr" and self.stack:
+            self.stack[-1][1] += 1
+            self.stack[-1][2] = -1
+        elif tag == _W + "tc" and self.stack:
+            self.stack[-1][2] += 1
+
+    def end(self, tag):
+        if tag == _W + "tbl" and self.stack:
+            self.stack.pop()
+
+    def row_id(self):
+        t, r, _ = self.stack[-1]
+        return None if t is None else f"T{t}R{r}"
+
+    def cell_id(self):
+        t, r, c = self.stack[-1]
+        return None if t is None else f"T{t}R{r}C{c}"
+
+
+def _iter_slot_ids(body):
+    """
+    遍历内存中的文档，产出 (编号, 元素)：行为 (T0R3, w:tr)，单元格为 (T0R3C1, w:tc)
+    """
+    from lxml import etree
+
+    counter, skip_depth = _SlotCounter(), 0
+    for event, el in etree.iterwalk(body, events=("start", "end")):
+        tag = el.tag
+        if tag == _MC_FALLBACK:
+            skip_depth += 1 if event == "start" else -1
+            continue
+        if skip_depth:
+            continue
+        if event == "end":
+            counter.end(tag)
+            continue
+        counter.start(tag)
+        if tag == _W + "tr" and counter.stack:
+            sid = counter.row_id()
+        elif tag == _W + "tc" and counter.stack:
+            sid = counter.cell_id()
+        else:
+            continue
+        if sid: yield sid, el
+
+
+def _read_docx(file_path, slot_ids=False):
+    """
+    直接用 lxml 流式遍历 word/document.xml，一次扫描按文档顺序输出表格和正文：
+    - 不构造 python-docx 的单元格对象，也不重算合并网格
+    - 横向合并 (gridSpan) 本身就是一个 w:tc；纵向合并的续格 (vMerge=continue) 输出为空占位，
+      内容不重复输出，同一行后面的格子也不会错位到前一列
+    - 嵌套表格单独成块，紧跟在外层表格之后；含嵌套表格的格子不编号
+    - 处理完的节点立即释放，峰值内存与文档长度基本无关
+    slot_ids=True 时 (读取模板结构) 顶层表格的空白格输出为编号 #T0R3C1，填写区后附编号，
+    连续的空白行折叠为一行说明，并把其上一行标为列表区 (表头) #T0R2。
+    """
+    from lxml import etree
+
+    blocks = []
+    body_paras = []  # 连续的正文段落，遇到表格时成块输出
+    tables = []  # 表格栈：{"rows", "row", "cell", "nested", "blank", "last_row"}
+    paras = []  # 段落栈 (文本框里的段落嵌套在外层段落内)
+    skip_depth = 0  # mc:Fallback 与 mc:Choice 内容重复，跳过
+    table_count = [0]
+    counter = _SlotCounter()
+
+    def flush_paras():
+        if body_paras:
+            blocks.append("【正文区】\n" + "\n".join(body_paras))
+            body_paras.clear()
+
+    def flush_blank(t):
+        if t["blank"]:
+            if t["last_row"]:
+                t["rows"].append(f"〔列表区 #{t['last_row']}：上一行为表头，下有 {t['blank']} 行空白〕")
+            else:
+                t["rows"].append(f"〔{t['blank']} 行空白〕")
+            t["blank"] = 0
+
+    def emit_table(rows):
+        if rows:
+            blocks.append(f"【表格区_{table_count[0]}】\n" + "\n".join(rows))
+            table_count[0] += 1
+
+    with zipfile.ZipFile(file_path) as zf, zf.open("word/document.xml") as f:
+        for event, el in etree.iterparse(f, events=("start", "end")):
+            tag = el.tag
+            if tag == _MC_FALLBACK:
+                skip_depth += 1 if event == "start" else -1
+                continue
+            if skip_depth:
+                continue
+
+            if event == "start":
+                counter.start(tag)
+                if tag == _W + "p":
+                    paras.append([])
+                elif tag == _W + "tbl":
+                    if tables and tables[-1]["cell"] is not None:
+                        tables[-1]["cell"]["has_table"] = True
+                    tables.append({"rows": [], "row": None, "cell": None, "nested": [], "blank": 0, "last_row": None})
+                elif tag == _W + "tr" and tables:
+                    tables[-1]["row"] = []
+                    tables[-1]["row_id"] = counter.row_id() if slot_ids else None
+                elif tag == _W + "tc" and tables:
+                    tables[-1]["cell"] = {"paras": [], "merged": False, "has_table": False,
+                                          "id": counter.cell_id() if slot_ids else None}
+                continue
+            counter.end(tag)
+
+            if tag == _W + "t":
+                if paras: paras[-1].append(el.text or "")
+            elif tag == _W + "tab":
+                if paras: paras[-1].append("\t")
+            elif tag in (_W + "br", _W + "cr"):
+                if paras: paras[-1].append("\n")
+            elif tag == _W + "vMerge":
+                cell = tables[-1]["cell"] if tables else None
+                if cell is not None and el.get(_W + "val") in (None, "continue"):
+                    cell["merged"] = True
+            elif tag == _W + "p":
+                text = "".join(paras.pop()).strip()
+                if text:
+                    if paras:
+                        paras[-1].append("\n" + text)
+                    elif tables and tables[-1]["cell"] is not None:
+                        tables[-1]["cell"]["paras"].append(text)
+                    else:
+                        body_paras.append(text)
+                el.clear()
+            elif tag == _W + "tc" and tables:
+                t = tables[-1]
+                cell, t["cell"] = t["cell"], None
+                text = "\n".join(cell["paras"]).strip()
+                if t["row"] is None:
+                    pass
+                elif cell["merged"]:
+                    t["row"].append(("", None))  # 续格占位 (不可写入，不编号)
+                elif cell["id"] and cell["has_table"]:
+                    # 含嵌套表格的格子不是空白格：写入会清空格子，连同嵌套表格一起删掉
+                    t["row"].append((text or "〔嵌套表格，见下〕", None))
+                elif cell["id"]:
+                    t["row"].append((text, cell["id"] if _is_slot_text(text) else None))
+                elif text:
+                    t["row"].append((text, None))
+            elif tag == _W + "tr" and tables:
+                t = tables[-1]
+                if t["row_id"] and not any(text for text, _ in t["row"]):
+                    t["blank"] += 1  # 空白行 (含只剩纵向合并续格的行)，折叠输出
+                elif t["row"]:
+                    flush_blank(t)
+                    t["rows"].append(" | ".join(
+                        (f"{text} #{sid}" if text else f"#{sid}") if sid else text for text, sid in t["row"]))
+                    t["last_row"] = t["row_id"]
+                t["row"] = None
+            elif tag == _W + "tbl":
+                t = tables.pop()
+                flush_blank(t)
+                if tables:
+                    tables[-1]["nested"].extend([t["rows"]] + t["nested"])
+                else:
+                    flush_paras()
+                    emit_table(t["rows"])
+                    for rows in t["nested"]:
+                        emit_table(rows)
+                el.clear()
+
+            # 已处理完的 body 顶层节点从树上摘掉
+            parent = el.getparent()
+            if parent is not None and parent.tag == _W + "body":
+                el.clear()
+                while el.getprevious() is not None:
+                    del parent[0]
+
+    flush_paras()
+    return "\n\n".join(blocks)
+
+
+def _read_docx_legacy(file_path):
+    """
+    旧版 python-docx 实现 (先所有表格，再所有段落)。保留用于兜底和基准对比。
+    """
+    from docx import Document
+    doc = Document(file_path)
+    text = []
+    for i, table in enumerate(doc.tables):
+        table_data = []
+        for row in table.rows:
+            row_txt = " | ".join([c.text.strip() for c in row.cells if c.text.strip()])
+            if row_txt: table_data.append(row_txt)
+        if table_data:
+            text.append(f"【表格区_{i}】\n" + "\n".join(table_data))
+
+    para_data = []
+    for p in doc.paragraphs:
+        if p.text.strip(): para_data.append(p.text.strip())
+    if para_data:
+        text.append("【正文区】\n" + "\n".join(para_data))
+
+    return "\n\n".join(text)
+
+
+def read_file_content(file_path, pdf_table_strategy=None, char_budget=None):
+    """
+    char_budget 只对 PDF 生效 (DOCX 读取本身足够快)，见 _read_pdf
+    """
     ext = os.path.splitext(file_path)[1].lower()
-    if ext == '.pdf': return _read_pdf(file_path)
+    if ext == '.pdf':
+        return _read_pdf(file_path, table_strategy=pdf_table_strategy, char_budget=char_budget)
     try:
-        doc = Document(file_path)
-        text = []
-        for i, table in enumerate(doc.tables):
-            table_data = []
-            for row in table.rows:
-                row_txt = " | ".join([c.text.strip() for c in row.cells if c.text.strip()])
-                if row_txt: table_data.append(row_txt)
-            if table_data:
-                text.append(f"【表格区_{i}】\n" + "\n".join(table_data))
-
-        para_data = []
-        for p in doc.paragraphs:
-            if p.text.strip(): para_data.append(p.text.strip())
-        if para_data:
-            text.append("【正文区】\n" + "\n".join(para_data))
-
-        return "\n\n".join(text)
+        return _read_docx(file_path)
+    except Exception:
+        record_metric("docx_reader_fallbacks")
+    try:
+        return _read_docx_legacy(file_path)
     except Exception as e:
         return f"[读取错误] {str(e)}"
 
 
+# ----- 多个源文件 (简历 + 成绩单 + 证书清单 ...) 并发读取，合并为一份 -----
+# PDF 解析 (pdfminer) 是纯 Python 的 CPU 密集任务，线程之间受 GIL 限制只能轮流执行，
+# 多核机器上两个以上 PDF 交给进程池 (默认 CPU 核数 - 1 个进程，按需启动，不超过 PDF 个数)；
+# 单核机器上进程池只会多出启动开销，默认为 0，全部走线程。DOCX 读取很快，始终走线程。
+SOURCE_PROCESS_WORKERS = int(os.getenv("SOURCE_PROCESS_WORKERS", str((os.cpu_count() or 1) - 1)))
+DEDUPE_MIN_CHARS = 10  # 短行 (成绩、性别等) 在不同文件里重复是正常的，不去重
+
+_source_pool = None
+_source_pool_lock = threading.Lock()
+
+
+def _get_source_pool():
+    global _source_pool
+    with _source_pool_lock:
+        if _source_pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            _source_pool = ProcessPoolExecutor(max_workers=SOURCE_PROCESS_WORKERS,
+                                               mp_context=multiprocessing.get_context("spawn"))
+        return _source_pool
+
+
+def _reset_source_pool(wait=False):
+    global _source_pool
+    with _source_pool_lock:
+        pool, _source_pool = _source_pool, None
+    if pool is not None: pool.shutdown(wait=wait, cancel_futures=True)
+
+
+atexit.register(_reset_source_pool, True)  # 进程退出时回收工作进程
+
+
+def _read_source_in_worker(path, char_budget):
+    """
+    在进程池里读取一个源文件，返回 (文本, 本次新增的运行指标)：
+    子进程里 record_metric 的计数不在主进程，交回给 read_sources 合并
+    """
+    before = get_metrics()
+    text = read_file_content(path, None, char_budget)
+    delta = {k: v - before.get(k, 0) for k, v in get_metrics().items() if v != before.get(k, 0)}
+    return text, delta
+
+
+def merge_sources(named_texts):
+    """
+    named_texts: [(显示文件名, 文本), ...]。只有一份时原样返回；多份时每份前加来源标记
+    【来源 1/3：简历.pdf】，较长的行在前面已经出现过 (多份材料重复的个人信息、每页重复的页眉) 则去掉。
+    """
+    if len(named_texts) == 1:
+        return named_texts[0][1]
+    seen, parts, dropped = set(), [], 0
+    for n, (name, text) in enumerate(named_texts):
+        lines = []
+        for line in (text or "").split("\n"):
+            marker = re.match(r"\[PDF_[^\]]*\]", line)
+            key = re.sub(r"\s+", "", line[marker.end():] if marker else line)
+            if len(key) >= DEDUPE_MIN_CHARS:
+                if key in seen:
+                    dropped += 1
+                    if marker: lines.append(marker.group(0))  # 保留页码标记
+                    continue
+                seen.add(key)
+            lines.append(line)
+        parts.append(f"【来源 {n + 1}/{len(named_texts)}：{name}】\n" + "\n".join(lines))
+    record_metric("sources_merged", len(named_texts))
+    if dropped: record_metric("source_lines_deduped", dropped)
+    return "\n\n".join(parts)
+
+
+def read_sources(sources, char_budget=None):
+    """
+    sources: [(显示文件名, 路径), ...]。各文件并发读取 (多核机器上有两个以上 PDF 时 PDF 走进程池)，
+    总耗时约等于最大的那个文件；结果经 merge_sources 合并。
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+
+    if len(sources) == 1:
+        return read_file_content(sources[0][1], None, char_budget)
+    is_pdf = [os.path.splitext(path)[1].lower() == ".pdf" for _, path in sources]
+    pool = _get_source_pool() if sum(is_pdf) > 1 and SOURCE_PROCESS_WORKERS > 0 else None
+    with ThreadPoolExecutor(max_workers=len(sources)) as threads:
+        futures = [pool.submit(_read_source_in_worker, path, char_budget) if pool is not None and pdf
+                   else threads.submit(read_file_content, path, None, char_budget)
+                   for (_, path), pdf in zip(sources, is_pdf)]
+        texts = []
+        for (_, path), fut in zip(sources, futures):
+            try:
+                result = fut.result()
+                if isinstance(result, tuple):  # 进程池返回 (文本, 子进程指标)
+                    result, delta = result
+                    for name, value in delta.items(): record_metric(name, value)
+                texts.append(result)
+            except BrokenProcessPool:
+                # 工作进程异常退出 (如内存不足被杀)：重建进程池，本次在当前进程里读
+                _reset_source_pool()
+                texts.append(read_file_content(path, None, char_budget))
+    return merge_sources([(name, text) for (name, _), text in zip(sources, texts)])
+
+
+PLAN_CELL_IDS = os.getenv("PLAN_CELL_IDS", "1") == "1"  # 模板结构中带单元格编号，方案按编号直接写入
+
+
+def read_template_structure(file_path):
+    """
+    读取目标模板结构 (用于 Prompt)，可写入的格子和列表区带编号
+    """
+    if PLAN_CELL_IDS and os.path.splitext(file_path)[1].lower() == ".docx":
+        try:
+            return _read_docx(file_path, slot_ids=True)
+        except Exception:
+            record_metric("docx_reader_fallbacks")  # 退回不带编号的读取，计数便于发现解析器问题
+    return read_file_content(file_path)
+
+
+# ================= 本地规则预提取 (结构化短字段不必交给大模型) =================
+# 标准字段 -> (源/模板中可能出现的标签写法, 值的格式)
+# 数字类格式两端都不能紧挨数字，避免从更长的号码 (如身份证号) 中截出一段当作手机号/学号
+LOCAL_FIELD_RULES = {
+    "学号": (["学号", "学生编号"], r"(?<![A-Za-z0-9.])[A-Za-z]{0,2}\d{6,14}(?!\d)"),
+    "身份证号": (["公民身份号码", "身份证号码", "身份证号", "身份证"], r"(?<!\d)\d{17}[\dXx](?![\dXx])"),
+    "手机": (["手机号码", "手机号", "手机", "移动电话", "联系电话", "联系方式", "电话"], r"(?<!\d)(?:\+?86[- ]?)?1[3-9]\d{9}(?!\d)"),
+    "邮箱": (["电子邮箱", "电子邮件", "邮箱", "E-mail", "Email", "邮件"], r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+"),
+    "出生年月": (["出生年月", "出生日期", "出生时间", "生日"],
+             r"(?<!\d)(?:19|20)\d{2}\s*[年./-]\s*\d{1,2}(?:\s*[月./-]\s*\d{1,2}\s*日?|\s*月)?"),
+    "性别": (["性别"], r"[男女]"),
+    "政治面貌": (["政治面貌"], r"中共预备党员|中共党员|共青团员|预备党员|党员|团员|群众|民主党派人士|无党派人士"),
+}
+# 格式足够独特的字段：即使源数据里没有标签，全文只出现一个候选值时也可以采用
+_UNLABELED_OK = {"身份证号", "手机", "邮箱"}
+
+
+def _strip_label(text):
+    return re.sub(r"[\s:：*＊]", "", text)
+
+
+def _template_labels(target_structure):
+    """
+    模板中的标签：按单元格、行和冒号切开 ("姓名：____ 手机：____" 也能拆出 "手机")
+    """
+    return {_strip_label(c) for c in re.split(r"\s*\|\s*|\n|[:：]", target_structure or "") if c.strip()}
+
+
+def _find_template_anchor(labels, aliases):
+    """
+    按完整标签匹配：允许带括号说明、下划线填空或单元格编号 (如 "手机号码（必填）")，
+    但 "电话" 不会匹配 "家庭电话"、"紧急联系人电话"
+    """
+    for alias in aliases:
+        pat = re.compile(r"_*" + re.escape(alias) + r"(?:[（(\[【].*|_+)?(?:#T\d+R\d+(?:C\d+)?)?")
+        if any(pat.fullmatch(label) for label in labels):
+            return alias
+    return None
+
+
+# 源数据中的标签前面只能是行首、空白、表格分隔符或标点，不能紧挨汉字/字母/数字：
+# "母亲出生年月"、"父亲政治面貌"、"家庭电话" 都不是本人的 "出生年月"、"政治面貌"、"电话"
+_LABEL_START = r"(?<![\u4e00-\u9fa5A-Za-z0-9])"
+_LABEL_BEFORE_RE = re.compile(r"[\u4e00-\u9fa5]\s*[:：]?\s*$")
+
+
+def _find_labeled_values(old_data, aliases, value_re):
+    """
+    返回源数据中所有带本字段标签的候选值 (去重)。多于一个说明有歧义，交给大模型判断
+    """
+    values = []
+    # 1. 表格行 "标签 | 值 | 标签 | 值"：标签格的下一格就是值
+    for line in old_data.splitlines():
+        if " | " not in line: continue
+        cells = line.split(" | ")
+        for i, cell in enumerate(cells[:-1]):
+            if _strip_label(cell) in aliases:
+                m = value_re.search(cells[i + 1])
+                if m: values.append(m.group(0).strip())
+    # 2. 行内 "标签：值"
+    for alias in aliases:
+        pat = _LABEL_START + re.escape(alias) + r"\s*[:：]?\s*(" + value_re.pattern + ")"
+        values.extend(m.group(1).strip() for m in re.finditer(pat, old_data))
+    return list(dict.fromkeys(values))
+
+
+def _has_other_label(old_data, start):
+    """
+    值前面 (同一单元格或前一个单元格) 是否紧挨着一个中文标签，如 "家庭电话：139..."：
+    这样的值属于别的字段，不能当作无标签的候选
+    """
+    before = old_data[old_data.rfind("\n", 0, start) + 1:start].split(" | ")
+    head = before[-1].strip() or (before[-2].strip() if len(before) > 1 else "")
+    return bool(_LABEL_BEFORE_RE.search(head))
+
+
+def extract_local_fields(old_data, target_structure):
+    """
+    用标签词典 + 正则 + 表格相邻格规则，在本地毫秒级提取模板需要的结构化短字段。
+    返回 (kv 列表, 模板中出现的规则字段数)。anchor 使用模板里的标签写法，便于写入时定位。
+    """
+    template_labels = _template_labels(target_structure)
+    found = {}  # 字段 -> (anchor, 值或 None)
+    labeled = {}  # 字段 -> 带标签的候选值
+    for field, (aliases, pattern) in LOCAL_FIELD_RULES.items():
+        anchor = _find_template_anchor(template_labels, aliases)
+        if anchor:
+            labeled[field] = _find_labeled_values(old_data, aliases, re.compile(pattern))
+            found[field] = (anchor, labeled[field][0] if len(labeled[field]) == 1 else None)
+            if len(labeled[field]) > 1: record_metric("local_field_ambiguous")
+
+    # 无标签兜底：已被其他字段取走的位置不再参与 (同一个号码不能既是身份证号又是手机号)，
+    # 紧跟在别的标签后面的值 (如 "家庭电话：") 也不算无标签
+    claimed = [m.span() for vals in labeled.values() for val in vals for m in re.finditer(re.escape(val), old_data)]
+    for field, (anchor, val) in found.items():
+        if val is not None or labeled[field] or field not in _UNLABELED_OK: continue
+        candidates = set(m.group(0) for m in re.finditer(LOCAL_FIELD_RULES[field][1], old_data)
+                         if not any(m.start() < end and start < m.end() for start, end in claimed)
+                         and not _has_other_label(old_data, m.start()))
+        if len(candidates) == 1:
+            val = candidates.pop()
+            found[field] = (anchor, val)
+            claimed.extend(m.span() for m in re.finditer(re.escape(val), old_data))
+
+    kv = [{"anchor": anchor, "val": val, "source": "规则"} for anchor, val in found.values() if val]
+    return kv, len(found)
+
+
 # ================= V5 核心 Prompt (修复基础信息遗漏) =================
-def generate_filling_plan_v2(client, old_data, target_structure):
+SOURCE_CHAR_BUDGET = 12000  # Prompt 中源数据的最大字数
+# 源数据超过该字数时按模板标签检索相关段落 (见 retrieval.py)，而不是只截取开头；设为 0 关闭检索
+RETRIEVAL_CHAR_BUDGET = int(os.getenv("RETRIEVAL_CHAR_BUDGET", "8000"))
+# 读取源文件时的字数上限：检索需要看到后面的页，因此比 Prompt 预算宽得多
+SOURCE_READ_BUDGET = int(os.getenv("SOURCE_READ_BUDGET", "60000"))
+TEMPLATE_CHAR_BUDGET = 6000  # Prompt 中目标表结构的最大字数 (带单元格编号后比纯文本略长)
+
+_call_context = threading.local()  # 当前线程的调用上下文 (如投机预取的取消信号)
+
+
+def _chat(client, user="", **kwargs):
+    """
+    所有大模型调用的统一出口：经进程级调度器按 Key 限流、按用户公平排队
+    """
+    est = llm_scheduler.estimate_tokens(kwargs.get("messages", []), kwargs.get("max_tokens"))
+    return llm_scheduler.submit(getattr(client, "api_key", ""), user,
+                                lambda: client.chat.completions.create(**kwargs), est,
+                                cancel_event=getattr(_call_context, "cancel_event", None))
+
+
+def _retrieval_query(target_structure):
+    # 查询只用模板里的标签词，去掉单元格编号和列表区说明
+    return " ".join(template_keywords(re.sub(r"〔[^〕]*〕|#T\d+R\d+(?:C\d+)?", " ", target_structure or "")))
+
+
+def select_source_passages(old_data, target_structure, budget=None):
+    """
+    长源数据只保留与模板相关的段落 (预算默认 RETRIEVAL_CHAR_BUDGET)，不超过预算的源数据原样返回
+    """
+    budget = budget or RETRIEVAL_CHAR_BUDGET
+    if not RETRIEVAL_CHAR_BUDGET or len(old_data or "") <= budget:
+        return old_data
+    t0 = time.perf_counter()
+    packed, info = retrieval.pack_passages(old_data, _retrieval_query(target_structure), budget)
+    record_metric("retrieval_calls")
+    record_metric("retrieval_index_cache_hits" if info["cached"] else "retrieval_index_builds")
+    record_metric("retrieval_chars_in", len(old_data))
+    record_metric("retrieval_chars_out", len(packed))
+    record_metric("retrieval_ms", round((time.perf_counter() - t0) * 1000))
+    return packed
+
+
+# ================= 结构化输出：JSON 约束 + 残缺修复 + 定向补全 =================
+PLAN_SECTIONS = ("kv", "checkbox", "lists")
+PLAN_MAX_TOKENS = 8192
+_json_mode_unsupported = set()  # 不支持 response_format 的接口地址
+
+
+def _rejects_json_mode(e):
+    """
+    400/422 且错误信息指向 response_format 才算接口不支持 JSON 模式；
+    Prompt 超长、其他参数错误等照常抛出
+    """
+    if getattr(e, "status_code", None) not in (400, 422):
+        return False
+    detail = f"{getattr(e, 'body', '') or ''} {e}".lower()
+    return "response_format" in detail or "json_object" in detail
+
+
+def _chat_json(client, user, prompt, **kwargs):
+    """
+    优先使用 JSON 约束输出 (response_format=json_object)；接口不支持时记住并退回普通模式
+    """
+    messages = [{"role": "user", "content": prompt}]
+    base_url = str(getattr(client, "base_url", ""))
+    if base_url not in _json_mode_unsupported:
+        try:
+            return _chat(client, user, messages=messages, response_format={"type": "json_object"}, **kwargs)
+        except Exception as e:
+            if not _rejects_json_mode(e):
+                raise
+            _json_mode_unsupported.add(base_url)
+    return _chat(client, user, messages=messages, **kwargs)
+
+
+def _salvage_sections(text, sections=PLAN_SECTIONS):
+    """
+    从被截断或局部损坏的输出中逐个抢救完整的对象。
+    返回 (抢救出的方案, 完整闭合的分区集合)。
+    """
+    decoder = json.JSONDecoder()
+    plan, complete = {}, set()
+    for sec in sections:
+        m = re.search(r'"%s"\s*:\s*\[' % sec, text)
+        if not m: continue
+        pos, items = m.end(), []
+        while True:
+            while pos < len(text) and text[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(text): break
+            if text[pos] == "]":
+                complete.add(sec)
+                break
+            try:
+                obj, pos = decoder.raw_decode(text, pos)
+            except ValueError:
+                break
+            items.append(obj)
+        plan[sec] = items
+    return plan, complete
+
+
+def _parse_plan_output(content, sections=PLAN_SECTIONS):
+    """
+    解析模型输出，返回 (方案, 需要补全的分区列表, 状态)，状态为 ok / repaired / failed
+    """
+    text = re.sub(r'```json\s*|\s*```', '', content or "").strip()
+    try:
+        obj = json.loads(text)
+        if isinstance(obj, dict):
+            return obj, [], "ok"
+    except ValueError:
+        pass
+    # 前后夹带了说明文字
+    start, end = text.find("{"), text.rfind("}")
+    if 0 <= start < end:
+        try:
+            obj = json.loads(text[start:end + 1])
+            if isinstance(obj, dict):
+                return obj, [], "repaired"
+        except ValueError:
+            pass
+    plan, complete = _salvage_sections(text, sections)
+    missing = [sec for sec in sections if sec not in complete]
+    status = "repaired" if complete or any(plan.values()) else "failed"
+    return plan, missing, status
+
+
+def _as_text(v):
+    if v is None: return ""
+    if isinstance(v, (list, dict)): return json.dumps(v, ensure_ascii=False)
+    return str(v)
+
+
+def _bind_slot_id(item, label):
+    # 记下编号是给哪个 anchor/keyword 的：用户改了文字后写入时不再使用该编号
+    if isinstance(item.get("id"), str) and item["id"].strip():
+        item["id_anchor"] = label
+
+
+def _validate_plan(plan):
+    """
+    按方案结构校验并规整：丢弃不合格的条目，数值转字符串，列表按表头列数对齐。
+    返回 (规整后的方案, 丢弃的条目数)
+    """
+    clean = {sec: [] for sec in PLAN_SECTIONS}
+    dropped = 0
+    for item in plan.get("kv") or []:
+        if isinstance(item, dict) and isinstance(item.get("anchor"), str) and item["anchor"].strip():
+            item = dict(item)
+            item["val"] = _as_text(item.get("val"))
+            _bind_slot_id(item, item["anchor"])
+            clean["kv"].append(item)
+        else:
+            dropped += 1
+    for item in plan.get("checkbox") or []:
+        if isinstance(item, dict) and item.get("keyword") and item.get("status") is not None:
+            clean["checkbox"].append(dict(item, keyword=_as_text(item["keyword"]), status=_as_text(item["status"])))
+        else:
+            dropped += 1
+    for item in plan.get("lists") or []:
+        if not (isinstance(item, dict) and item.get("keyword") and isinstance(item.get("data", []), list)):
+            dropped += 1
+            continue
+        headers = item.get("headers") or []
+        if isinstance(headers, str):
+            headers = [h for h in re.split(r"\s*[,，、|]\s*", headers.strip()) if h]  # 偶尔整行表头写成一个字符串
+        if not isinstance(headers, list):
+            dropped += 1
+            continue
+        headers = [_as_text(h) for h in headers if h is not None]
+        data = [[_as_text(c) for c in row] if isinstance(row, list) else [_as_text(row)] for row in item.get("data") or []]
+        # 自动清洗表格列数 (防止报错)
+        if headers and data:
+            num_cols = len(headers)
+            data = [row[:num_cols] if len(row) > num_cols else row + [""] * (num_cols - len(row)) for row in data]
+        item = dict(item, keyword=_as_text(item["keyword"]), headers=headers, data=data)
+        _bind_slot_id(item, item["keyword"])
+        clean["lists"].append(item)
+    # 其他键 (如后续扩展字段) 原样保留
+    for k, v in plan.items():
+        if k not in clean: clean[k] = v
+    return clean, dropped
+
+
+def _request_missing_sections(client, user, old_data, target_structure, plan, sections):
+    """
+    只为缺失/截断的分区发一个小请求，并告知已完成的条目避免重复
+    """
+    done_kv = [item.get("anchor") for item in plan.get("kv", []) if isinstance(item, dict)]
+    done_lists = [item.get("keyword") for item in plan.get("lists", []) if isinstance(item, dict)]
+    done_cb = [item.get("keyword") for item in plan.get("checkbox", []) if isinstance(item, dict)]
+    id_note = "\n    kv 与 lists 项可带 \"id\" (目标表结构中的编号，不带 #)。" if "#T" in target_structure else ""
+    prompt = f"""
+    你之前为下面的表格生成的填写方案 JSON 被截断了，请**只补充**缺失的部分。
+
+    【源数据】
+    {old_data[:SOURCE_CHAR_BUDGET]}
+
+    【目标表结构】
+    {target_structure[:TEMPLATE_CHAR_BUDGET]}
+
+    【已完成，不要重复】
+    kv: {"、".join(filter(None, done_kv)) or "无"}
+    checkbox: {"、".join(filter(None, done_cb)) or "无"}
+    lists: {"、".join(filter(None, done_lists)) or "无"}
+
+    【输出】一个 JSON 对象，只包含这些键: {", ".join(sections)}。
+    kv 项格式 {{"anchor": "", "val": ""}}；checkbox 项格式 {{"keyword": "", "status": ""}}；
+    lists 项格式 {{"keyword": "", "headers": [], "data": [[]]}}。{id_note}
+    """
+    response = _chat_json(client, user, prompt, model="deepseek-chat", temperature=0.2, max_tokens=PLAN_MAX_TOKENS)
+    extra, _, _ = _parse_plan_output(response.choices[0].message.content, sections)
+    return extra
+
+
+def _local_hint(local_anchors, number):
+    if not local_anchors:
+        return ""
+    return f"""
+    {number}. **已由系统提取的字段**: {"、".join(local_anchors)} 已经填好，**不要**在 kv 中重复输出这些字段。
+"""
+
+
+def _slot_id_hint(target_structure, number, sections=("kv", "lists")):
+    """
+    模板结构带单元格编号时 (见 read_template_structure)，要求方案给出编号以便直接写入
+    """
+    if "#T" not in target_structure:
+        return ""
+    lines = []
+    if "kv" in sections:
+        lines.append('形如 #T0R1C1 的是可写入格子的编号 (空白格直接显示为编号，“此栏填写”类格子在文字后附编号)。'
+                     'kv 项请在 "id" 中给出要写入的格子编号 (不带 #)，如 {"id": "T0R1C1", "anchor": "姓名", "val": "张三"}。')
+    if "lists" in sections and "〔列表区" in target_structure:
+        lines.append('〔列表区 #T1R2 …〕 标出了列表的表头行，lists 项请在 "id" 中给出该编号 (不带 #)。')
+    if not lines:
+        return ""
+    lines.append("找不到合适的编号时省略 id，不要编造。")
+    return f"\n    {number}. **单元格编号**:\n" + "\n".join(f"       - {line}" for line in lines) + "\n"
+
+
+def _generate_plan_single(client, user, old_data, target_structure, local_anchors):
+    """
+    一次请求输出全部分区
+    """
+    local_hint = _local_hint(local_anchors, 4) + _slot_id_hint(target_structure, 5 if local_anchors else 4)
+    old_data = select_source_passages(old_data, target_structure)
     prompt = f"""
     你是一个专业的数据迁移专家。
 
     【源数据】
-    {old_data[:12000]} 
+    {old_data[:SOURCE_CHAR_BUDGET]}
 
     【目标表结构】
-    {target_structure[:4000]}
+    {target_structure[:TEMPLATE_CHAR_BUDGET]}
 
     【必须严格执行的指令】
     1. **全面提取 KV (基础信息 + 软信息)**:
@@ -112,7 +921,7 @@ def generate_filling_plan_v2(client, old_data, target_structure):
     3. **Checkbox (勾选框)**:
        - 寻找“□”符号。
        - 输出 keyword (选项文字) 和 status (有/无/是/否)。
-
+{local_hint}
     【输出格式 (JSON)】
     {{
         "kv": [
@@ -134,43 +943,213 @@ def generate_filling_plan_v2(client, old_data, target_structure):
         ]
     }}
     """
-    response = client.chat.completions.create(
+    response = _chat_json(
+        client, user, prompt,
         model="deepseek-chat",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.25  # 微调温度，平衡创造性(软信息)和准确性(基础信息)
+        temperature=0.25,  # 微调温度，平衡创造性(软信息)和准确性(基础信息)
+        max_tokens=PLAN_MAX_TOKENS
     )
-    content = response.choices[0].message.content
-    content = re.sub(r'```json\s*|\s*```', '', content)
+    plan, missing, status = _parse_plan_output(response.choices[0].message.content)
+    record_metric("plan_parse_total")
+    record_metric(f"plan_parse_{status}")
+
+    # 输出残缺时，只针对缺失的分区补一次，而不是整体重跑
+    if missing:
+        record_metric("plan_followup_requests")
+        try:
+            extra = _request_missing_sections(client, user, old_data, target_structure, plan, missing)
+            for sec in missing:
+                plan[sec] = list(plan.get(sec) or []) + list(extra.get(sec) or [])
+        except Exception:
+            record_metric("plan_followup_failed")
+
+    return plan
+
+
+# ----- 分区并发模式：kv / checkbox / lists 各发一个更短的请求 -----
+# 生成耗时主要取决于输出长度，三个分区互不依赖，拆开并发后总耗时约等于最长的那个分区。
+# 源数据不再整份重复三次：检索预算按下表在实际发出的分区间分配，各分区只带与自己那部分模板相关的段落，
+# 合计与单次请求的源数据量相当。
+PLAN_MODE = os.getenv("PLAN_MODE", "single")  # single / split
+CHECKBOX_MARKS = ("□", "☐", "■", "☑", "☒")
+SECTION_MAX_TOKENS = {"kv": PLAN_MAX_TOKENS, "checkbox": 2048, "lists": PLAN_MAX_TOKENS}
+SECTION_SOURCE_SHARE = {"kv": 0.5, "checkbox": 0.15, "lists": 0.35}
+
+_SECTION_RULES = {
+    "kv": """
+    1. **全面提取 KV (基础信息 + 软信息)**:
+       - **基础信息**: 必须地毯式提取所有短字段！包括“学号”、“性别”、“民族”、“籍贯”、“政治面貌”、“出生年月”等。不要因为它们简单就忽略！
+       - **软信息**: 对于“自我鉴定”、“主要事迹”等长文本，如果源数据没有，请**根据简历事实自动撰写**，禁止留空。
+    2. 多行表格 (有明确表头的明细) 和勾选框 (□) 由其他任务处理，这里**不要**输出。
+""",
+    "checkbox": """
+    1. 下面列出的是目标表中带“□”符号的内容，逐个选项判断。
+    2. 输出 keyword (选项文字) 和 status (有/无/是/否)。
+""",
+    "lists": """
+    1. 凡是目标表中有明确表头（如：时间|课程|成绩）的，必须提取为 `lists`。
+    2. **严格对齐**: `headers` 列数必须与 `data` 列数一致。
+""",
+}
+
+_SECTION_EXAMPLES = {
+    "kv": """{
+        "kv": [
+            {"anchor": "姓名", "val": "张三"},
+            {"anchor": "学号", "val": "20201101"},
+            {"anchor": "自我鉴定", "val": "本人在校期间..."}
+        ]
+    }""",
+    "checkbox": """{
+        "checkbox": [
+            {"keyword": "党员", "status": "有"},
+            {"keyword": "英语六级", "status": "无"}
+        ]
+    }""",
+    "lists": """{
+        "lists": [
+            {
+                "keyword": "获奖情况",
+                "headers": ["时间", "奖项", "等级"],
+                "data": [["2023.09", "一等奖", "校级"]]
+            }
+        ]
+    }""",
+}
 
+
+def _section_structure(target_structure, sec):
+    """
+    按分区裁剪目标表结构：勾选框只看带 □ 的行，多行表格只看表格区，kv 看全部。
+    返回空串表示模板里没有该分区的内容，不必请求。
+    """
+    if sec == "kv":
+        return target_structure
+    blocks = target_structure.split("\n\n")
+    if sec == "lists":
+        return "\n\n".join(b for b in blocks if b.startswith("【表格区"))
+    kept = []
+    for block in blocks:
+        title, _, body = block.partition("\n")
+        lines = [line for line in body.split("\n") if any(m in line for m in CHECKBOX_MARKS)]
+        if lines:
+            kept.append(title + "\n" + "\n".join(lines))
+    return "\n\n".join(kept)
+
+
+def _generate_section(client, user, sec, old_data, structure, extra_rules="", cancel_event=None):
+    """
+    单个分区的请求 (在线程池中执行)，返回 (该分区条目列表, 耗时秒)
+    """
+    _call_context.cancel_event = cancel_event
+    t0 = time.perf_counter()
     try:
-        plan = json.loads(content)
+        prompt = f"""
+    你是一个专业的数据迁移专家。本次只负责填写方案中的 {sec} 部分。
 
-        # 自动清洗表格列数 (防止报错)
-        if "lists" in plan:
-            for lst in plan["lists"]:
-                headers = lst.get("headers", [])
-                data = lst.get("data", [])
-                if headers and data:
-                    num_cols = len(headers)
-                    cleaned_data = []
-                    for row in data:
-                        if len(row) > num_cols:
-                            cleaned_data.append(row[:num_cols])
-                        elif len(row) < num_cols:
-                            cleaned_data.append(row + [""] * (num_cols - len(row)))
-                        else:
-                            cleaned_data.append(row)
-                    lst["data"] = cleaned_data
+    【源数据】
+    {old_data[:SOURCE_CHAR_BUDGET]}
 
-        return plan
-    except:
-        return {"kv": [], "checkbox": [], "lists": []}
+    【目标表结构】
+    {structure[:TEMPLATE_CHAR_BUDGET]}
+
+    【必须严格执行的指令】
+{_SECTION_RULES[sec]}{extra_rules}
+    【输出格式 (JSON)，只包含 {sec} 一个键】
+    {_SECTION_EXAMPLES[sec]}
+    """
+        response = _chat_json(client, user, prompt, model="deepseek-chat", temperature=0.25,
+                              max_tokens=SECTION_MAX_TOKENS[sec])
+        part, missing, status = _parse_plan_output(response.choices[0].message.content, (sec,))
+        record_metric("plan_parse_total")
+        record_metric(f"plan_parse_{status}")
+        items = list(part.get(sec) or [])
+        if missing:
+            record_metric("plan_followup_requests")
+            try:
+                extra = _request_missing_sections(client, user, old_data, structure, part, missing)
+                items += list(extra.get(sec) or [])
+            except Exception:
+                record_metric("plan_followup_failed")
+        return items, time.perf_counter() - t0
+    finally:
+        _call_context.cancel_event = None
+
+
+def _generate_plan_split(client, user, old_data, target_structure, local_anchors):
+    """
+    kv / checkbox / lists 并发请求后合并；模板里没有勾选框或表格时对应请求直接省掉。
+    各分区耗时记入运行指标 plan_section_<分区>_ms / plan_section_<分区>_calls。
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    cancel_event = getattr(_call_context, "cancel_event", None)
+    t0 = time.perf_counter()
+    plan = {sec: [] for sec in PLAN_SECTIONS}
+    structures = {}
+    for sec in PLAN_SECTIONS:
+        structure = _section_structure(target_structure, sec)
+        if structure.strip():
+            structures[sec] = structure
+        else:
+            record_metric("plan_sections_skipped")
+    share_total = sum(SECTION_SOURCE_SHARE[sec] for sec in structures)
+    # 源数据放得进 RETRIEVAL_CHAR_BUDGET 时与单次请求一样整份发送；超出时才按分区切分预算各自检索
+    split_budget = bool(RETRIEVAL_CHAR_BUDGET) and len(old_data or "") > RETRIEVAL_CHAR_BUDGET
+    with ThreadPoolExecutor(max_workers=len(PLAN_SECTIONS)) as pool:
+        futures = {}
+        for sec, structure in structures.items():
+            extra_rules = ""
+            if sec == "kv":
+                extra_rules = _local_hint(local_anchors, 3) + _slot_id_hint(structure, 4 if local_anchors else 3, ("kv",))
+            elif sec == "lists":
+                extra_rules = _slot_id_hint(structure, 3, ("lists",))
+            if split_budget:
+                # 每个分区按自己的那部分模板、在分到的预算内检索源数据
+                budget = int(RETRIEVAL_CHAR_BUDGET * SECTION_SOURCE_SHARE[sec] / share_total)
+                source = select_source_passages(old_data, structure, budget)
+            else:
+                source = old_data
+            record_metric(f"plan_section_{sec}_source_chars", len(source or ""))
+            futures[sec] = pool.submit(_generate_section, client, user, sec, source, structure,
+                                       extra_rules, cancel_event)
+        for sec, fut in futures.items():
+            plan[sec], seconds = fut.result()
+            record_metric(f"plan_section_{sec}_ms", round(seconds * 1000))
+            record_metric(f"plan_section_{sec}_calls")
+    record_metric("plan_split_wall_ms", round((time.perf_counter() - t0) * 1000))
+    record_metric("plan_split_calls")
+    return plan
+
+
+def generate_filling_plan_v2(client, old_data, target_structure, user="", mode=None):
+    """
+    mode: single (默认，一次请求) / split (按分区并发请求)，未指定时取环境变量 PLAN_MODE
+    """
+    # 先本地提取结构化短字段，模型只需要补剩下的部分
+    local_kv, local_requested = extract_local_fields(old_data, target_structure)
+    record_metric("local_fields_requested", local_requested)
+    record_metric("local_fields_hit", len(local_kv))
+    local_anchors = [item["anchor"] for item in local_kv]
+
+    if (mode or PLAN_MODE) == "split":
+        plan = _generate_plan_split(client, user, old_data, target_structure, local_anchors)
+    else:
+        plan = _generate_plan_single(client, user, old_data, target_structure, local_anchors)
+
+    plan, dropped = _validate_plan(plan)
+    if dropped: record_metric("plan_items_dropped", dropped)
+
+    # 合并：本地规则结果优先 (源数据原文)，模型重复输出的同名字段丢弃
+    llm_kv = [item for item in plan.get("kv", []) if item.get("anchor") not in local_anchors]
+    plan["kv"] = local_kv + llm_kv
+    return plan
 
 
-def refine_text_v2(client, original_text, instruction):
+def refine_text_v2(client, original_text, instruction, user=""):
     prompt = f"原文：{original_text}\n指令：{instruction}\n请输出修改后的结果："
-    response = client.chat.completions.create(
-        model="deepseek-chat", messages=[{"role": "user", "content": prompt}]
+    response = _chat(
+        client, user, model="deepseek-chat", messages=[{"role": "user", "content": prompt}]
     )
     return response.choices[0].message.content
 
@@ -181,6 +1160,10 @@ def force_write_cell(cell, text, alignment="auto"):
     """
     格式美化：清除原有格式，自动判断居中或左对齐
     """
+    from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
+    from docx.oxml.ns import qn
+    from docx.shared import Pt, RGBColor
+
     # 保护性检查：如果 text 是 None，转为空字符串
     if text is None: text = ""
 
@@ -203,9 +1186,13 @@ def force_write_cell(cell, text, alignment="auto"):
 
 
 def get_next_distinct_cell(row, current_idx):
-    current_cell = row.cells[current_idx]
-    for i in range(current_idx + 1, len(row.cells)):
-        next_cell = row.cells[i]
+    return _next_distinct_cell(row.cells, current_idx)
+
+
+def _next_distinct_cell(cells, current_idx):
+    current_cell = cells[current_idx]
+    for i in range(current_idx + 1, len(cells)):
+        next_cell = cells[i]
         if next_cell._element is not current_cell._element:
             return next_cell
     return None
@@ -268,11 +1255,26 @@ def get_fuzzy_score(anchor, target_text):
     return difflib.SequenceMatcher(None, a, t).ratio()
 
 
+def _fuzzy_over(anchor, target_text, threshold):
+    """
+    等价于 get_fuzzy_score(...) > threshold，但先用 SequenceMatcher 的廉价上界排除明显不匹配的单元格
+    """
+    a = anchor.replace(" ", "").replace("\n", "").lower()
+    t = target_text.replace(" ", "").replace("\n", "").lower()
+    if not a or not t: return False
+    if a in t: return True
+    sm = difflib.SequenceMatcher(None, a, t)
+    return sm.real_quick_ratio() > threshold and sm.quick_ratio() > threshold and sm.ratio() > threshold
+
+
 # --- 辅助函数：设置单元格为纵向合并的“继续”状态 ---
 def set_cell_merge_continue(cell):
     """
     修改单元格 XML，使其属性变为 vMerge="continue" (即合并单元格的非首行部分)
     """
+    from docx.oxml import OxmlElement
+    from docx.oxml.ns import qn
+
     tc = cell._tc
     tcPr = tc.get_or_add_tcPr()
     # 查找现有的 vMerge
@@ -320,10 +1322,230 @@ def find_column_index_by_header(row, header_texts):
                 mapping[h] = idx
     return mapping
 
-def execute_word_writing_v2(plan, template_path, output_path, progress_callback=None):
+# ================= 补丁式保存 (只重写改动过的 XML 部件) =================
+# python-docx 的 doc.save() 会把所有部件 (包括动辄十几 MB 的图片、字体) 解压再重新压缩。
+# 补丁模式下：打开时用空占位替换二进制部件，写入完成后只序列化内容有变化的 XML 部件，
+# 其余 zip 成员按原始压缩字节原样拷贝，不解压也不重新压缩。
+WRITER_MODE = os.getenv("WRITER_MODE", "patch")  # patch / docx
+
+
+class _PatchUnsupported(Exception):
+    pass
+
+
+def _is_xml_member(name):
+    return name.endswith(".xml") or name.endswith(".rels")
+
+
+def _open_lightweight(template_path):
+    """
+    只解压 XML 部件来构造 Document，二进制部件用空字节占位。
+    返回 (doc, 打开时各 XML 部件的序列化快照)。
+    """
+    import io
+    from docx import Document
+    from docx.opc.part import XmlPart
+
+    buf = io.BytesIO()
+    with zipfile.ZipFile(template_path) as zin, zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zlight:
+        for info in zin.infolist():
+            zlight.writestr(info.filename, zin.read(info) if _is_xml_member(info.filename) else b"")
+    buf.seek(0)
+    doc = Document(buf)
+    snapshot = {str(p.partname): (p.blob if isinstance(p, XmlPart) else None) for p in doc.part.package.iter_parts()}
+    return doc, (snapshot, _rels_signature(doc))
+
+
+def _rels_signature(doc):
+    package = doc.part.package
+    sig = [("/", tuple(sorted(package.rels)))]
+    for p in package.iter_parts():
+        sig.append((str(p.partname), tuple(sorted(p.rels))))
+    return sig
+
+
+def _copy_zip_member_raw(zin, zout, info):
+    """
+    把 zin 中的成员按原始 (已压缩) 字节拷贝到 zout，不经过解压/重新压缩
+    """
+    import struct
+    zin.fp.seek(info.header_offset)
+    header = zin.fp.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"本地文件头损坏: {info.filename}")
+    name_len, extra_len = struct.unpack("<HH", header[26:30])
+    zin.fp.seek(info.header_offset + zipfile.sizeFileHeader + name_len + extra_len)
+
+    new_info = copy(info)
+    new_info.flag_bits &= ~0x08  # 长度和 CRC 直接写在本地文件头里，不再附加数据描述符
+    new_info.header_offset = zout.fp.tell()
+    zout.fp.write(new_info.FileHeader())
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = zin.fp.read(min(remaining, 1024 * 1024))
+        if not chunk:
+            raise zipfile.BadZipFile(f"成员数据不完整: {info.filename}")
+        zout.fp.write(chunk)
+        remaining -= len(chunk)
+    zout.filelist.append(new_info)
+    zout.NameToInfo[new_info.filename] = new_info
+    zout.start_dir = zout.fp.tell()
+    zout._didModify = True
+
+
+def _save_patched(doc, snapshot, template_path, output_path):
+    from docx.opc.part import XmlPart
+
+    snapshot, rels_sig = snapshot
+    parts = {str(p.partname): p for p in doc.part.package.iter_parts()}
+    if set(parts) != set(snapshot) or _rels_signature(doc) != rels_sig:
+        raise _PatchUnsupported("写入过程中新增/删除了部件或关系")
+    changed = {}
+    for name, part in parts.items():
+        if isinstance(part, XmlPart):
+            blob = part.blob
+            if blob != snapshot[name]:
+                changed[name.lstrip("/")] = blob
+
+    with zipfile.ZipFile(template_path) as zin, zipfile.ZipFile(output_path, "w", zipfile.ZIP_DEFLATED) as zout:
+        for info in zin.infolist():
+            if info.filename in changed:
+                new_info = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+                new_info.compress_type = zipfile.ZIP_DEFLATED
+                new_info.external_attr = info.external_attr
+                zout.writestr(new_info, changed.pop(info.filename))
+            else:
+                _copy_zip_member_raw(zin, zout, info)
+    if changed:
+        os.remove(output_path)
+        raise _PatchUnsupported(f"无法定位需要更新的部件: {list(changed)}")
+
+
+# ================= 模板预处理 (与方案无关，可在等待大模型时提前完成) =================
+PREPARED_TEMPLATE_MAX = int(os.getenv("PREPARED_TEMPLATE_MAX", "8"))
+
+_prepared_templates = OrderedDict()
+_prepared_lock = threading.Lock()
+
+
+def _has_nested_table(tc):
+    return tc.find(".//" + _W + "tbl") is not None
+
+
+def _build_cell_index(doc):
+    """
+    按 doc.tables -> rows -> cells 的遍历顺序缓存每个单元格 (所在行的单元格列表, 列号, 单元格, 文本)。
+    KV 和勾选框阶段不改变表格结构，只需在写入后刷新对应单元格的文本。
+    同时按模板序列化时的编号建立 格子编号 -> 单元格、列表区编号 -> (表格, 表头行) 的映射。
+    """
+    entries, by_tc, texts, row_table = [], {}, {}, {}
+    for table in doc.tables:
+        for row in table.rows:
+            row_table[row._tr] = table
+            cells = row.cells
+            for c_idx, cell in enumerate(cells):
+                tc = cell._tc
+                if tc not in texts: texts[tc] = cell.text  # 合并单元格只取一次文本
+                entry = [cells, c_idx, cell, texts[tc]]
+                entries.append(entry)
+                by_tc.setdefault(tc, []).append(entry)
+
+    # 与 _read_docx(slot_ids=True) 的规则一致：空白格/填写区可写入，非空行之后紧跟空白行即为列表区
+    by_id, rows, blank = {}, [], {}
+    for sid, el in _iter_slot_ids(doc.element.body):
+        if el.tag == _W + "tr":
+            rows.append((sid, el))
+            blank[sid] = True
+            continue
+        text = texts.get(el)  # 纵向合并的续格不在 python-docx 的 cells 中
+        if text is None: continue
+        nested = _has_nested_table(el)
+        if text.strip() or nested: blank[rows[-1][0]] = False
+        if _is_slot_text(text) and not nested: by_id[sid] = by_tc[el][0]
+    regions = {}
+    for (sid, tr), (next_sid, _) in zip(rows, rows[1:]):
+        same_table = sid.split("R")[0] == next_sid.split("R")[0]
+        if same_table and not blank[sid] and blank[next_sid] and tr in row_table:
+            regions[sid] = (row_table[tr], tr)
+    return {"entries": entries, "by_tc": by_tc, "by_id": by_id, "regions": regions}
+
+
+def _slot_id(item, label):
+    """
+    条目的格子编号。生成方案时记下了编号对应的 anchor/keyword (id_anchor)，
+    用户之后改了 anchor/keyword 的话编号就不再可信，返回 None 按文字重新定位
+    """
+    sid = item.get("id")  # 编辑器新增的行没有编号 (NaN)
+    if not isinstance(sid, str): return None
+    bound = item.get("id_anchor")
+    if isinstance(bound, str) and bound != label:
+        record_metric("slot_id_stale")
+        return None
+    return sid.strip().lstrip("#")
+
+
+def _reindex_cell(index, cell):
+    text = cell.text
+    for entry in index["by_tc"].get(cell._tc, []):
+        entry[3] = text
+
+
+def prepare_template(template_path, mode=None):
+    """
+    打开模板并建立单元格索引，返回一次性的写入状态 (写入会修改其中的文档)
+    """
+    mode = mode or WRITER_MODE
+    if mode == "patch":
+        doc, snapshot = _open_lightweight(template_path)
+    else:
+        from docx import Document
+        doc, snapshot = Document(template_path), None
+    return {"mode": mode, "doc": doc, "snapshot": snapshot, "index": _build_cell_index(doc)}
+
+
+def stash_prepared_template(template_hash, prepared):
+    with _prepared_lock:
+        _prepared_templates[template_hash] = prepared
+        _prepared_templates.move_to_end(template_hash)
+        while len(_prepared_templates) > PREPARED_TEMPLATE_MAX:
+            _prepared_templates.popitem(last=False)
+
+
+def take_prepared_template(template_hash):
+    with _prepared_lock:
+        return _prepared_templates.pop(template_hash, None)
+
+
+def execute_word_writing_v2(plan, template_path, output_path, progress_callback=None, mode=None, prepared=None):
+    """
+    prepared: prepare_template 的结果 (可选)，传入后跳过打开模板和建立索引
+    """
     if not zipfile.is_zipfile(template_path):
         raise ValueError("目标文件格式错误")
-    doc = Document(template_path)
+    mode = mode or WRITER_MODE
+    if prepared is not None and prepared["mode"] != mode:
+        prepared = None
+    if prepared is not None: record_metric("prepared_template_used")
+    if mode == "patch":
+        try:
+            prepared = prepared or prepare_template(template_path, mode)
+            _apply_plan(prepared["doc"], plan, progress_callback, prepared["index"])
+            _save_patched(prepared["doc"], prepared["snapshot"], template_path, output_path)
+            if progress_callback: progress_callback(100, "完成")
+            return
+        except (_PatchUnsupported, zipfile.BadZipFile, KeyError):
+            prepared = None  # 模板结构特殊，退回完整保存
+    prepared = prepared or prepare_template(template_path, "docx")
+    _apply_plan(prepared["doc"], plan, progress_callback, prepared["index"])
+    prepared["doc"].save(output_path)
+    if progress_callback: progress_callback(100, "完成")
+
+
+def _apply_plan(doc, plan, progress_callback=None, index=None):
+    """
+    把方案写入已打开的 Document (KV -> 勾选框 -> 列表)，不负责保存
+    """
+    if index is None: index = _build_cell_index(doc)
 
     # ---------------- 1. KV 写入 ----------------
     total_kv = len(plan.get("kv", []))
@@ -333,46 +1555,51 @@ def execute_word_writing_v2(plan, template_path, output_path, progress_callback=
 
         if progress_callback: progress_callback(int(10 + (i / total_kv) * 30), f"正在写入: {anchor}...")
 
-        found = False
-        for table in doc.tables:
-            for row in table.rows:
-                for c_idx, cell in enumerate(row.cells):
-                    cell_text = cell.text.strip().replace(" ", "")
-                    clean_anchor = anchor.strip().replace(" ", "")
-                    match_score = get_fuzzy_score(clean_anchor, cell_text)
-
-                    if match_score > 0.8:
-                        target_cell = None
-                        # 大格子逻辑 (自我鉴定)
-                        if len(cell_text) > 20 or "此栏" in cell_text or "填写" in cell_text:
-                            target_cell = cell
-                            # 普通 KV 逻辑 (学号、姓名)
-                        else:
-                            candidate = get_next_distinct_cell(row, c_idx)
-                            if candidate: target_cell = candidate
-
-                        if target_cell:
-                            # 保护机制：防止覆盖表头
-                            # 如果目标格子很短，且包含冒号或看起来像另一个表头，跳过
-                            if len(target_cell.text) < 10 and ("：" in target_cell.text or ":" in target_cell.text):
-                                pass
-                            else:
-                                force_write_cell(target_cell, val, alignment="auto")
-                                found = True
-                                break
-                if found: break
-            if found: break
+        # 方案给出了格子编号：直接写入；编号无效时退回按 anchor 模糊定位
+        sid = _slot_id(item, anchor)
+        entry = index["by_id"].get(sid) if sid else None
+        if entry is not None:
+            force_write_cell(entry[2], val, alignment="auto")
+            _reindex_cell(index, entry[2])
+            record_metric("slot_id_writes")
+            continue
+        if sid: record_metric("slot_id_fallbacks")
+
+        clean_anchor = anchor.strip().replace(" ", "")
+        for cells, c_idx, cell, text in index["entries"]:
+            cell_text = text.strip().replace(" ", "")
+
+            if _fuzzy_over(clean_anchor, cell_text, 0.8):
+                target_cell = None
+                # 大格子逻辑 (自我鉴定)
+                if len(cell_text) > 20 or "此栏" in cell_text or "填写" in cell_text:
+                    target_cell = cell
+                    # 普通 KV 逻辑 (学号、姓名)
+                else:
+                    candidate = _next_distinct_cell(cells, c_idx)
+                    if candidate: target_cell = candidate
+
+                if target_cell and _has_nested_table(target_cell._tc):
+                    target_cell = None  # 清空格子会删掉其中的嵌套表格
+                if target_cell:
+                    # 保护机制：防止覆盖表头
+                    # 如果目标格子很短，且包含冒号或看起来像另一个表头，跳过
+                    target_text = index["by_tc"][target_cell._tc][0][3]
+                    if len(target_text) < 10 and ("：" in target_text or ":" in target_text):
+                        pass
+                    else:
+                        force_write_cell(target_cell, val, alignment="auto")
+                        _reindex_cell(index, target_cell)
+                        break
 
     # ---------------- 2. Checkbox 写入 (新版匹配逻辑) ----------------
     if progress_callback: progress_callback(60, "处理勾选框...")
     for item in plan.get("checkbox", []):
         keyword, status = item["keyword"], item["status"]
-        for table in doc.tables:
-            for row in table.rows:
-                for cell in row.cells:
-                    # 只有当关键字匹配时才尝试打钩
-                    if keyword in cell.text:
-                        handle_checkbox(cell, status)
+        for cells, c_idx, cell, text in index["entries"]:
+            # 只有当关键字匹配时才尝试打钩
+            if keyword in text:
+                if handle_checkbox(cell, status): _reindex_cell(index, cell)
 
     # 3. Lists 写入 (✨ 修复表头被顶飞的问题 ✨)
     if progress_callback: progress_callback(80, "处理表格列表...")
@@ -384,23 +1611,34 @@ def execute_word_writing_v2(plan, template_path, output_path, progress_callback=
 
         if not data: continue
 
-        # A. 定位锚点
+        # A. 定位锚点：优先按列表区编号 (表头行) 直接定位，否则按关键字搜索
         target_table = None
         anchor_row_idx = -1
         anchor_col_idx = -1
 
         found = False
-        for t_idx, table in enumerate(doc.tables):
-            for r_idx, row in enumerate(table.rows):
-                for c_idx, cell in enumerate(row.cells):
-                    if keyword in cell.text:
-                        target_table = table
-                        anchor_row_idx = r_idx
-                        anchor_col_idx = c_idx
-                        found = True
-                        break
+        sid = _slot_id(item, keyword)
+        region = index["regions"].get(sid) if sid else None
+        if region is not None:
+            target_table, header_tr = region
+            anchor_row_idx = target_table._tbl.tr_lst.index(header_tr)  # 前面的列表可能已插入行，现算行号
+            anchor_col_idx = next((c_idx for c_idx, cell in enumerate(target_table.rows[anchor_row_idx].cells)
+                                   if keyword in cell.text), 0)
+            found = True
+            record_metric("slot_id_writes")
+        else:
+            if sid: record_metric("slot_id_fallbacks")
+            for t_idx, table in enumerate(doc.tables):
+                for r_idx, row in enumerate(table.rows):
+                    for c_idx, cell in enumerate(row.cells):
+                        if keyword in cell.text:
+                            target_table = table
+                            anchor_row_idx = r_idx
+                            anchor_col_idx = c_idx
+                            found = True
+                            break
+                    if found: break
                 if found: break
-            if found: break
 
         if not found:
             continue
@@ -413,8 +1651,8 @@ def execute_word_writing_v2(plan, template_path, output_path, progress_callback=
         header_map = find_column_index_by_header(target_table.rows[anchor_row_idx], headers)
         data_start_row = anchor_row_idx  # 默认从锚点行开始算
 
-        # 策略：向下一行探测
-        if anchor_row_idx + 1 < len(target_table.rows):
+        # 策略：向下一行探测 (按编号定位时锚点行就是表头行，无需探测)
+        if region is None and anchor_row_idx + 1 < len(target_table.rows):
             next_row = target_table.rows[anchor_row_idx + 1]
             next_row_text = "".join([c.text for c in next_row.cells]).strip()
 
@@ -513,5 +1751,281 @@ def execute_word_writing_v2(plan, template_path, output_path, progress_callback=
 
             cursor_row_idx += 1
 
-    doc.save(output_path)
-    if progress_callback: progress_callback(100, "完成")
\ No newline at end of file
+# ================= 步骤 1 流水线 (大模型请求在途时并行预处理模板) =================
+def _prepare_quietly(template_path):
+    try:
+        return prepare_template(template_path)
+    except Exception:
+        return None  # 预处理只是加速手段，失败时步骤 3 再按常规方式打开
+
+
+def _read_step1_inputs(pool, template_path, source_path, source_text, source_char_budget, template_text=None):
+    f_new = pool.submit(read_template_structure, template_path) if template_text is None else None
+    if source_text is None and isinstance(source_path, (list, tuple)):
+        source_text = pool.submit(read_sources, source_path, source_char_budget).result()
+    elif source_text is None:
+        source_text = pool.submit(read_file_content, source_path, None, source_char_budget).result()
+    return source_text, (f_new.result() if f_new else template_text)
+
+
+def run_step1_pipeline(client, template_path, source_path=None, source_text=None, template_hash=None, user="",
+                       source_char_budget=None, template_text=None, cancel_event=None):
+    """
+    1. 模板结构与源文件并发读取 (已读过的可直接传入 source_text / template_text)；
+       source_path 也可以是 [(文件名, 路径), ...]，多个源文件并发读取后合并 (见 read_sources)
+    2. 发出大模型请求的同时，在后台线程打开模板、建立单元格索引
+    准备好的写入状态按 template_hash 暂存，步骤 3 渲染时直接取用。
+    返回 (方案, 源文本, 写入状态或 None)
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        source_text, new_txt = _read_step1_inputs(pool, template_path, source_path, source_text,
+                                                  source_char_budget, template_text)
+        if cancel_event is not None and cancel_event.is_set():
+            raise llm_scheduler.Cancelled()
+
+        f_prep = pool.submit(_prepare_quietly, template_path)
+        _call_context.cancel_event = cancel_event
+        try:
+            plan = generate_filling_plan_v2(client, source_text, new_txt, user=user)
+        finally:
+            _call_context.cancel_event = None
+        prepared = f_prep.result()
+    if cancel_event is not None and cancel_event.is_set():
+        raise llm_scheduler.Cancelled()
+    if prepared is not None and template_hash:
+        stash_prepared_template(template_hash, prepared)
+    return plan, source_text, prepared
+
+
+# ================= 投机预取 (输入就绪即在后台开始，点击开始时直接取结果) =================
+# 键由输入内容的哈希构成；输入变化时旧的预取被取消。仍在排队的大模型请求会立即让出名额，
+# 已经发出的请求无法中止，其结果直接丢弃。
+SPECULATION_TTL_SECONDS = int(os.getenv("SPECULATION_TTL_SECONDS", "600"))
+SPECULATION_WORKERS = int(os.getenv("SPECULATION_WORKERS", "4"))
+
+_speculations = {}
+_speculation_lock = threading.Lock()
+_speculation_pool = None
+
+
+def speculation_key(*parts):
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+
+def _speculate(cancel_event, client, template_path, source_path, source_text, template_hash, user,
+               source_char_budget, with_plan):
+    if with_plan:
+        plan, source_text, _ = run_step1_pipeline(client, template_path, source_path, source_text, template_hash,
+                                                  user, source_char_budget, cancel_event=cancel_event)
+        return {"plan": plan, "source_text": source_text, "template_text": None}
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        source_text, template_text = _read_step1_inputs(pool, template_path, source_path, source_text,
+                                                        source_char_budget)
+    return {"plan": None, "source_text": source_text, "template_text": template_text}
+
+
+def start_speculation(key, make_client, template_path, source_path=None, source_text=None, template_hash=None, user="",
+                      source_char_budget=None, with_plan=False):
+    """
+    在后台开始读取输入 (with_plan=True 时连同方案一起生成)。同一个键重复调用不会重复提交。
+    make_client: 返回大模型客户端的函数，只在真正提交新的预取时调用 (页面每次重跑都会调用本函数)
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    global _speculation_pool
+
+    with _speculation_lock:
+        now = time.time()
+        for old_key in [k for k, e in _speculations.items() if now - e["created_at"] > SPECULATION_TTL_SECONDS]:
+            entry = _speculations.pop(old_key)
+            entry["cancel"].set()
+            entry["future"].cancel()
+        if key in _speculations: return
+    client = make_client()
+    with _speculation_lock:
+        if key in _speculations: return
+        if _speculation_pool is None:
+            _speculation_pool = ThreadPoolExecutor(max_workers=SPECULATION_WORKERS, thread_name_prefix="speculate")
+        cancel_event = threading.Event()
+        future = _speculation_pool.submit(_speculate, cancel_event, client, template_path, source_path, source_text,
+                                          template_hash, user, source_char_budget, with_plan)
+        _speculations[key] = {"future": future, "cancel": cancel_event, "created_at": now}
+    record_metric("speculation_started")
+
+
+def cancel_speculation(key):
+    with _speculation_lock:
+        entry = _speculations.pop(key, None)
+    if entry is None: return
+    entry["cancel"].set()
+    entry["future"].cancel()
+    record_metric("speculation_cancelled")
+
+
+def take_speculation(key):
+    """
+    取走预取结果 (仍在进行时等待其完成)。没有预取或预取失败时返回 None，由调用方按常规流程执行。
+    返回 {"plan": 方案或 None, "source_text", "template_text"}
+    """
+    with _speculation_lock:
+        entry = _speculations.pop(key, None) if key else None
+    if entry is None:
+        return None
+    try:
+        result = entry["future"].result()
+    except Exception:
+        record_metric("speculation_failed")
+        return None
+    record_metric("speculation_used")
+    return result
+
+
+# ================= 批量填表 (一份源数据 -> 多个模板) =================
+def _fill_one_template(client, old_data, template_path, output_path, user=""):
+    """
+    单个模板的完整流水线：预检 -> 读取结构 -> 生成方案 (同时预处理模板) -> 写入
+    """
+    valid, msg = validate_file_format(template_path)
+    if not valid:
+        raise ValueError(msg)
+    plan, _, prepared = run_step1_pipeline(client, template_path, source_text=old_data, user=user)
+    execute_word_writing_v2(plan, template_path, output_path, prepared=prepared)
+    return plan
+
+
+def run_multi_template_job(client, old_data, template_items, work_dir, max_workers=4, progress_callback=None, user=""):
+    """
+    一次读取源数据，并发为多个模板生成方案并写入，最终打包为一个 zip。
+    template_items: [(显示文件名, 模板路径), ...]
+    返回 (zip 字节, 结果列表)，结果列表每项为 {"name", "ok", "error"}。
+    总耗时约等于最慢的单个模板，而不是所有模板之和。
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    import io
+
+    results = []
+    outputs = {}
+    total = len(template_items)
+    if total == 0:
+        raise ValueError("没有可处理的模板")
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, total))) as pool:
+        futures = {}
+        for idx, (name, path) in enumerate(template_items):
+            out_path = os.path.join(work_dir, f"result_{idx}.docx")
+            futures[pool.submit(_fill_one_template, client, old_data, path, out_path, user)] = (idx, name, out_path)
+
+        done = 0
+        for fut in as_completed(futures):
+            idx, name, out_path = futures[fut]
+            done += 1
+            try:
+                fut.result()
+                outputs[idx] = (name, out_path)
+                results.append({"name": name, "ok": True, "error": ""})
+            except Exception as e:
+                results.append({"name": name, "ok": False, "error": str(e)})
+            if progress_callback: progress_callback(int(done / total * 100), f"已完成 {done}/{total}: {name}")
+
+    # 按上传顺序打包，重名文件自动加序号
+    buf = io.BytesIO()
+    used_names = set()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        for idx in sorted(outputs):
+            name, out_path = outputs[idx]
+            base, ext = os.path.splitext(name)
+            arc_name = f"WordToWord_V1.0_{base}{ext or '.docx'}"
+            n = 1
+            while arc_name in used_names:
+                n += 1
+                arc_name = f"WordToWord_V1.0_{base}_{n}{ext or '.docx'}"
+            used_names.add(arc_name)
+            zf.write(out_path, arc_name)
+        failed = [r for r in results if not r["ok"]]
+        if failed:
+            report = "\n".join([f"{r['name']}: {r['error']}" for r in failed])
+            zf.writestr("失败清单.txt", report)
+
+    return buf.getvalue(), results
+
+
+# ================= 生成结果缓存 (步骤 3 重复渲染直接命中) =================
+# 键 = (模板哈希, 规范化方案哈希, 写入方式, 写入器版本)。写入逻辑或模板编号规则有改动时请同步修改 WRITER_VERSION。
+# v2.3 补丁式保存，v2.4 按格子编号写入，v2.5 含嵌套表格的格子不再编号/写入
+WRITER_VERSION = "v2.5"
+RENDER_CACHE_MAX_BYTES = int(os.getenv("RENDER_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+_render_cache = OrderedDict()
+_render_cache_bytes = 0
+_render_lock = threading.Lock()
+_render_key_locks = {}
+
+
+def plan_hash(plan):
+    """
+    方案的规范化哈希：键排序、紧凑分隔符，与字典顺序无关
+    """
+    canonical = json.dumps(plan, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _render_cache_get(key):
+    with _render_lock:
+        data = _render_cache.get(key)
+        if data is not None:
+            _render_cache.move_to_end(key)
+        return data
+
+
+def _render_cache_put(key, data):
+    global _render_cache_bytes
+    if len(data) > RENDER_CACHE_MAX_BYTES: return
+    with _render_lock:
+        if key in _render_cache: return
+        _render_cache[key] = data
+        _render_cache_bytes += len(data)
+        while _render_cache_bytes > RENDER_CACHE_MAX_BYTES and _render_cache:
+            _, old = _render_cache.popitem(last=False)
+            _render_cache_bytes -= len(old)
+
+
+def render_document_cached(plan, template_path, template_hash=None, progress_callback=None):
+    """
+    带缓存的 execute_word_writing_v2：返回 (结果字节, 是否命中缓存)。
+    同一个键并发请求时只会真正渲染一次。
+    """
+    key = (template_hash or _file_hash(template_path), plan_hash(plan), WRITER_MODE, WRITER_VERSION)
+    data = _render_cache_get(key)
+    if data is not None:
+        return data, True
+
+    with _render_lock:
+        key_lock = _render_key_locks.setdefault(key, threading.Lock())
+    with key_lock:
+        data = _render_cache_get(key)
+        if data is not None:
+            return data, True
+        prepared = take_prepared_template(template_hash) if template_hash else None
+        fd, out_path = tempfile.mkstemp(suffix=".docx")
+        os.close(fd)
+        try:
+            execute_word_writing_v2(plan, template_path, out_path, progress_callback=progress_callback, prepared=prepared)
+            with open(out_path, "rb") as f:
+                data = f.read()
+            # 先写缓存再移除键锁：之后到达的请求要么等在同一把锁上，要么直接命中缓存
+            _render_cache_put(key, data)
+        finally:
+            os.remove(out_path)
+            with _render_lock:
+                _render_key_locks.pop(key, None)
+    return data, False
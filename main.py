@@ -1,13 +1,16 @@
 import streamlit as st
-import pandas as pd
 import os
 import time
-from openai import OpenAI
+import tempfile
+import uuid
 
 # 导入模块
 import logic
 import auth
 import styles
+import blobstore
+import llm_scheduler
+import state_store
 
 # 初始化
 st.set_page_config(page_title="WordToWord V1.0", page_icon="📝", layout="wide")
@@ -19,11 +22,79 @@ if 'logged_in' not in st.session_state: st.session_state.logged_in = False
 if 'user_role' not in st.session_state: st.session_state.user_role = None
 if 'username' not in st.session_state: st.session_state.username = ""
 if 'step' not in st.session_state: st.session_state.step = 1
-if 'plan' not in st.session_state: st.session_state.plan = None
-if 'template_bytes' not in st.session_state: st.session_state.template_bytes = None
+# 大块数据 (模板、源文本、方案、KV 表) 存放在 blobstore，会话里只保留句柄
+if 'plan_blob' not in st.session_state: st.session_state.plan_blob = None
+if 'kv_blob' not in st.session_state: st.session_state.kv_blob = None
+if 'template_blob' not in st.session_state: st.session_state.template_blob = None
 if 'user_filename_display' not in st.session_state: st.session_state.user_filename_display = "template.docx"
 # 新增：用于存储当前使用的源数据文本（用于展示）
-if 'source_text_display' not in st.session_state: st.session_state.source_text_display = ""
+if 'source_blob' not in st.session_state: st.session_state.source_blob = None
+
+
+def get_llm_client(api_key):
+    from openai import OpenAI  # 延迟导入：只有真正调用大模型时才加载
+    # 重试与退避统一交给 llm_scheduler，避免 SDK 自带重试让大家在同一时刻一起重试
+    return OpenAI(api_key=api_key, base_url="https://api.deepseek.com", max_retries=0)
+
+
+def set_blob(key, handle):
+    """
+    会话字段换绑到新的 blob 句柄，同时维护引用计数
+    """
+    st.session_state[key] = blobstore.swap(st.session_state.get(key), handle)
+
+
+# 跨副本共享的工作流字段 (字段名 -> 默认值)，其余会话字段只属于当前浏览器连接
+WORKFLOW_DEFAULTS = {"step": 1, "plan_blob": None, "kv_blob": None, "template_blob": None, "source_blob": None,
+                     "batch_blob": None, "batch_results": [], "user_filename_display": "template.docx"}
+
+
+WORKFLOW_BLOBS = [key for key in WORKFLOW_DEFAULTS if key.endswith("_blob")]
+
+
+def workflow_session_id():
+    """
+    浏览器标签页的工作流 ID，放在地址栏参数 wf 里：刷新或被负载均衡切到其他副本后仍能找回，
+    同一用户的多个标签页各自独立
+    """
+    sid = st.query_params.get("wf")
+    if not sid:
+        sid = uuid.uuid4().hex[:16]
+        st.query_params["wf"] = sid
+    return sid
+
+
+def restore_workflow():
+    """
+    从共享存储恢复该标签页的工作流 (可能由其他副本或重启前的进程写入)。
+    恢复出的 blob 句柄由本会话重新引用，之后 set_blob 换绑时释放的正是这份引用。
+    """
+    saved = state_store.load_workflow(st.session_state.username, workflow_session_id()) or {}
+    for key, default in WORKFLOW_DEFAULTS.items():
+        st.session_state[key] = saved.get(key, default)
+    for key in WORKFLOW_BLOBS:
+        blobstore.acquire(st.session_state[key])
+    st.session_state.workflow_saved = {key: st.session_state[key] for key in WORKFLOW_DEFAULTS}
+
+
+def persist_workflow():
+    """
+    本次运行改动过工作流时写回共享存储
+    """
+    current = {key: st.session_state.get(key) for key in WORKFLOW_DEFAULTS}
+    if current != st.session_state.get('workflow_saved'):
+        state_store.save_workflow(st.session_state.username, workflow_session_id(), current)
+        st.session_state.workflow_saved = current
+
+
+def release_workflow():
+    """
+    退出登录：工作流已写回共享存储，释放本会话持有的 blob 引用 (再次登录时 restore_workflow 重新引用)
+    """
+    for key in WORKFLOW_BLOBS:
+        blobstore.release(st.session_state.get(key))
+        st.session_state[key] = None
+    del st.session_state.workflow_saved
 
 
 # ================= 登录页 =================
@@ -69,11 +140,109 @@ def admin_page():
     users, logs, fb = auth.get_admin_data()
     m1, m2, m3 = st.columns(3)
     m1.metric("总用户数", len(users))
-    m2.metric("累计任务", len(logs))
+    m2.metric("累计任务", auth.count_logs())
     m3.metric("平均满意度", f"{fb['rating'].mean():.1f}" if not fb.empty else "0.0")
+
+    # 运行指标 (本进程自启动以来)
+    run_stats = logic.get_metrics()
+    st.markdown("#### ⚙️ 运行指标")
+    r1, r2, r3, r4 = st.columns(4)
+    local_req = run_stats.get("local_fields_requested", 0)
+    r1.metric("本地规则命中率", f"{run_stats.get('local_fields_hit', 0) / local_req:.0%}" if local_req else "-",
+              help="模板中的结构化短字段 (学号、手机等) 由本地规则直接提取、无需大模型的比例")
+    r2.metric("本地规则提取字段数", run_stats.get("local_fields_hit", 0))
+    parse_total = run_stats.get("plan_parse_total", 0)
+    r3.metric("方案解析失败率", f"{run_stats.get('plan_parse_failed', 0) / parse_total:.1%}" if parse_total else "-",
+              help="模型输出完全无法解析为 JSON 的比例")
+    r4.metric("方案修复率", f"{run_stats.get('plan_parse_repaired', 0) / parse_total:.1%}" if parse_total else "-",
+              help=f"输出残缺但被修复/抢救的比例；补全请求 {run_stats.get('plan_followup_requests', 0)} 次，"
+                   f"丢弃不合格条目 {run_stats.get('plan_items_dropped', 0)} 个")
+    split_calls = run_stats.get("plan_split_calls", 0)
+    if split_calls:
+        section_ms = "，".join(
+            f"{sec} {run_stats.get(f'plan_section_{sec}_ms', 0) / run_stats[f'plan_section_{sec}_calls']:.0f} ms"
+            for sec in logic.PLAN_SECTIONS if run_stats.get(f"plan_section_{sec}_calls"))
+        st.caption(f"🧩 分区并发生成方案 {split_calls} 次，平均总耗时 "
+                   f"{run_stats.get('plan_split_wall_ms', 0) / split_calls:.0f} ms；各分区平均：{section_ms}")
+    retrieval_calls = run_stats.get("retrieval_calls", 0)
+    if retrieval_calls:
+        st.caption(f"🔍 长源数据检索 {retrieval_calls} 次，源数据平均 "
+                   f"{run_stats.get('retrieval_chars_in', 0) / retrieval_calls:.0f} 字 → Prompt "
+                   f"{run_stats.get('retrieval_chars_out', 0) / retrieval_calls:.0f} 字，索引缓存命中 "
+                   f"{run_stats.get('retrieval_index_cache_hits', 0) / retrieval_calls:.0%}，平均 "
+                   f"{run_stats.get('retrieval_ms', 0) / retrieval_calls:.1f} ms")
+
+    # 大模型调度队列 (按 API Key)
+    llm_stats = llm_scheduler.get_stats()
+    if llm_stats:
+        st.caption("🚦 大模型请求队列 (按 API Key)")
+        st.dataframe(llm_stats, use_container_width=True, hide_index=True,
+                     column_config={"key": "Key 指纹", "running": "执行中", "concurrency_limit": "并发上限",
+                                    "queued": "排队请求", "queued_users": "排队用户", "avg_wait_ms": "平均等待(ms)",
+                                    "max_wait_ms": "最大等待(ms)", "requests": "累计请求", "rate_limited": "429 次数",
+                                    "cooldown_s": "冷却剩余(s)"})
+
+    # 档案检索 (全部用户)
+    st.markdown("#### 🔎 档案检索 (全部用户)")
+    s1, s2 = st.columns([4, 1])
+    admin_query = s1.text_input("关键词", placeholder="档案名或内容，多个词用空格分隔", key="admin_profile_query")
+    admin_page_no = s2.number_input("页码", min_value=1, value=1, step=1, key="admin_profile_page")
+    hits, hit_total = auth.search_profiles(admin_query, page=admin_page_no)
+    st.caption(f"共 {hit_total} 份档案 (全库 {auth.count_profiles()} 份)")
+    if hits:
+        st.dataframe(hits, use_container_width=True, hide_index=True,
+                     column_config={"username": "用户", "profile_name": "档案名", "created_at": "创建时间",
+                                    "snippet": "匹配片段"})
+
     st.dataframe(logs, use_container_width=True)
 
 
+PREFETCH_MODES = ["关闭", "预读文件", "预读文件 + 预生成方案"]
+
+
+def upload_blob(uploaded):
+    """
+    上传的文件存入 blobstore 并校验格式，结果按上传 ID 记在会话里：
+    Streamlit 每次重跑都会执行到这里，不必每次重新哈希、写盘和校验。
+    返回 (句柄, 是否通过校验, 提示)
+    """
+    cache = st.session_state.setdefault('upload_blobs', {})
+    hit = cache.get(uploaded.file_id)
+    if hit is None or blobstore.blob_path(hit[0]) is None:  # 第一次见到，或 blob 已被淘汰
+        handle = blobstore.put_bytes(uploaded.getvalue(), os.path.splitext(uploaded.name)[1])
+        hit = (handle, *logic.validate_file_format(blobstore.blob_path(handle)))
+        cache[uploaded.file_id] = hit
+    return hit
+
+
+def source_paths(source_handles):
+    return [(name, blobstore.blob_path(handle)) for name, handle in source_handles]
+
+
+def update_speculation(api_key, template_handle, source_handles, source_text, source_budget):
+    """
+    输入齐全时按输入哈希开始预取，输入变化时取消旧的预取。返回当前的预取键 (未开启时为 None)
+    source_handles: [(文件名, blob 句柄), ...]，使用档案时为 None
+    """
+    mode = st.session_state.get('prefetch_mode', PREFETCH_MODES[0])
+    key = None
+    if mode != PREFETCH_MODES[0] and api_key and template_handle and (source_handles or source_text):
+        with_plan = mode == PREFETCH_MODES[2]
+        source_id = "|".join(h for _, h in source_handles) if source_handles else logic.speculation_key(source_text)
+        key = logic.speculation_key(st.session_state.username, template_handle, source_id, source_budget, with_plan)
+    old_key = st.session_state.get('spec_key')
+    if old_key and old_key != key:
+        logic.cancel_speculation(old_key)
+    st.session_state.spec_key = key
+    if key:
+        logic.start_speculation(key, lambda: get_llm_client(api_key), blobstore.blob_path(template_handle),
+                                source_path=source_paths(source_handles) if source_handles else None,
+                                source_text=source_text, template_hash=template_handle,
+                                user=st.session_state.username, source_char_budget=source_budget,
+                                with_plan=with_plan)
+    return key
+
+
 # ================= 用户工作台 =================
 def user_page():
     # --- 【新增】初始化一个固定的档案名，防止每次刷新都变 ---
@@ -93,6 +262,10 @@ def user_page():
 
         if not api_key: st.warning("⚠️ 请输入 API Key")
 
+        # 投机预取：选好文件后立即在后台开始，点击“开始”时直接取结果 (预生成方案会额外消耗 token)
+        st.selectbox("⚡ 预取模式", PREFETCH_MODES, key="prefetch_mode",
+                     help="输入就绪后提前读取文件；选择“预生成方案”时会提前调用大模型，修改输入后之前的请求作废")
+
         st.divider()
         with st.expander("📖 V1.0 使用指南", expanded=False):
             st.markdown(styles.get_guide_html(), unsafe_allow_html=True)
@@ -100,14 +273,32 @@ def user_page():
         # 档案管理
         st.divider()
         st.caption("📚 我的档案库")
-        profiles_df = auth.get_user_profiles(st.session_state.username)
-        if not profiles_df.empty:
-            st.dataframe(profiles_df[['profile_name', 'created_at']], hide_index=True)
+        recent_profiles = auth.list_profiles(st.session_state.username, limit=10)
+        if recent_profiles:
+            st.dataframe([{"profile_name": n, "created_at": t} for n, t in recent_profiles], hide_index=True)
+            st.caption(f"共 {auth.count_profiles(st.session_state.username)} 份，可在“从档案库选择”中搜索")
         else:
             st.info("暂无存档，上传文件后可保存。")
 
+        # HTTP API 访问密钥 (供 api_server.py 使用)
+        with st.expander("🔑 API 访问密钥", expanded=False):
+            if st.button("生成新密钥", use_container_width=True):
+                st.session_state.new_api_key = auth.create_api_key(st.session_state.username, "web")
+            if st.session_state.get('new_api_key'):
+                st.code(st.session_state.new_api_key)
+                st.caption("⚠️ 密钥只显示这一次，请妥善保存。")
+            for prefix, name, created_at, last_used in auth.list_api_keys(st.session_state.username):
+                k1, k2 = st.columns([3, 1])
+                k1.caption(f"{prefix}… 创建于 {created_at}")
+                if k2.button("撤销", key=f"revoke_{prefix}"):
+                    auth.revoke_api_key(st.session_state.username, prefix)
+                    st.session_state.new_api_key = None
+                    st.rerun()
+
         if st.button("退出登录"):
+            persist_workflow()
             st.session_state.logged_in = False
+            release_workflow()  # 下次登录重新从共享存储恢复
             st.rerun()
 
     # --- 主界面 ---
@@ -126,30 +317,27 @@ def user_page():
             unsafe_allow_html=True)
 
         # 核心升级：Tab页切换
-        t1, t2 = st.tabs(["📤 上传新简历", "🗂️ 从档案库选择"])
+        t1, t2, t3 = st.tabs(["📤 上传新简历", "🗂️ 从档案库选择", "📦 批量填表"])
 
         p_old_text = None  # 用于存储最终选定的源文本
 
         # 方式 A: 上传
         with t1:
             c1, c2 = st.columns(2)
-            f_old = c1.file_uploader("源文件 (简历/旧表格)", type=["docx", "pdf"], key="old")
+            # 可同时上传多份材料 (简历、成绩单、证书清单...)，并发读取后去重合并为一份源数据
+            f_olds = c1.file_uploader("源文件 (简历/成绩单/旧表格，可多选)", type=["docx", "pdf"], key="old",
+                                      accept_multiple_files=True)
             f_new = c2.file_uploader("目标文件 (空白模板)", type=["docx"], key="new")
 
             # 立即检测 (UI 交互改进)
             if f_new:
-                if not os.path.exists("temp"): os.makedirs("temp")
-                temp_check_path = os.path.join("temp", "check_template.docx")
-                with open(temp_check_path, "wb") as f:
-                    f.write(f_new.getbuffer())
-
-                valid, msg = logic.validate_file_format(temp_check_path)
+                _, valid, msg = upload_blob(f_new)
                 if not valid:
                     st.error(msg)
                     st.stop()  # 🛑 立即停止，不让用户点开始
 
             # 档案保存选项
-            save_profile = st.checkbox("💾 将此源文件存为档案 (方便下次直接用)", value=True)
+            save_profile = st.checkbox("💾 将源文件存为档案 (多个文件合并为一份，方便下次直接用)", value=True)
             # 【修改】使用 session_state 中的固定名字作为 value
             profile_name = st.text_input("档案名称",
                                          value=st.session_state.auto_profile_name,
@@ -159,18 +347,105 @@ def user_page():
             if save_profile and profile_name:
                 st.session_state.auto_profile_name = profile_name
 
-        # 方式 B: 档案
+        # 方式 B: 档案 (全文检索 + 分页)
         with t2:
-            profiles = auth.get_user_profiles(st.session_state.username)
-            selected_profile_name = st.selectbox("选择档案",
-                                                 profiles['profile_name'].tolist() if not profiles.empty else [])
+            q1, q2 = st.columns([4, 1])
+            profile_query = q1.text_input("🔎 搜索档案", placeholder="档案名或内容，多个词用空格分隔", key="profile_query")
+            profile_page = q2.number_input("页码", min_value=1, value=1, step=1, key="profile_page")
+            hits, hit_total = auth.search_profiles(profile_query, username=st.session_state.username, page=profile_page)
+            page_count = max(1, -(-hit_total // auth.PROFILE_PAGE_SIZE))
+            st.caption(f"共 {hit_total} 份档案，第 {min(profile_page, page_count)}/{page_count} 页")
+            snippets = {h['profile_name']: h for h in hits}
+            selected_profile_name = st.selectbox("选择档案", list(snippets),
+                                                 format_func=lambda n: f"{n}  ({snippets[n]['created_at']})")
+            if selected_profile_name:
+                st.markdown(f"> {snippets[selected_profile_name]['snippet']}")
             f_new_archive = st.file_uploader("目标文件 (空白模板)", type=["docx"], key="new_archive")
-            if not profiles.empty and selected_profile_name:
-                p_old_text = profiles[profiles['profile_name'] == selected_profile_name]['content_text'].values[0]
-                st.info(f"✅ 已加载档案内容 (长度: {len(p_old_text)} 字)")
+            if selected_profile_name:
+                p_old_text = auth.get_profile_text(st.session_state.username, selected_profile_name)
+                st.info(f"✅ 已加载档案内容 (长度: {len(p_old_text or '')} 字)")
+
+        # 方式 C: 批量 (一份源数据，多个模板，直接打包下载)
+        with t3:
+            st.caption("源数据只读取一次，多个模板并发生成，最终打包为一个 zip。")
+            b1, b2 = st.columns(2)
+            f_batch_olds = b1.file_uploader("源文件 (简历/成绩单/旧表格，可多选)", type=["docx", "pdf"], key="batch_old",
+                                            accept_multiple_files=True)
+            batch_profile = b1.selectbox("或选择档案",
+                                         ["(不使用档案)"] + [n for n, _ in auth.list_profiles(st.session_state.username, limit=200)],
+                                         key="batch_profile")
+            f_batch_tpls = b2.file_uploader("目标文件 (可多选)", type=["docx"], key="batch_tpls",
+                                            accept_multiple_files=True)
+
+            if st.button("📦 批量生成", use_container_width=True):
+                if not api_key:
+                    st.error("请先在左侧输入 API Key")
+                    st.stop()
+                if not f_batch_tpls or (not f_batch_olds and batch_profile == "(不使用档案)"):
+                    st.error("请上传源文件(或选择档案)以及至少一个模板")
+                    st.stop()
+
+                if not os.path.exists("temp"): os.makedirs("temp")
+                with tempfile.TemporaryDirectory(dir="temp") as work_dir:
+                    # 源数据只读一次 (多个源文件并发读取后合并)
+                    if f_batch_olds:
+                        sources = []
+                        for idx, src in enumerate(f_batch_olds):
+                            src_path = os.path.join(work_dir, f"source_{idx}{os.path.splitext(src.name)[1]}")
+                            with open(src_path, "wb") as f:
+                                f.write(src.getbuffer())
+                            sources.append((src.name, src_path))
+                        batch_old_txt = logic.read_sources(sources, char_budget=logic.SOURCE_READ_BUDGET)
+                    else:
+                        batch_old_txt = auth.get_profile_text(st.session_state.username, batch_profile)
+
+                    items = []
+                    for idx, tpl in enumerate(f_batch_tpls):
+                        tpl_path = os.path.join(work_dir, f"template_{idx}.docx")
+                        with open(tpl_path, "wb") as f:
+                            f.write(tpl.getbuffer())
+                        items.append((tpl.name, tpl_path))
+
+                    batch_bar = st.progress(0, text=f"正在并发处理 {len(items)} 个模板...")
+                    client = get_llm_client(api_key)
+                    zip_bytes, results = logic.run_multi_template_job(
+                        client, batch_old_txt, items, work_dir,
+                        progress_callback=lambda p, msg: batch_bar.progress(p, text=msg),
+                        user=st.session_state.username)
+
+                set_blob('batch_blob', blobstore.put_bytes(zip_bytes, ".zip"))
+                st.session_state.batch_results = results
+                auth.log_action(st.session_state.username, f"Batch Completed ({len(items)})")
+
+            batch_zip = blobstore.get_bytes(st.session_state.get('batch_blob'))
+            if batch_zip:
+                for r in st.session_state.get('batch_results', []):
+                    if r['ok']:
+                        st.success(f"✅ {r['name']}")
+                    else:
+                        st.error(f"❌ {r['name']}: {r['error']}")
+                st.download_button("📥 下载全部结果 (zip)", batch_zip,
+                                   file_name="WordToWord_V1.0_batch.zip", mime="application/zip",
+                                   type="primary", use_container_width=True)
 
         st.markdown("<br>", unsafe_allow_html=True)
 
+        # 输入就绪即开始预取 (需在侧边栏开启；关闭时不碰上传的文件)
+        spec_template = spec_sources = None
+        spec_budget = None
+        prefetch_on = st.session_state.get('prefetch_mode', PREFETCH_MODES[0]) != PREFETCH_MODES[0]
+        if prefetch_on and f_olds and f_new:
+            uploads = [upload_blob(f) for f in [f_new] + f_olds]
+            if all(valid for _, valid, _ in uploads):
+                spec_template = uploads[0][0]
+                spec_sources = [(f.name, handle) for f, (handle, _, _) in zip(f_olds, uploads[1:])]
+            spec_budget = None if (save_profile and profile_name) else logic.SOURCE_READ_BUDGET
+        elif prefetch_on and p_old_text and (f_new or f_new_archive):
+            handle, valid, _ = upload_blob(f_new or f_new_archive)
+            spec_template = handle if valid else None
+        spec_key = update_speculation(api_key, spec_template, spec_sources, p_old_text if not spec_sources else None,
+                                      spec_budget)
+
         # 统一处理开始逻辑
         start_btn = st.button("🚀 开始 AI 分析 (V1.0)", type="primary", use_container_width=True)
 
@@ -180,45 +455,46 @@ def user_page():
                 st.stop()
 
             # 确定源数据来源
-            final_old_txt = ""
+            final_old_txt = None
+            p_old_paths = None
+            source_budget = None
             final_new_path = ""
 
             # 路径 1: 新上传
-            if f_old and f_new:
-                if not os.path.exists("temp"): os.makedirs("temp")
-                # 保存源文件
-                old_ext = os.path.splitext(f_old.name)[1]
-                p_old_path = os.path.join("temp", f"source_file{old_ext}")
-                with open(p_old_path, "wb") as f:
-                    f.write(f_old.getbuffer())
-
-                # 保存目标文件 (英文名)
-                final_new_path = os.path.join("temp", "target_template.docx")
-                with open(final_new_path, "wb") as f:
-                    f.write(f_new.getbuffer())
+            if f_olds and f_new:
+                # 源文件沿用本会话已存好的 blob (见 upload_blob)，多个文件在分析流水线中并发读取并合并
+                source_uploads = [upload_blob(f) for f in f_olds]
+                for _, valid, msg in source_uploads:
+                    if not valid:
+                        st.error(msg)
+                        st.stop()
+                p_old_paths = source_paths([(f.name, handle) for f, (handle, _, _) in zip(f_olds, source_uploads)])
 
-                # 读取内容
-                final_old_txt = logic.read_file_content(p_old_path)
+                # 保存并校验目标文件
+                template_handle, valid, msg = upload_blob(f_new)
+                if not valid:
+                    st.error(msg)
+                    st.stop()
+                final_new_path = blobstore.blob_path(template_handle)
 
-                # 存档案
-                if save_profile and profile_name:
-                    auth.save_profile(st.session_state.username, profile_name, final_old_txt)
-                    st.toast("✅ 档案已保存！")
+                # 源文件在分析流水线中与模板并发读取：只用于本次填表时，PDF 读满读取预算即停；要存档案则读全文
+                source_budget = None if (save_profile and profile_name) else logic.SOURCE_READ_BUDGET
 
                 # 存Session
-                st.session_state.template_bytes = f_new.getvalue()
+                set_blob('template_blob', template_handle)
                 st.session_state.user_filename_display = f_new.name
 
             # 路径 2: 用档案
             elif p_old_text and (f_new or f_new_archive):
                 final_file = f_new if f_new else f_new_archive
-                if not os.path.exists("temp"): os.makedirs("temp")
-                final_new_path = os.path.join("temp", "target_template.docx")
-                with open(final_new_path, "wb") as f:
-                    f.write(final_file.getbuffer())
+                template_handle, valid, msg = upload_blob(final_file)
+                if not valid:
+                    st.error(msg)
+                    st.stop()
+                final_new_path = blobstore.blob_path(template_handle)
 
                 final_old_txt = p_old_text
-                st.session_state.template_bytes = final_file.getvalue()
+                set_blob('template_blob', template_handle)
                 st.session_state.user_filename_display = final_file.name
             else:
                 st.error("请上传文件或选择档案")
@@ -227,20 +503,28 @@ def user_page():
             # 开始分析
             with st.spinner("正在读取文档并构建知识图谱..."):
                 try:
-                    # 再次预检目标文件
-                    valid, msg = logic.validate_file_format(final_new_path)
-                    if not valid:
-                        st.error(msg)
-                        st.stop()
-
-                    new_txt = logic.read_file_content(final_new_path)
-                    st.session_state.source_text_display = final_old_txt  # 存下来给用户看
-
-                    client = OpenAI(api_key=api_key, base_url="https://api.deepseek.com")
-                    plan = logic.generate_filling_plan_v2(client, final_old_txt, new_txt)
-
-                    st.session_state.plan = plan
-                    st.session_state.kv_df = pd.DataFrame(plan['kv'])
+                    # 有预取结果时直接取用 (仍在进行则等待)，否则按常规流程：
+                    # 读取与大模型请求并行进行；预处理好的模板留给步骤 3 直接写入
+                    spec = logic.take_speculation(spec_key)
+                    st.session_state.spec_key = None
+                    if spec and spec["plan"] is not None:
+                        plan, final_old_txt = spec["plan"], spec["source_text"]
+                    else:
+                        client = get_llm_client(api_key)
+                        plan, final_old_txt, _ = logic.run_step1_pipeline(
+                            client, final_new_path, source_path=p_old_paths,
+                            source_text=spec["source_text"] if spec else final_old_txt,
+                            template_hash=st.session_state.template_blob, user=st.session_state.username,
+                            source_char_budget=source_budget, template_text=spec["template_text"] if spec else None)
+
+                    # 存档案
+                    if p_old_paths and save_profile and profile_name:
+                        auth.save_profile(st.session_state.username, profile_name, final_old_txt)
+                        st.toast("✅ 档案已保存！")
+                    set_blob('source_blob', blobstore.put_text(final_old_txt))  # 存下来给用户看
+
+                    set_blob('plan_blob', blobstore.put_json(plan))
+                    set_blob('kv_blob', blobstore.put_json(plan['kv']))
                     st.session_state.step = 2
                     auth.log_action(st.session_state.username, "Analysis Started")
                     st.rerun()
@@ -253,10 +537,21 @@ def user_page():
         st.markdown(
             """<div class="w2w-card"><div class="w2w-header">📊 步骤 2: 数据核对</div><div class="w2w-desc">AI 已从源文件中提取数据。</div>""",
             unsafe_allow_html=True)
+        import pandas as pd
+
+        plan = blobstore.get_json(st.session_state.plan_blob)
+        kv_records = blobstore.get_json(st.session_state.kv_blob)
+        if plan is None or kv_records is None:
+            st.error("⚠️ 会话过期")
+            if st.button("🔙 返回首页"):
+                st.session_state.step = 1
+                st.rerun()
+            st.stop()
+        kv_df = pd.DataFrame(kv_records)
 
         # 新增：查看 AI 读到了什么
         with st.expander("🔍 [调试] 查看 AI 读取到的源文件内容"):
-            st.text_area("源文本快照", st.session_state.source_text_display, height=200, disabled=True)
+            st.text_area("源文本快照", blobstore.get_text(st.session_state.source_blob) or "", height=200, disabled=True)
             st.caption("如果这里没有你需要的数据，说明源文件格式太复杂，AI 没读出来。")
 
         # ======================= 【新增】核心调试功能 =======================
@@ -264,18 +559,18 @@ def user_page():
         with st.expander("🧩 [调试] 查看 AI 返回的原始 JSON (排查写入失败)"):
             st.info(
                 "💡 关键检查点：\n1. 你的“社会工作/奖惩情况”是不是在 `kv` 列表里？(在 kv 才能写入大单元格)\n2. `anchor` (定位词) 的名字是不是和 Word 模板里的文字能对应上？")
-            st.json(st.session_state.plan)
+            st.json(plan)
         # ===================================================================
 
         # 数据编辑器
         edited_df = st.data_editor(
-            st.session_state.kv_df,
+            kv_df,
             column_config={"anchor": "字段", "val": st.column_config.TextColumn("内容", width="large"),
-                           "source": "来源"},
+                           "source": "来源", "id": None, "id_anchor": None},  # 格子编号只给写入器用，不展示
             use_container_width=True, num_rows="dynamic", height=400
         )
 
-        lists = st.session_state.plan.get("lists", [])
+        lists = plan.get("lists", [])
         if lists:
             st.info(f"📋 识别到 {len(lists)} 个列表，将自动扩展表格行。")
             for lst in lists:
@@ -290,11 +585,12 @@ def user_page():
         t_target = c1.selectbox("选择字段", edited_df['anchor'].tolist())
         t_prompt = c2.text_input("指令", placeholder="例如：扩充到200字，语气更自信")
         if c3.button("执行", use_container_width=True):
-            client = OpenAI(api_key=api_key, base_url="https://api.deepseek.com")
-            idx = st.session_state.kv_df.index[st.session_state.kv_df['anchor'] == t_target].tolist()[0]
+            client = get_llm_client(api_key)
+            idx = kv_df.index[kv_df['anchor'] == t_target].tolist()[0]
             curr = edited_df.loc[idx, 'val']
-            new_val = logic.refine_text_v2(client, curr, t_prompt)
-            st.session_state.kv_df.at[idx, 'val'] = new_val
+            new_val = logic.refine_text_v2(client, curr, t_prompt, user=st.session_state.username)
+            kv_df.at[idx, 'val'] = new_val
+            set_blob('kv_blob', blobstore.put_json(kv_df.to_dict('records')))
             st.rerun()
         st.markdown("</div>", unsafe_allow_html=True)
 
@@ -303,7 +599,9 @@ def user_page():
             st.session_state.step = 1
             st.rerun()
         if c_b2.button("✅ 确认生成", type="primary"):
-            st.session_state.plan['kv'] = edited_df.to_dict('records')
+            plan['kv'] = edited_df.to_dict('records')
+            set_blob('plan_blob', blobstore.put_json(plan))
+            set_blob('kv_blob', blobstore.put_json(plan['kv']))
             st.session_state.step = 3
             st.rerun()
 
@@ -315,15 +613,10 @@ def user_page():
         bar = st.progress(0)
 
         try:
-            p_template = os.path.join("temp", "target_template.docx")
-            p_out = os.path.join("temp", "final_result.docx")
-
-            # 强制恢复文件
-            if st.session_state.get('template_bytes'):
-                if not os.path.exists("temp"): os.makedirs("temp")
-                with open(p_template, "wb") as f:
-                    f.write(st.session_state.template_bytes)
-            else:
+            # 模板和方案都从 blobstore 取回，被淘汰则视为会话过期
+            p_template = blobstore.blob_path(st.session_state.get('template_blob'))
+            plan = blobstore.get_json(st.session_state.get('plan_blob'))
+            if p_template is None or plan is None:
                 st.error("⚠️ 会话过期")
                 if st.button("🔙 返回首页"):
                     st.session_state.step = 1
@@ -334,18 +627,22 @@ def user_page():
                 bar.progress(p, text=msg)
                 time.sleep(0.05)
 
-            logic.execute_word_writing_v2(st.session_state.plan, p_template, p_out, progress_callback=update_bar)
-            auth.log_action(st.session_state.username, "Completed")
+            # 方案和模板都没变时直接复用上次结果 (下载、返回等按钮触发的重跑不再重新生成)
+            result_bytes, cached = logic.render_document_cached(
+                plan, p_template, template_hash=st.session_state.template_blob, progress_callback=update_bar)
+            if cached:
+                bar.progress(100, text="完成")
+            else:
+                auth.log_action(st.session_state.username, "Completed")
             st.success("处理完成！")
 
             output_name = f"WordToWord_V1.0_{st.session_state.user_filename_display}"
             # === 修改开始：使用三列布局优化按钮排版 ===
             col_dl, col_back, col_new = st.columns([3, 2, 2])
 
-            with open(p_out, "rb") as f:
-                col_dl.download_button("📥 下载结果", f, file_name=output_name,
-                                       mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                                       type="primary", use_container_width=True)
+            col_dl.download_button("📥 下载结果", result_bytes, file_name=output_name,
+                                   mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                                   type="primary", use_container_width=True)
 
             # 【新增功能】返回上一步
             if col_back.button("✏️ 不满意？返回修改"):
@@ -357,7 +654,8 @@ def user_page():
                 # 清除旧的默认名
                 if 'auto_profile_name' in st.session_state:
                     del st.session_state.auto_profile_name
-                st.session_state.plan = None  # 彻底清空，防止数据残留
+                for key in ('plan_blob', 'kv_blob', 'template_blob', 'source_blob'):
+                    set_blob(key, None)  # 彻底清空，防止数据残留
                 st.rerun()
             # === 修改结束 ===
 
@@ -377,4 +675,11 @@ else:
     if st.session_state.user_role == 'admin':
         admin_page()
     else:
-        user_page()
\ No newline at end of file
+        # 工作流状态在共享存储中，任意副本都能接着处理 (无需粘性会话)
+        if 'workflow_saved' not in st.session_state:
+            restore_workflow()
+        try:
+            user_page()
+        finally:
+            if 'workflow_saved' in st.session_state:
+                persist_workflow()
\ No newline at end of file
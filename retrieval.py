@@ -0,0 +1,168 @@
+import hashlib
+import math
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+
+# ================= 源数据检索 (本地 BM25，只把与模板相关的段落放进 Prompt) =================
+# 长源文件 (几十页的简历/成绩单、档案全文) 不再只截取开头：
+#   - 按页 / 表格 / 段落切分，中文按相邻两字、英文和数字按词建立 BM25 索引
+#   - 用模板里的标签词检索，按得分在字数预算内挑选段落，再按原文顺序拼接
+#   - 索引按源文本的哈希缓存，同一份档案反复使用时只建一次
+# 纯 Python 实现，不依赖外部服务。
+
+PASSAGE_MAX_CHARS = int(os.getenv("PASSAGE_MAX_CHARS", "800"))
+RETRIEVAL_CACHE_MAX = int(os.getenv("RETRIEVAL_CACHE_MAX", "32"))
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TOKEN_RE = re.compile(r"[\u4e00-\u9fa5]+|[A-Za-z]+|\d+")
+_BLOCK_SPLIT_RE = re.compile(r"\n\s*\n|\n(?=\[PDF_|【)")  # 空行、PDF 页/表格标记、DOCX 正文区/表格区
+_BLOCK_HEAD_RE = re.compile(r"^(\[PDF_[^\]]*\]|【[^】]*】)")
+_SOURCE_TAG_RE = re.compile(r"^【来源 [^】]*】$")  # logic.merge_sources 加在每个源文件前的标记
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def tokenize(text):
+    """
+    中文连续片段切成相邻两字 (单字片段保留单字)，英文转小写按词，数字整体作为一个词
+    """
+    tokens = []
+    for m in _TOKEN_RE.finditer(text or ""):
+        word = m.group(0)
+        if "\u4e00" <= word[0] <= "\u9fa5":
+            if len(word) == 1:
+                tokens.append(word)
+            else:
+                tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        else:
+            tokens.append(word.lower())
+    return tokens
+
+
+def split_passages(text):
+    """
+    按 read_file_content 的输出结构切分段落；超长的块按行再切，续块带上原块的标记 (如 [PDF_第3页])。
+    多个源文件合并的文本，每个段落前带上所属文件的来源标记，挑选后仍能看出出处。
+    """
+    passages = []
+    source_tag = ""
+    for block in _BLOCK_SPLIT_RE.split(text or ""):
+        block = block.strip()
+        if not block: continue
+        first, _, rest = block.partition("\n")
+        if _SOURCE_TAG_RE.match(first):
+            source_tag = first + "\n"
+            block = rest.strip()
+            if not block: continue
+        start = len(passages)
+        passages.extend(_split_block(block))
+        if source_tag:
+            passages[start:] = [source_tag + p for p in passages[start:]]
+    return passages
+
+
+def _split_block(block):
+    if len(block) <= PASSAGE_MAX_CHARS:
+        return [block]
+    m = _BLOCK_HEAD_RE.match(block)
+    head = m.group(1) + " " if m else ""
+    passages, chunk = [], ""
+    for line in block.split("\n"):
+        # 没有换行的超长段落按字数硬切
+        for k in range(0, max(len(line), 1), PASSAGE_MAX_CHARS):
+            piece = line[k:k + PASSAGE_MAX_CHARS]
+            if chunk and len(chunk) + len(piece) + 1 > PASSAGE_MAX_CHARS:
+                passages.append(chunk)
+                chunk = head + piece
+            else:
+                chunk = f"{chunk}\n{piece}" if chunk else piece
+    if chunk: passages.append(chunk)
+    return passages
+
+
+def build_index(text):
+    passages = split_passages(text)
+    postings = {}
+    lengths = []
+    for i, passage in enumerate(passages):
+        tf = Counter(tokenize(passage))
+        lengths.append(sum(tf.values()))
+        for term, n in tf.items():
+            postings.setdefault(term, []).append((i, n))
+    avgdl = (sum(lengths) / len(lengths)) if lengths else 0.0
+    return {"passages": passages, "postings": postings, "lengths": lengths, "avgdl": avgdl or 1.0}
+
+
+def get_index(text):
+    """
+    返回 (索引, 是否命中缓存)
+    """
+    key = hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is not None:
+            _indexes.move_to_end(key)
+            return index, True
+    index = build_index(text)
+    with _indexes_lock:
+        _indexes[key] = index
+        while len(_indexes) > RETRIEVAL_CACHE_MAX:
+            _indexes.popitem(last=False)
+    return index, False
+
+
+def search(index, query):
+    """
+    BM25 打分，返回 {段落序号: 得分}，只包含命中任一查询词的段落
+    """
+    n_docs = len(index["passages"])
+    lengths, avgdl = index["lengths"], index["avgdl"]
+    scores = {}
+    for term in set(tokenize(query)):
+        plist = index["postings"].get(term)
+        if not plist: continue
+        idf = math.log(1 + (n_docs - len(plist) + 0.5) / (len(plist) + 0.5))
+        for i, tf in plist:
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[i] / avgdl)
+            scores[i] = scores.get(i, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+    return scores
+
+
+def pack_passages(text, query, budget):
+    """
+    在 budget 字以内 (含“……”标记) 挑选与 query 最相关的段落，按原文顺序拼接，被略过的地方用“……”标出。
+    第一段 (通常是姓名等基本信息) 始终保留；预算有剩余时按原文顺序补入未命中的段落。
+    返回 (拼接后的文本, 统计信息)
+    """
+    index, cached = get_index(text)
+    passages = index["passages"]
+    if not passages:
+        return "", {"passages": 0, "selected": 0, "matched": 0, "cached": cached}
+    scores = search(index, query)
+    ranked = sorted(scores, key=lambda i: (-scores[i], i))
+    order = [0] + [i for i in ranked if i != 0] + [i for i in range(1, len(passages)) if i not in scores]
+    # used 为拼接结果的实际字数：每段加两个换行，每处“……”连同换行占 4 字
+    chosen, used = set(), 2
+
+    def skipped(j):
+        return 0 <= j < len(passages) and j not in chosen
+
+    for i in order:
+        left, right = skipped(i - 1), skipped(i + 1)
+        gaps = 1 if left and right else (-1 if not left and not right else 0)
+        n = len(passages[i]) + 2 + 4 * gaps
+        if used + n > budget: continue
+        chosen.add(i)
+        used += n
+    parts, prev = [], -1
+    for i in sorted(chosen):
+        if i != prev + 1: parts.append("……")
+        parts.append(passages[i])
+        prev = i
+    if prev != len(passages) - 1: parts.append("……")
+    info = {"passages": len(passages), "selected": len(chosen), "matched": len(scores), "cached": cached}
+    return "\n\n".join(parts), info
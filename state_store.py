@@ -0,0 +1,162 @@
+import abc
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# ================= 共享状态存储 (多副本部署) =================
+# 工作流状态 (步骤、方案/模板句柄等) 和 API 任务不再只放在单个进程的内存里，
+# 任何一个副本都能接着处理任意用户的任务，进程重启也不会丢。
+#   - 大块数据仍由 blobstore 保存，这里只存很小的 JSON 记录 (里面是 blob 句柄)
+#   - 多副本部署时，STATE_DB_FILE 与 BLOB_DIR 需指向所有副本共享的存储
+#   - 需要接入其他存储 (Redis 等) 时，实现 StateBackend 并用 register_backend 注册，
+#     再通过环境变量 STATE_BACKEND 选择
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")
+STATE_DB_FILE = os.getenv("STATE_DB_FILE", os.path.join("temp", "state.db"))
+WORKFLOW_TTL_SECONDS = int(os.getenv("WORKFLOW_TTL_SECONDS", str(7 * 24 * 3600)))
+
+
+class StateBackend(abc.ABC):
+    """
+    后端接口：按 (命名空间, 键) 存取可 JSON 序列化的字典，支持过期时间
+    """
+
+    @abc.abstractmethod
+    def get(self, namespace, key):
+        """返回未过期的值，不存在时返回 None"""
+
+    @abc.abstractmethod
+    def put(self, namespace, key, value, ttl=None):
+        """写入 (覆盖)，ttl 秒后过期；None 表示不过期"""
+
+    @abc.abstractmethod
+    def delete(self, namespace, key):
+        """删除，不存在时不报错"""
+
+    @abc.abstractmethod
+    def items(self, namespace):
+        """返回命名空间下所有未过期的 (键, 值)"""
+
+    def count(self, namespace):
+        return len(self.items(namespace))
+
+
+class SqliteStateBackend(StateBackend):
+    """
+    单个 SQLite 文件，适合本机多进程或共享卷上的少量副本
+    """
+
+    def __init__(self, db_file=None):
+        self.db_file = db_file or STATE_DB_FILE
+        self._init_lock = threading.Lock()
+        self._ready = False
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.db_file) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.db_file, timeout=30)
+        if not self._ready:
+            with self._init_lock:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute('''CREATE TABLE IF NOT EXISTS state (namespace TEXT, key TEXT, value TEXT,
+                                updated_at REAL, expires_at REAL, PRIMARY KEY (namespace, key))''')
+                conn.commit()
+                self._ready = True
+        return conn
+
+    def get(self, namespace, key):
+        conn = self._connect()
+        row = conn.execute("SELECT value FROM state WHERE namespace=? AND key=? AND (expires_at IS NULL OR expires_at > ?)",
+                           (namespace, key, time.time())).fetchone()
+        conn.close()
+        return json.loads(row[0]) if row else None
+
+    def put(self, namespace, key, value, ttl=None):
+        now = time.time()
+        conn = self._connect()
+        conn.execute("INSERT OR REPLACE INTO state (namespace, key, value, updated_at, expires_at) VALUES (?, ?, ?, ?, ?)",
+                     (namespace, key, json.dumps(value, ensure_ascii=False, default=str), now,
+                      now + ttl if ttl else None))
+        conn.commit()
+        conn.close()
+
+    def delete(self, namespace, key):
+        conn = self._connect()
+        conn.execute("DELETE FROM state WHERE namespace=? AND key=?", (namespace, key))
+        conn.commit()
+        conn.close()
+
+    def items(self, namespace):
+        now = time.time()
+        conn = self._connect()
+        # 顺带清理过期记录
+        conn.execute("DELETE FROM state WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+        conn.commit()
+        rows = conn.execute("SELECT key, value FROM state WHERE namespace=?", (namespace,)).fetchall()
+        conn.close()
+        return [(k, json.loads(v)) for k, v in rows]
+
+    def count(self, namespace):
+        conn = self._connect()
+        n = conn.execute("SELECT COUNT(*) FROM state WHERE namespace=? AND (expires_at IS NULL OR expires_at > ?)",
+                         (namespace, time.time())).fetchone()[0]
+        conn.close()
+        return n
+
+
+_BACKENDS = {"sqlite": SqliteStateBackend}
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def register_backend(name, factory):
+    _BACKENDS[name] = factory
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if STATE_BACKEND not in _BACKENDS:
+                    raise ValueError(f"未知的状态存储后端: {STATE_BACKEND}")
+                _backend = _BACKENDS[STATE_BACKEND]()
+    return _backend
+
+
+# --- 网页工作流 (按用户名 + 浏览器会话 ID，同一用户开多个标签页互不覆盖) ---
+def _workflow_key(username, session_id):
+    return f"{username}\x00{session_id}"
+
+
+def load_workflow(username, session_id):
+    return get_backend().get("workflow", _workflow_key(username, session_id))
+
+
+def save_workflow(username, session_id, state):
+    get_backend().put("workflow", _workflow_key(username, session_id), state, ttl=WORKFLOW_TTL_SECONDS)
+
+
+def clear_workflow(username, session_id):
+    get_backend().delete("workflow", _workflow_key(username, session_id))
+
+
+# --- API 任务 ---
+def get_job(job_id):
+    return get_backend().get("job", job_id)
+
+
+def put_job(job, ttl=None):
+    get_backend().put("job", job["job_id"], job, ttl=ttl)
+
+
+def delete_job(job_id):
+    get_backend().delete("job", job_id)
+
+
+def list_jobs():
+    return [job for _, job in get_backend().items("job")]
+
+
+def count_jobs():
+    return get_backend().count("job")
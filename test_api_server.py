@@ -0,0 +1,62 @@
+"""
+HTTP API (api_server.analyze) 上传限制的单元测试：python -m pytest -q
+"""
+import asyncio
+import json
+
+import pytest
+from aiohttp import FormData
+from aiohttp.test_utils import TestClient, TestServer
+
+import api_server
+import auth
+import blobstore
+
+
+@pytest.fixture
+def api_key(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(auth, "DB_FILE", str(tmp_path / "api.db"))
+    monkeypatch.setattr(auth, "_db_ready", False)
+    monkeypatch.setattr(blobstore, "BLOB_DIR", str(tmp_path / "blobs"))
+    auth.init_db()
+    auth.register_user("u1", "pw")
+    auth.save_user_apikey("u1", "sk-test")
+    return auth.create_api_key("u1")
+
+
+def _post(api_key, form):
+    async def run():
+        async with TestClient(TestServer(api_server.create_app())) as client:
+            resp = await client.post("/api/v1/analyze", data=form, headers={"X-API-Key": api_key})
+            return resp.status, await resp.text()
+    return asyncio.run(run())
+
+
+def _form(sources=1, size=10, profile_name=None):
+    form = FormData()
+    form.add_field("template", b"PK" + b"t" * size, filename="tpl.docx")
+    for i in range(sources):
+        form.add_field("source", b"PK" + bytes([i % 256]) * size, filename=f"s{i}.docx")
+    if profile_name is not None:
+        form.add_field("profile_name", profile_name)
+    return form
+
+
+def test_too_many_parts_rejected(api_key, monkeypatch):
+    monkeypatch.setattr(api_server, "MAX_PARTS", 3)
+    status, _ = _post(api_key, _form(sources=5))
+    assert status == 413
+
+
+def test_total_request_size_rejected(api_key, monkeypatch):
+    monkeypatch.setattr(api_server, "MAX_REQUEST_BYTES", 2500)
+    status, _ = _post(api_key, _form(sources=3, size=1000))  # 每个文件都没超过单文件上限
+    assert status == 413
+
+
+def test_long_profile_name_rejected(api_key):
+    status, body = _post(api_key, _form(sources=0, profile_name="档" * 200))
+    assert status == 400 and "profile_name" in body
+    status, body = _post(api_key, _form(sources=0, profile_name="张三"))
+    assert status == 404 and json.loads(body)["error"].endswith("张三")
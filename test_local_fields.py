@@ -0,0 +1,65 @@
+"""
+本地规则预提取 (logic.extract_local_fields) 的单元测试：python -m pytest -q
+"""
+import logic
+
+
+def _values(old_data, target_structure):
+    kv, _ = logic.extract_local_fields(old_data, target_structure)
+    return {item["anchor"]: item["val"] for item in kv}
+
+
+def test_labeled_values_from_table_and_inline():
+    old = "姓名 | 张三 | 性别 | 男\n手机 13800138000\n邮箱：zhangsan@example.com"
+    vals = _values(old, "性别 | #T0R0C1\n手机号码 | #T0R1C1\n邮箱 | #T0R2C1")
+    assert vals == {"性别": "男", "手机号码": "13800138000", "邮箱": "zhangsan@example.com"}
+
+
+def test_phone_is_not_cut_out_of_id_number():
+    vals = _values("姓名：张三\n110101199003071234\n", "手机：\n身份证号：")
+    assert vals == {"身份证号": "110101199003071234"}
+
+
+def test_unlabeled_fallback_skips_claimed_spans():
+    # 号码已被“身份证号”标签取走，不能再作为手机号的无标签候选
+    vals = _values("身份证号：11010119900307123X\n19900307123", "手机：\n身份证号：")
+    assert vals["身份证号"] == "11010119900307123X"
+    assert vals["手机"] == "19900307123"
+    assert _values("身份证：110101199003071234", "手机 | ") == {}
+
+
+def test_number_boundaries():
+    assert _values("学号：20211234567890123", "学号 | ") == {}
+    assert _values("学号：No.2021123456 学号 2021654321", "学号 | ") == {"学号": "2021654321"}
+    assert _values("联系电话 +86 13800138000", "联系电话 | ") == {"联系电话": "+86 13800138000"}
+
+
+def test_template_anchor_matches_whole_label():
+    assert _values("电话 13800138000", "家庭电话 | \n紧急联系人电话 | ") == {}
+    assert _values("电话 13800138000", "联系电话（必填） | #T0R0C1") == {"联系电话": "13800138000"}
+    assert _values("学号 2021123456", "姓名：____ 学号：____") == {"学号": "2021123456"}
+
+
+def test_requested_count():
+    _, requested = logic.extract_local_fields("", "学号 | \n性别 | \n备注 | ")
+    assert requested == 2
+
+
+def test_relative_prefixed_labels_are_not_own_fields():
+    tpl = "政治面貌 | \n出生年月 | \n手机 | "
+    assert _values("父亲政治面貌：中共党员\n本人政治面貌：共青团员", tpl) == {}
+    assert _values("母亲出生年月：1970年5月\n出生年月：2000年3月", tpl) == {"出生年月": "2000年3月"}
+    assert _values("家庭电话：13912345678", tpl) == {}
+    assert _values("家庭电话 | 13912345678", tpl) == {}
+    assert _values("父亲 | 政治面貌 | 中共党员", tpl) == {"政治面貌": "中共党员"}
+
+
+def test_disagreeing_labeled_values_are_left_to_llm():
+    old = "手机：13800138000\n联系电话：13900139000"
+    assert _values(old, "手机 | ") == {}
+    assert _values("手机：13800138000\n电话：13800138000", "手机 | ") == {"手机": "13800138000"}
+
+
+def test_student_id_right_after_label():
+    assert _values("学号2021123456", "学号 | ") == {"学号": "2021123456"}
+    assert _values("学号：AB2021123456", "学号 | ") == {"学号": "AB2021123456"}
@@ -0,0 +1,37 @@
+"""
+后台日志写入 (auth.log_action / flush_logs) 的单元测试：python -m pytest -q
+"""
+import sqlite3
+
+import pytest
+
+import auth
+
+
+@pytest.fixture
+def log_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(auth, "DB_FILE", str(tmp_path / "logs.db"))
+    monkeypatch.setattr(auth, "_db_ready", False)
+    auth.init_db()
+    auth.flush_logs()  # 清掉其他测试留下的队列内容
+
+
+def test_flush_makes_logs_visible(log_db):
+    auth.log_action("u1", "Analysis Started")
+    auth.flush_logs()
+    assert auth.count_logs() == 1
+
+
+def test_failed_write_reaches_flush_caller_and_is_retried(log_db, monkeypatch):
+    def locked(batch):
+        raise sqlite3.OperationalError("database is locked")
+
+    write_logs = auth._write_logs
+    monkeypatch.setattr(auth, "_write_logs", locked)
+    auth.log_action("u1", "Completed")
+    with pytest.raises(sqlite3.OperationalError):
+        auth.flush_logs()
+
+    monkeypatch.setattr(auth, "_write_logs", write_logs)
+    auth.flush_logs()
+    assert auth.count_logs() == 1
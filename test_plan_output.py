@@ -0,0 +1,93 @@
+"""
+方案输出的 JSON 模式回退与结构校验 (logic._chat_json / _validate_plan) 的单元测试：python -m pytest -q
+"""
+import types
+
+import pytest
+
+import logic
+
+
+class _APIError(Exception):
+    def __init__(self, status_code, message, body=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.body = body
+
+
+def _client(base_url, error):
+    calls = []
+
+    def create(**kwargs):
+        calls.append(kwargs)
+        if "response_format" in kwargs and error is not None:
+            raise error
+        return "ok"
+
+    client = types.SimpleNamespace(api_key="sk-test", base_url=base_url,
+                                   chat=types.SimpleNamespace(completions=types.SimpleNamespace(create=create)))
+    return client, calls
+
+
+def test_json_mode_disabled_only_when_endpoint_rejects_response_format():
+    error = _APIError(400, "Error code: 400", {"error": {"message": "response_format is not supported"}})
+    client, calls = _client("http://no-json-mode.test", error)
+    assert logic._chat_json(client, "u1", "prompt") == "ok"
+    assert "http://no-json-mode.test" in logic._json_mode_unsupported
+    assert logic._chat_json(client, "u1", "prompt") == "ok"
+    assert ["response_format" in c for c in calls] == [True, False, False]
+
+
+def test_other_bad_requests_are_raised_and_keep_json_mode():
+    client, _ = _client("http://prompt-too-long.test", _APIError(400, "maximum context length exceeded"))
+    with pytest.raises(_APIError):
+        logic._chat_json(client, "u1", "prompt")
+    assert "http://prompt-too-long.test" not in logic._json_mode_unsupported
+
+
+def test_validate_plan_headers():
+    plan, dropped = logic._validate_plan({"lists": [
+        {"keyword": "获奖情况", "headers": "时间, 奖项、等级", "data": [["2023.05", "一等奖"]]},
+        {"keyword": "课程", "headers": ["课程", "成绩"], "data": [["高数", 95, "多余"]]},
+        {"keyword": "其他", "headers": {"a": 1}, "data": []},
+    ]})
+    assert dropped == 1
+    assert plan["lists"][0]["headers"] == ["时间", "奖项", "等级"]
+    assert plan["lists"][0]["data"] == [["2023.05", "一等奖", ""]]
+    assert plan["lists"][1]["data"] == [["高数", "95"]]
+
+
+def test_cell_id_only_used_while_anchor_unchanged():
+    plan, _ = logic._validate_plan({"kv": [{"anchor": "性别", "val": "男", "id": "#T0R0C1"}],
+                                    "lists": [{"keyword": "获奖情况", "headers": ["时间"], "data": [], "id": "T1R2"}]})
+    kv, lists = plan["kv"][0], plan["lists"][0]
+    assert kv["id_anchor"] == "性别" and lists["id_anchor"] == "获奖情况"
+    assert logic._slot_id(kv, "性别") == "T0R0C1"
+    assert logic._slot_id(lists, "获奖情况") == "T1R2"
+    # 用户在编辑器里改了 anchor / keyword：退回按文字定位
+    assert logic._slot_id(kv, "民族") is None
+    assert logic._slot_id(lists, "科研经历") is None
+    # 旧方案没有 id_anchor 时仍沿用编号
+    assert logic._slot_id({"id": "T0R0C1"}, "任意") == "T0R0C1"
+
+
+@pytest.mark.parametrize("source_chars, whole", [(5000, True), (20000, False)])
+def test_split_mode_sends_whole_source_when_it_fits(monkeypatch, source_chars, whole):
+    sources = {}
+
+    def generate_section(client, user, sec, source, structure, extra_rules, cancel_event):
+        sources[sec] = source
+        return [], 0.0
+
+    monkeypatch.setattr(logic, "_generate_section", generate_section)
+    monkeypatch.setattr(logic, "RETRIEVAL_CHAR_BUDGET", 8000)
+    old = "\n\n".join(f"第{i}段 姓名 获奖 课程成绩" + "材料" * 40 for i in range(source_chars // 100))
+    structure = "【表格区_0】\n姓名 | #T0R0C1\n获奖情况 #T0R1\n〔列表区 #T0R1：上一行为表头，下有 3 行空白〕"
+    logic._generate_plan_split(None, "u1", old, structure, [])
+    assert sources
+    for sec, source in sources.items():
+        if whole:
+            assert source == old
+        else:
+            assert len(source) <= int(8000 * logic.SECTION_SOURCE_SHARE[sec] / sum(
+                logic.SECTION_SOURCE_SHARE[s] for s in sources))
@@ -0,0 +1,65 @@
+"""
+档案检索 (auth.search_profiles 及其索引) 的单元测试：python -m pytest -q
+"""
+import sqlite3
+
+import pytest
+
+import auth
+
+
+def _fresh_db(tmp_path, monkeypatch, trigram=True):
+    monkeypatch.setattr(auth, "DB_FILE", str(tmp_path / "profiles.db"))
+    monkeypatch.setattr(auth, "_db_ready", False)
+    monkeypatch.setattr(auth, "_HAS_TRIGRAM", trigram)
+    auth.init_db()
+    auth.save_profile("bob", "张伟的简历", "姓名：张伟\n专业：数学建模\n获奖：全国一等奖")
+    auth.save_profile("bob", "李娜的简历", "姓名：李娜\n专业：计算机科学\nPython 熟练")
+    auth.save_profile("amy", "欧阳修", "姓名：欧阳修\n专业：数学建模")
+
+
+def _names(query, username=None):
+    results, total = auth.search_profiles(query, username=username)
+    assert total == len(results)
+    return sorted(r["profile_name"] for r in results)
+
+
+def _tables():
+    conn = sqlite3.connect(auth.DB_FILE)
+    names = {row[0] for row in conn.execute("SELECT name FROM sqlite_master")}
+    conn.close()
+    return names
+
+
+@pytest.mark.parametrize("trigram", [True, False])
+def test_search_terms_of_every_length(tmp_path, monkeypatch, trigram):
+    _fresh_db(tmp_path, monkeypatch, trigram)
+    assert ("profiles_fts" in _tables()) == trigram
+    assert _names("张伟") == ["张伟的简历"]
+    assert _names("数学建模") == ["张伟的简历", "欧阳修"]
+    assert _names("建模 欧阳") == ["欧阳修"]
+    assert _names("py") == ["李娜的简历"]
+    assert _names("张") == ["张伟的简历"]
+    assert _names("数学建模", username="bob") == ["张伟的简历"]
+
+
+def test_short_terms_use_gram_index(tmp_path, monkeypatch):
+    _fresh_db(tmp_path, monkeypatch)
+    grams = sqlite3.connect(auth.DB_FILE).execute(
+        "SELECT COUNT(*) FROM profiles_grams WHERE profiles_grams MATCH '\"张伟\"'").fetchone()[0]
+    assert grams == 1
+    # 索引与逐行 LIKE 的结果一致
+    indexed = auth.search_profiles("李娜 py")
+    monkeypatch.setattr(auth, "_has_table", lambda c, name: False)
+    assert auth.search_profiles("李娜 py") == indexed
+
+
+def test_gram_index_follows_update_and_delete(tmp_path, monkeypatch):
+    _fresh_db(tmp_path, monkeypatch)
+    auth.save_profile("bob", "张伟的简历", "姓名：王强")
+    assert _names("张伟") == ["张伟的简历"]  # 档案名仍含“张伟”
+    assert _names("王强") == ["张伟的简历"]
+    assert _names("一等") == []
+    auth.delete_profile("bob", "张伟的简历")
+    assert _names("王强") == []
+    assert _names("张伟") == []
@@ -0,0 +1,100 @@
+"""
+DOCX 流式读取 (logic._read_docx) 的单元测试：合并单元格、嵌套表格、正文顺序与 mc:Fallback：python -m pytest -q
+"""
+from docx import Document
+from docx.oxml import parse_xml
+
+import logic
+
+_MC = "http://schemas.openxmlformats.org/markup-compatibility/2006"
+_WNS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+
+
+def _read(doc, tmp_path, **kwargs):
+    path = str(tmp_path / "doc.docx")
+    doc.save(path)
+    return logic._read_docx(path, **kwargs)
+
+
+def _grades_table(doc):
+    table = doc.add_table(rows=3, cols=3)
+    for c, text in enumerate(["课程", "学期", "成绩"]):
+        table.cell(0, c).text = text
+    table.cell(1, 0).text = "数学"
+    table.cell(1, 2).text = "90"
+    table.cell(2, 0).text = "物理"
+    table.cell(2, 2).text = "85"
+    table.cell(1, 1).merge(table.cell(2, 1)).text = "2021秋"
+    return table
+
+
+def test_horizontal_merge_is_read_once(tmp_path):
+    doc = Document()
+    table = doc.add_table(rows=2, cols=3)
+    table.cell(0, 0).merge(table.cell(0, 1)).text = "基本信息"
+    table.cell(0, 2).text = "备注"
+    table.cell(1, 0).text = "姓名"
+    table.cell(1, 1).text = "张三"
+    text = _read(doc, tmp_path)
+    assert text.splitlines()[1:] == ["基本信息 | 备注", "姓名 | 张三"]
+
+
+def test_vertical_merge_keeps_columns(tmp_path):
+    doc = Document()
+    _grades_table(doc)
+    text = _read(doc, tmp_path)
+    assert text.splitlines()[1:] == ["课程 | 学期 | 成绩", "数学 | 2021秋 | 90", "物理 |  | 85"]
+    assert text.count("2021秋") == 1
+
+
+def test_vertical_merge_continuation_gets_no_slot_id(tmp_path):
+    doc = Document()
+    table = _grades_table(doc)
+    table.cell(2, 2).text = ""
+    text = _read(doc, tmp_path, slot_ids=True)
+    assert "物理 |  | #T0R2C2" in text
+    assert "#T0R2C1" not in text
+
+
+def test_body_order_and_nested_tables(tmp_path):
+    doc = Document()
+    doc.add_paragraph("个人简历")
+    outer = doc.add_table(rows=1, cols=2)
+    outer.cell(0, 0).text = "家庭成员"
+    nested = outer.cell(0, 1).add_table(rows=1, cols=2)
+    nested.cell(0, 0).text = "父亲"
+    nested.cell(0, 1).text = "张某"
+    doc.add_paragraph("本人承诺以上信息属实")
+    blocks = _read(doc, tmp_path).split("\n\n")
+    assert blocks == ["【正文区】\n个人简历", "【表格区_0】\n家庭成员", "【表格区_1】\n父亲 | 张某",
+                      "【正文区】\n本人承诺以上信息属实"]
+
+
+def test_mc_fallback_is_skipped(tmp_path):
+    doc = Document()
+    p = doc.add_paragraph("联系方式")
+    p._p.append(parse_xml(
+        f'<w:r xmlns:w="{_WNS}" xmlns:mc="{_MC}"><mc:AlternateContent>'
+        f'<mc:Choice Requires="wps"><w:t>文本框内容</w:t></mc:Choice>'
+        f'<mc:Fallback><w:t>文本框内容</w:t></mc:Fallback>'
+        f'</mc:AlternateContent></w:r>'))
+    text = _read(doc, tmp_path)
+    assert text == "【正文区】\n联系方式文本框内容"
+
+
+def test_template_reader_fallback_is_counted(tmp_path, monkeypatch):
+    doc = Document()
+    doc.add_paragraph("姓名")
+    path = str(tmp_path / "tpl.docx")
+    doc.save(path)
+    calls = []
+
+    def broken(file_path, slot_ids=False):
+        calls.append(slot_ids)
+        raise ValueError("parser bug")
+
+    monkeypatch.setattr(logic, "_read_docx", broken)
+    before = logic.get_metrics().get("docx_reader_fallbacks", 0)
+    assert "姓名" in logic.read_template_structure(path)
+    assert calls == [True, False]
+    assert logic.get_metrics()["docx_reader_fallbacks"] - before == 2
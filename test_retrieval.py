@@ -0,0 +1,49 @@
+"""
+源数据检索 (retrieval) 的单元测试：分词、段落切分与字数预算：python -m pytest -q
+"""
+import pytest
+
+import retrieval
+
+
+def _text():
+    paras = ["姓名：张三\n学号：2021123456"]
+    paras += [f"课程{i}：高等数学 成绩 9{i % 10}" * 5 for i in range(20)]
+    paras += ["获奖情况：全国大学生数学建模竞赛一等奖", "科研经历：参与国家自然科学基金项目"]
+    paras += ["社会实践：志愿服务" * 8 for _ in range(10)]
+    return "\n\n".join(paras)
+
+
+def test_tokenize():
+    assert retrieval.tokenize("数学建模 Python3 张") == ["数学", "学建", "建模", "python", "3", "张"]
+    assert retrieval.tokenize("") == []
+
+
+def test_split_passages_keeps_source_tags_and_block_heads(monkeypatch):
+    monkeypatch.setattr(retrieval, "PASSAGE_MAX_CHARS", 40)
+    text = "【来源 1: a.pdf】\n[PDF_第1页]\n" + "\n".join(["第一行内容比较长" * 3] * 3) + "\n\n【来源 2: b.docx】\n姓名：李四"
+    passages = retrieval.split_passages(text)
+    assert passages[-1] == "【来源 2: b.docx】\n姓名：李四"
+    assert all(p.startswith("【来源 1: a.pdf】\n") for p in passages[:-1])
+    assert passages[1].split("\n")[1].startswith("[PDF_第1页] ")
+    assert all(len(p.split("\n", 1)[1]) <= 40 for p in passages)
+
+
+@pytest.mark.parametrize("budget", [10, 60, 200, 500, 1000, 5000])
+def test_pack_passages_respects_budget(budget):
+    out, info = retrieval.pack_passages(_text(), "获奖 科研", budget)
+    assert len(out) <= budget
+    assert info["selected"] <= info["passages"]
+
+
+def test_pack_passages_prefers_matches_in_original_order():
+    text = _text()
+    out, info = retrieval.pack_passages(text, "获奖情况 科研经历", 100)
+    assert out.startswith("姓名：张三")
+    assert out.index("获奖情况") < out.index("科研经历")
+    assert "课程" not in out and "……" in out
+    assert info["matched"] == 2
+    # 预算足够时原文完整保留，没有省略标记
+    full, info = retrieval.pack_passages(text, "获奖", len(text))
+    assert full == text and info["selected"] == info["passages"]
+    assert retrieval.pack_passages(text, "获奖", 60)[1]["cached"]
@@ -0,0 +1,46 @@
+"""
+多个源文件的读取与合并 (logic.read_sources / merge_sources) 的单元测试：python -m pytest -q
+"""
+import benchmark
+import logic
+
+
+def test_single_source_is_returned_unchanged():
+    assert logic.merge_sources([("简历.pdf", "姓名：张三\n姓名：张三")]) == "姓名：张三\n姓名：张三"
+
+
+def test_merge_tags_sources_and_dedupes_long_lines():
+    header = "XX大学 计算机学院 本科生成绩单"
+    merged = logic.merge_sources([
+        ("简历.docx", f"{header}\n姓名：张三\n获奖：全国大学生数学建模竞赛一等奖"),
+        ("成绩单.pdf", f"[PDF_第1页]\n[PDF_第2页] {header}\n姓名：张三\n高等数学 95"),
+    ])
+    first, second = merged.split("\n\n")
+    assert first.startswith("【来源 1/2：简历.docx】\n")
+    assert second.startswith("【来源 2/2：成绩单.pdf】\n")
+    # 长行只保留第一次出现 (重复行上的页码标记保留)；短行 (姓名) 不去重
+    assert merged.count(header) == 1
+    assert second.split("\n")[1:] == ["[PDF_第1页]", "[PDF_第2页]", "姓名：张三", "高等数学 95"]
+
+
+def test_read_sources_keeps_input_order(monkeypatch):
+    monkeypatch.setattr(logic, "read_file_content", lambda path, _=None, budget=None: f"内容 {path} {budget}")
+    merged = logic.read_sources([("a.docx", "/x/a.docx"), ("b.pdf", "/x/b.pdf")], char_budget=100)
+    assert merged == "【来源 1/2：a.docx】\n内容 /x/a.docx 100\n\n【来源 2/2：b.pdf】\n内容 /x/b.pdf 100"
+
+
+def test_process_pool_returns_text_and_metrics(tmp_path, monkeypatch):
+    sources = []
+    for i in range(2):
+        path = str(tmp_path / f"source_{i}.pdf")
+        benchmark._make_pdf(path, 2)
+        sources.append((f"材料{i + 1}.pdf", path))
+    threaded = logic.read_sources(sources)
+
+    monkeypatch.setattr(logic, "SOURCE_PROCESS_WORKERS", 2)
+    before = logic.get_metrics().get("pdf_pages_read", 0)
+    try:
+        assert logic.read_sources(sources) == threaded
+    finally:
+        logic._reset_source_pool(wait=True)
+    assert logic.get_metrics().get("pdf_pages_read", 0) - before == 4
@@ -0,0 +1,24 @@
+"""
+投机预取 (logic.start_speculation) 的单元测试：python -m pytest -q
+"""
+import logic
+
+
+def test_client_built_only_for_new_speculation(monkeypatch):
+    monkeypatch.setattr(logic, "_speculate", lambda *args: None)
+    built = []
+
+    def make_client():
+        built.append(1)
+        return object()
+
+    key = logic.speculation_key("u1", "tpl", "src", None, False)
+    try:
+        for _ in range(3):  # 页面重跑时反复调用
+            logic.start_speculation(key, make_client, "/tmp/tpl.docx", source_text="姓名：张三", user="u1")
+        assert built == [1]
+    finally:
+        logic.cancel_speculation(key)
+    logic.start_speculation(key, make_client, "/tmp/tpl.docx", source_text="姓名：张三", user="u1")
+    logic.cancel_speculation(key)
+    assert built == [1, 1]
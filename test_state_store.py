@@ -0,0 +1,129 @@
+"""
+共享状态存储 (state_store / blobstore 后端) 的单元测试，包含一个进程保存工作流、另一个进程恢复并读取 blob 的场景：python -m pytest -q
+"""
+import multiprocessing
+import os
+import time
+
+import pytest
+
+import blobstore
+import state_store
+
+
+def _use_shared_storage(state_db, blob_dir):
+    blobstore.BLOB_DIR = blob_dir
+    state_store._backend = state_store.SqliteStateBackend(state_db)
+
+
+def _save_step(state_db, blob_dir):
+    """
+    副本 A：保存模板和方案两个 blob，把句柄写进工作流
+    """
+    _use_shared_storage(state_db, blob_dir)
+    template = blobstore.put_bytes(b"PK-template-bytes", ".docx")
+    plan = blobstore.put_json({"kv": [{"anchor": "姓名", "val": "张三"}]})
+    for handle in (template, plan): blobstore.acquire(handle)
+    state_store.save_workflow("u1", "tab-a", {"step": 2, "template_blob": template, "plan_blob": plan})
+    return os.getpid()
+
+
+def _restore_step(state_db, blob_dir):
+    """
+    副本 B：恢复工作流并读出其中的 blob
+    """
+    _use_shared_storage(state_db, blob_dir)
+    state = state_store.load_workflow("u1", "tab-a")
+    for key in ("template_blob", "plan_blob"): blobstore.acquire(state[key])
+    with open(blobstore.blob_path(state["template_blob"]), "rb") as f:
+        template = f.read()
+    return os.getpid(), state["step"], template, blobstore.get_json(state["plan_blob"])
+
+
+class _MemoryBlobBackend(blobstore.BlobBackend):
+    def __init__(self, cache_dir):
+        self.data, self.cache_dir = {}, cache_dir
+
+    def put_bytes(self, handle, data):
+        self.data[handle] = data
+
+    def get(self, handle):
+        return self.data.get(handle)
+
+    def local_path(self, handle):
+        if handle not in self.data: return None
+        path = os.path.join(self.cache_dir, handle)
+        with open(path, "wb") as f:
+            f.write(self.data[handle])
+        return path
+
+    def delete(self, handle):
+        self.data.pop(handle, None)
+
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+    b = state_store.SqliteStateBackend(str(tmp_path / "state.db"))
+    monkeypatch.setattr(state_store, "_backend", b)
+    return b
+
+
+def test_backend_interface_is_abstract():
+    with pytest.raises(TypeError):
+        state_store.StateBackend()
+
+    class Partial(state_store.StateBackend):
+        def get(self, namespace, key):
+            return None
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_workflow_with_blobs_restored_in_another_process(tmp_path):
+    state_db, blob_dir = str(tmp_path / "state.db"), str(tmp_path / "blobs")
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(1, maxtasksperchild=1) as pool:  # 每个任务一个新进程，模拟两个副本
+        saver = pool.apply(_save_step, (state_db, blob_dir))
+        restorer, step, template, plan = pool.apply(_restore_step, (state_db, blob_dir))
+    assert saver != restorer
+    assert step == 2
+    assert template == b"PK-template-bytes"
+    assert plan == {"kv": [{"anchor": "姓名", "val": "张三"}]}
+
+
+def test_blob_backend_is_pluggable(tmp_path, monkeypatch):
+    with pytest.raises(TypeError):
+        blobstore.BlobBackend()
+    backend = _MemoryBlobBackend(str(tmp_path))
+    blobstore.register_backend("memory", lambda: backend)
+    monkeypatch.setattr(blobstore, "BLOB_BACKEND", "memory")
+    monkeypatch.setattr(blobstore, "_backend", None)
+    monkeypatch.setattr(blobstore, "BLOB_DIR", str(tmp_path / "index"))
+
+    handle = blobstore.put_json({"a": 1})
+    assert handle in backend.data
+    assert not os.path.exists(os.path.join(str(tmp_path / "index"), handle[:2]))  # 数据不落本地目录
+    assert blobstore.get_json(handle) == {"a": 1}
+    assert open(blobstore.blob_path(handle), "rb").read() == backend.data[handle]
+    assert blobstore.evict(now=time.time() + blobstore.BLOB_TTL_SECONDS + 1) == 1
+    assert handle not in backend.data and blobstore.get_bytes(handle) is None
+
+
+def test_expired_records_are_hidden(backend):
+    backend.put("job", "old", {"x": 1}, ttl=-1)
+    backend.put("job", "new", {"x": 2}, ttl=60)
+    assert backend.get("job", "old") is None
+    assert [key for key, _ in backend.items("job")] == ["new"]
+    assert backend.count("job") == 1
+
+
+def test_workflows_are_kept_per_browser_session(backend):
+    state_store.save_workflow("u1", "tab-a", {"step": 2, "plan_blob": "a"})
+    state_store.save_workflow("u1", "tab-b", {"step": 1, "plan_blob": None})
+    assert state_store.load_workflow("u1", "tab-a")["step"] == 2
+    assert state_store.load_workflow("u1", "tab-b")["step"] == 1
+    assert state_store.load_workflow("u2", "tab-a") is None
+    state_store.clear_workflow("u1", "tab-a")
+    assert state_store.load_workflow("u1", "tab-a") is None
+    assert state_store.load_workflow("u1", "tab-b") is not None
@@ -0,0 +1,41 @@
+"""
+写入器 (logic.execute_word_writing_v2) 与模板编号的单元测试：python -m pytest -q
+"""
+import pytest
+from docx import Document
+
+import logic
+
+
+def _template(path):
+    doc = Document()
+    table = doc.add_table(rows=2, cols=2)
+    table.cell(0, 0).text = "家庭成员"
+    nested = table.cell(0, 1).add_table(rows=2, cols=2)
+    nested.cell(0, 0).text = "称谓"
+    nested.cell(0, 1).text = "姓名"
+    table.cell(1, 0).text = "姓名"
+    doc.save(path)
+    return path
+
+
+def test_cell_with_nested_table_gets_no_slot_id(tmp_path):
+    structure = logic.read_template_structure(_template(str(tmp_path / "tpl.docx")))
+    assert "#T0R0C1" not in structure
+    assert "#T0R1C1" in structure
+    index = logic._build_cell_index(Document(str(tmp_path / "tpl.docx")))
+    assert "T0R0C1" not in index["by_id"] and "T0R1C1" in index["by_id"]
+
+
+@pytest.mark.parametrize("mode", ["patch", "docx"])
+def test_writes_keep_nested_table(tmp_path, mode):
+    tpl = _template(str(tmp_path / "tpl.docx"))
+    out = str(tmp_path / "out.docx")
+    plan = {"kv": [{"anchor": "家庭成员", "val": "父亲 张某", "id": "T0R0C1"},
+                   {"anchor": "姓名", "val": "张三", "id": "T0R1C1"}],
+            "checkbox": [], "lists": []}
+    logic.execute_word_writing_v2(plan, tpl, out, mode=mode)
+    table = Document(out).tables[0]
+    assert len(table.cell(0, 1).tables) == 1
+    assert table.cell(0, 1).tables[0].cell(0, 0).text == "称谓"
+    assert table.cell(1, 1).text == "张三"